@@ -1,117 +1,397 @@
-
 import argparse
 from pathlib import Path
+import sys
 import time
 
 import config
-from controls import Controls
-from minecraft import Minecraft
-from minecraftai import MinecraftAI
-from simplelogic import SimpleLogic
-import terminal
-import tests
-import vision
 
+# Everything else is imported by the subcommands that use it, so e.g. "--version" or
+# "create --help" don't wait for torch, cv2 or the platform libraries to load.
 
 
-def create(
-    path: Path,
-    name: str=config.DEFAULT_MODEL_NAME
+# Size of the frames the design works on, as (width, height). ScreenGrab decimates to this
+# size while grabbing, and other frame sources are shrunk to it by VisionProcessing.
+FRAME_SIZE = (config.CONTROLS_WINDOW_WIDTH // 8, config.CONTROLS_WINDOW_HEIGHT // 8)
+
+
+
+def define(
+    model: 'MinecraftAI',
+    screen_grab_type: type=None,
+    screen_grab_args: dict=dict(size=FRAME_SIZE),
+    controls_type: type=None,
+    controls_args: dict={},
+    simple_logic_args: dict={},
+    num_agents: int=1
 ):
-    model = MinecraftAI(name=name)
-    
+    '''
+    Adds the Processes and Connections of the design to model.
+    The frame source and the controls can be swapped out, e.g. for benchmarking.
+    With num_agents > 1, each agent gets its own frame source, vision and controls, and
+    a single SimpleLogic serves all of them with batched inference. Frame sources and
+    controls are passed their agent index as type arg agent. They default to
+    vision.ScreenGrab and Controls.
+    '''
+    from controls import Controls
+    from simplelogic import SimpleLogic
+    import vision
+    if screen_grab_type is None:
+        screen_grab_type = vision.ScreenGrab
+    if controls_type is None:
+        controls_type = Controls
+
     # A Process is a set of operations that loop in parallel to everything else.
-    # Each Process runs in its own (multiprocessing) thread.
+    # Each Process runs on its own backend: a thread (the default), a spawned OS process
+    # (backend='process') for CPU-heavy stages, or an asyncio task (backend='asyncio').
+
+    # Names are suffixed with the agent index when there's more than one agent.
+    suffixes = [''] if num_agents == 1 else [f'_{i}' for i in range(num_agents)]
 
     # A Process can be a single function. Inputs/outputs are params/return values.
-    PROC_screen_grab = model.add_process(vision.ScreenGrab, name='screen_grab')
-    PROC_vision = model.add_process(vision.VisionProcessing, name='vision')
+    PROCS_screen_grab = [model.add_process(screen_grab_type, name='screen_grab' + s,
+        type_args=dict(screen_grab_args, agent=i)) for i, s in enumerate(suffixes)]
+    # SimpleLogic only reads the RGB channels, so skip computing the other features.
+    PROCS_vision = [model.add_process(vision.VisionProcessing, name='vision' + s,
+        type_args=dict(features=['rgb'], size=FRAME_SIZE)) for s in suffixes]
 
     # A Process can also be a class inheriting from the Process class.
     # Pass the type, not an instance.
-    PROC_controls = model.add_process(Controls, name='controls')
-    PROC_simple_logic = model.add_process(SimpleLogic, name='simple_logic')
+    PROCS_controls = [model.add_process(controls_type, name='controls' + s,
+        type_args=dict(controls_args, agent=i)) for i, s in enumerate(suffixes)]
+    PROC_simple_logic = model.add_process(SimpleLogic, name='simple_logic',
+        type_args=dict(simple_logic_args, num_agents=num_agents, frame_size=FRAME_SIZE))
 
     # Processes communicate through "connections", which are made by connecting outputs to inputs.
     # Since Processes may run at different speeds, each connection has an evaluation policy.
     # Evalulation policies (default='discrete'):
     #   - 'discrete': wait and use the next available value. Note this may block the input Process.
     #   - 'continuous': return the most recent value, even if it hasn't changed from the last eval.
+    #     The sender never blocks. With wait_for_new, wait for a value newer than the last one.
     
     # connect() takes inputs and returns outputs.
     # It enables an easy sequential-like model definition, while also 
     # supporting more complex configurations.
 
-    screen = PROC_screen_grab.connect()
-    vision_data = PROC_vision.connect(screen, policy='continuous', names=['scgrb->vis'])
-    movement = PROC_simple_logic.connect(vision_data, policy='discrete', names=['vis->mov'])
-    PROC_controls.connect(movement, policy='discrete', names=['mov->ctrl'])
+    vision_data = []
+    for s, PROC_screen_grab, PROC_vision in zip(suffixes, PROCS_screen_grab, PROCS_vision):
+        screen = PROC_screen_grab.connect()
+        vision_data.append(PROC_vision.connect(screen, policy='continuous',
+            names=['scgrb->vis' + s], connection_args=dict(wait_for_new=True)))
+    movement = PROC_simple_logic.connect(*vision_data, policy='discrete',
+        names=['vis->mov' + s for s in suffixes])
+    if num_agents == 1:
+        movement = [movement]
+    for s, PROC_controls, m in zip(suffixes, PROCS_controls, movement):
+        PROC_controls.connect(m, policy='discrete', names=['mov->ctrl' + s])
+
+
 
+def create(
+    path: Path,
+    name: str=config.DEFAULT_MODEL_NAME,
+    recording_path: Path=None,
+    replay_mode: str='native',
+    learning: str='inline',
+    num_agents: int=1,
+    acceleration: dict=None
+):
+    from minecraftai import MinecraftAI
+    import recording
+    model = MinecraftAI(name=name)
+    simple_logic_args = dict(learning=learning, acceleration=acceleration)
+    # Frames come from the Minecraft window, or from a recording made with "record".
+    if recording_path is None:
+        # Only agent 0 can use the game's window. See run --platform.
+        define(model, simple_logic_args=simple_logic_args, num_agents=num_agents)
+    else:
+        define(model, recording.RecordedScreenGrab,
+            dict(path=str(recording_path), mode=replay_mode),
+            simple_logic_args=simple_logic_args, num_agents=num_agents)
     model.save(path)
 
 
 
 
-def run(model_path: Path):
+def platform_arguments(parser: argparse.ArgumentParser):
+    '''Adds the arguments choosing a platform (see platforms.py) to parser.'''
+    import platforms
+    from simulation import SimulatedMinecraft
+    parser.add_argument('--platform', action='store', type=str,
+        choices=list(platforms.PLATFORMS),
+        help=f'where frames come from and camera movements go (default {config.PLATFORM})')
+    parser.add_argument('--simulate', action='store', type=str,
+        choices=SimulatedMinecraft.MODES,
+        help='shorthand for --platform simulated, at this speed')
+    parser.add_argument('--platform_recording', action='store', type=str,
+        help='the recording to replay with --platform recorded')
+
+
+def chosen_platform(args: argparse.Namespace) -> tuple[str or None, dict]:
+    '''
+    The name and arguments of the platform chosen by args (see platform_arguments()),
+    or (None, {}) if none was chosen.
+    '''
+    if args.simulate is not None:
+        return 'simulated', {'mode': args.simulate}
+    if args.platform == 'recorded':
+        if args.platform_recording is None:
+            raise ValueError('--platform recorded requires --platform_recording')
+        return 'recorded', {'path': args.platform_recording}
+    return args.platform, {}
+
+
+
+def run(
+    model_path: Path,
+    checkpoint_interval: float=0,
+    keep_checkpoints: int=3,
+    train: bool=True,
+    quantize: bool=False,
+    fuse: bool=False,
+    trace: str=None
+):
+    from checkpoint import CheckpointScheduler
+    from minecraft import Minecraft
+    from minecraftai import MinecraftAI
+    import terminal
+    import tracing
 
     model = MinecraftAI.load(model_path)
     Minecraft.focus_window()
-    model.start()
+    # Before building, since Processes add their models (and optimizers) when built.
+    model.set_training(train, quantize)
+    model.build(fuse=fuse)
+    if trace is not None:
+        tracing.start(trace)
+    model.start(allow_training=train, quantize=quantize)
+    # Periodically save to model_path/checkpoints, so a crash doesn't lose the session.
+    # Frozen models don't change, so there's nothing to save.
+    scheduler = None
+    if checkpoint_interval > 0 and train:
+        scheduler = CheckpointScheduler(model, Path(model_path) / 'checkpoints',
+            checkpoint_interval, keep_checkpoints)
+        scheduler.start()
     
     terminal.during_run(model)
 
+    if scheduler is not None:
+        scheduler.stop()
     model.stop()
+    if trace is not None:
+        # After stopping, so spans from Processes in their own OS process are included.
+        tracing.stop()
+        print(f'Wrote trace to {trace}')
 
-    model.save(model_path)
+    if train:
+        model.save(model_path)
 
 
 
+def record(dest_path: Path, seconds: float):
+    '''Record frames from the Minecraft window, for replay with RecordedScreenGrab.'''
+    from minecraft import Minecraft
+    from minecraftai import MinecraftAI
+    import recording
+    import vision
+    model = MinecraftAI(name='recorder')
+    PROC_screen_grab = model.add_process(vision.ScreenGrab, name='screen_grab')
+    PROC_recorder = model.add_process(recording.FrameRecorder, name='recorder',
+        type_args=dict(path=str(dest_path)))
+    PROC_recorder.connect(PROC_screen_grab.connect(), names=['scgrb->rec'])
+    Minecraft.focus_window()
+    model.start()
+    try:
+        time.sleep(seconds)
+    except KeyboardInterrupt:
+        pass
+    model.stop()
+    print(f'Recorded {PROC_recorder.get_properties().get("recorded", 0)} frames')
 
 
 
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(
-        prog='MinecraftAI',
-        description='An AI designed to play Minecraft.'
-    )
-    subparsers = parser.add_subparsers(dest='subcommand', required=True)
-    parser.add_argument('-v', '--version', action='version', version=config.VERSION)
 
-    parser_create = subparsers.add_parser('create', help='create a new model')
-    parser_create.add_argument('dest_path', action='store', type=str,
+
+
+def acceleration_arguments(parser: argparse.ArgumentParser):
+    '''Adds the arguments accelerating SimpleLogic\'s inference to parser.'''
+    from process import COMPILE_MODES
+    parser.add_argument('--accelerate', action='store_true',
+        help='run inference in torch.inference_mode, with channels-last tensors')
+    parser.add_argument('--compile', action='store', type=str,
+        choices=[m for m in COMPILE_MODES if m is not None],
+        help='compile the model for inference (implies --accelerate)')
+    parser.add_argument('--threads', action='store', type=int,
+        help='torch threads per operation for SimpleLogic (implies --accelerate)')
+
+
+def chosen_acceleration(args: argparse.Namespace) -> dict or None:
+    '''The acceleration chosen by args (see acceleration_arguments()), if any.'''
+    if not args.accelerate and args.compile is None and args.threads is None:
+        return None
+    return dict(channels_last=True, compile=args.compile, num_threads=args.threads)
+
+
+
+def create_arguments(parser: argparse.ArgumentParser):
+    import recording
+    parser.add_argument('dest_path', action='store', type=str,
         help='path to save the new model')
-    parser_create.add_argument('--name', '-n', action='store', type=str,
+    parser.add_argument('--name', '-n', action='store', type=str,
         help='the name of the model',
         default=config.DEFAULT_MODEL_NAME)
+    parser.add_argument('--recording', '-r', action='store', type=str,
+        help='replay frames from this recording instead of grabbing the screen')
+    parser.add_argument('--replay_mode', action='store', type=str, default='native',
+        choices=recording.RecordedScreenGrab.MODES,
+        help='how fast to replay the recording')
+    parser.add_argument('--learning', action='store', type=str, default='inline',
+        choices=config.LEARNING_MODES,
+        help='train inline, or on a background learner so movements are not delayed by training')
+    parser.add_argument('--agents', action='store', type=int, default=1,
+        help='number of agents sharing one batched SimpleLogic (requires --recording or ' + \
+            'running on a platform other than win32)')
+    acceleration_arguments(parser)
+
 
-    parser_run = subparsers.add_parser('run', help='run an existing model')
-    parser_run.add_argument('model_path', action='store', type=str,
+def run_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('model_path', action='store', type=str,
         help='path to load the model from')
-    parser_run.add_argument('-nt', '--no_train', dest='train', action='store_false',
+    parser.add_argument('-nt', '--no_train', dest='train', action='store_false',
         help='freeze the model to prevent learning')
+    parser.add_argument('--quantize', action='store_true',
+        help='with --no_train, run models with int8 dynamically quantized linear layers')
+    parser.add_argument('--checkpoint_interval', action='store', type=float, default=0,
+        help='save a checkpoint to model_path/checkpoints every this many seconds (0 = never)')
+    parser.add_argument('--keep_checkpoints', action='store', type=int, default=3,
+        help='how many of the most recent checkpoints to keep')
+    parser.add_argument('--fuse', action='store_true',
+        help='run linear chains of Processes as one loop, without hand-offs between them')
+    parser.add_argument('--trace', action='store', type=str,
+        help='write a Chrome trace of the run to this file, viewable in Perfetto')
+    platform_arguments(parser)
+
+
+def bench_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--recording', '-r', action='store', type=str,
+        help='replay frames from this recording instead of synthetic frames')
+    parser.add_argument('--seconds', '-s', action='store', type=float, default=10,
+        help='how long to run the end-to-end benchmark for')
+    parser.add_argument('--iterations', '-i', action='store', type=int, default=200,
+        help='iterations for the per-stage and connection benchmarks')
+    parser.add_argument('--output', '-o', action='store', type=str,
+        help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--agents', action='store', type=int, default=1,
+        help='number of agents sharing one batched SimpleLogic')
+    parser.add_argument('--learning', action='store', type=str, default='inline',
+        choices=config.LEARNING_MODES,
+        help='how SimpleLogic learns; only \'async\' runs inference separately from training')
+    parser.add_argument('-nt', '--no_train', dest='train', action='store_false',
+        help='benchmark the frozen model, without learning')
+    parser.add_argument('--quantize', action='store_true',
+        help='with --no_train, run models with int8 dynamically quantized linear layers')
+    acceleration_arguments(parser)
+    parser.add_argument('--fuse', action='store_true',
+        help='also run the pipeline with linear chains of Processes fused, and compare')
+    parser.add_argument('--trace', action='store', type=str,
+        help='write a Chrome trace of the end-to-end pipeline to this file')
+    parser.add_argument('--startup', action='store_true',
+        help='only measure how long the CLI takes to start, and what it imports')
+    # With a platform, the design runs closed-loop against it, with its own controls.
+    platform_arguments(parser)
+
+
+def record_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('dest_path', action='store', type=str,
+        help='directory to save the recording')
+    parser.add_argument('--seconds', '-s', action='store', type=float, default=60,
+        help='how long to record for')
+    platform_arguments(parser)
+
+
+# Subcommands, with their help and a function adding their arguments.
+SUBCOMMANDS = {
+    'create': ('create a new model', create_arguments),
+    'run': ('run an existing model', run_arguments),
+    'bench': ('benchmark the model design', bench_arguments),
+    'record': ('record frames for later replay', record_arguments),
+    'test1': ('test: detect wnd & send keypresses', None),
+    'test2': ('test: test optical flow', None),
+    'test3': ('test: test feature mapping', None),
+    'test4': ('test: test the mouse movement', None),
+    'test5': ('test: test the model loading capability', None),
+    'test6': ('test: compare connection transport throughput', None),
+    'test7': ('test: check that frozen models don\'t build optimizers', None),
+}
 
-    subparsers.add_parser('test1', help='test: detect wnd & send keypresses')
-    subparsers.add_parser('test2', help='test: test optical flow')
-    subparsers.add_parser('test3', help='test: test feature mapping')
-    subparsers.add_parser('test4', help='test: test the mouse movement')
-    subparsers.add_parser('test5', help='test: test the model loading capability')
+
+
+
+
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='MinecraftAI',
+        description='An AI designed to play Minecraft.'
+    )
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    parser.add_argument('-v', '--version', action='version', version=config.VERSION)
+
+    subcommand_parsers = {name: subparsers.add_parser(name, help=help)
+        for name, (help, _) in SUBCOMMANDS.items()}
+    # Only the chosen subcommand's arguments are added, because adding them imports the
+    # modules their choices come from.
+    chosen = next((a for a in sys.argv[1:] if a in SUBCOMMANDS), None)
+    if chosen is not None and SUBCOMMANDS[chosen][1] is not None:
+        SUBCOMMANDS[chosen][1](subcommand_parsers[chosen])
 
     args = parser.parse_args()
 
     if args.subcommand == 'create':
-        create(args.dest_path, args.name)
-    elif args.subcommand == 'run':
-        run(args.model_path)
-
-    elif args.subcommand == 'test1':
-        tests.keypress_test()
-    elif args.subcommand == 'test2':
-        tests.optical_flow_test()
-    elif args.subcommand == 'test3':
-        tests.feature_map_test()
-    elif args.subcommand == 'test4':
-        tests.mouse_test()
-    elif args.subcommand == 'test5':
-        tests.load_test()
+        create(args.dest_path, args.name, args.recording, args.replay_mode, args.learning,
+            args.agents, chosen_acceleration(args))
+    elif args.subcommand in ['run', 'record']:
+        from minecraft import Minecraft
+        platform_name, platform_args = chosen_platform(args)
+        if platform_name is not None:
+            Minecraft.use_platform(platform_name, **platform_args)
+        if args.subcommand == 'run':
+            if args.quantize and args.train:
+                parser.error('--quantize requires --no_train')
+            run(args.model_path, args.checkpoint_interval, args.keep_checkpoints, args.train,
+                args.quantize, args.fuse, args.trace)
+        else:
+            record(args.dest_path, args.seconds)
+    elif args.subcommand == 'bench':
+        import bench
+        if args.startup:
+            bench.run_startup_benchmark(Path(__file__).parent, args.output)
+        else:
+            simple_logic_args = dict(learning=args.learning,
+                acceleration=chosen_acceleration(args))
+            if args.quantize and args.train:
+                parser.error('--quantize requires --no_train')
+            bench.run_benchmark(define, args.recording, args.seconds, args.iterations,
+                args.output, args.agents, *chosen_platform(args), simple_logic_args,
+                args.train, args.quantize, args.fuse, args.trace)
+
+    # The tests use pywin32 directly, so only import them when needed.
+    elif args.subcommand.startswith('test'):
+        import tests
+        if args.subcommand == 'test1':
+            tests.keypress_test()
+        elif args.subcommand == 'test2':
+            tests.optical_flow_test()
+        elif args.subcommand == 'test3':
+            tests.feature_map_test()
+        elif args.subcommand == 'test4':
+            tests.mouse_test()
+        elif args.subcommand == 'test5':
+            tests.load_test()
+        elif args.subcommand == 'test6':
+            tests.transport_test()
+        elif args.subcommand == 'test7':
+            tests.frozen_build_test(define)
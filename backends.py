@@ -0,0 +1,180 @@
+import asyncio
+import inspect
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+
+import tracing
+
+
+
+# Execution backends a ProcessContainer can run on.
+#   - 'thread': a threading.Thread in this interpreter. Cheap, but shares the GIL.
+#   - 'process': a spawned OS process. CPU-heavy stages scale across cores.
+#   - 'asyncio': a task on a shared event loop thread. For cheap, I/O-bound stages.
+BACKENDS = ('thread', 'process', 'asyncio')
+
+# How often a process backend reports its properties back to the parent, in seconds.
+STATUS_INTERVAL = 0.25
+
+# How long an asyncio backend sleeps while waiting for input or output space, in seconds.
+POLL_INTERVAL = 0.001
+
+
+def check_backend(name: str) -> str:
+    if name not in BACKENDS:
+        raise ValueError(f'"{name}" is not a valid execution backend ' + \
+            f'(expected one of {", ".join(BACKENDS)})')
+    return name
+
+
+
+class EventLoopThread():
+    '''
+    An asyncio event loop running forever in a background thread.
+    All ProcessContainers using the 'asyncio' backend share one of these.
+    '''
+
+    def __init__(self, name: str='asyncio'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, coro) -> 'concurrent.futures.Future':
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+
+def process_main(process_obj, inputs: list, outputs: list, stop_event, status, control,
+    trace_capacity: int=None):
+    '''
+    Entry point of a spawned OS process running a single Process.
+    The Process is built here, since built state (window handles, etc.) can't be pickled.
+    Properties, input latencies and output drops are reported through status periodically,
+    and the models are sent back when stopping so the parent can save them.
+    Snapshot requests (see ProcessContainer.snapshot_models()) arrive through control and
+    are answered from a separate thread, so they don't wait for the run loop.
+    With trace_capacity, spans are traced here and sent back when stopping (see tracing.py).
+    '''
+    from process import _run_loop
+    if trace_capacity is not None:
+        tracing.start(capacity=trace_capacity)
+    # Outputs that aren't connected are None.
+    connected = [conn for conn in outputs if conn is not None]
+    last_report = time.perf_counter()
+    def report():
+        nonlocal last_report
+        now = time.perf_counter()
+        if now - last_report > STATUS_INTERVAL:
+            last_report = now
+            try:
+                status.put_nowait(('properties', process_obj._get_properties()))
+                status.put_nowait(('latency',
+                    {conn.connection_id: conn._latency for conn in inputs}))
+                status.put_nowait(('dropped',
+                    {conn.connection_id: conn._dropped for conn in connected}))
+            except queue.Full:
+                pass
+    def serve_snapshots():
+        while True:
+            ticket = control.get()
+            if ticket is None:
+                return
+            status.put(('snapshot', (ticket, pickle.dumps(process_obj._snapshot_models()))))
+    process_obj._build()
+    snapshots = threading.Thread(target=serve_snapshots, name='snapshots', daemon=True)
+    snapshots.start()
+    _run_loop(process_obj, inputs, outputs, lambda: not stop_event.is_set(), report,
+        multiprocessing.current_process().name)
+    control.put(None)
+    snapshots.join()
+    # Pickle the models by value. Tensors sent through a multiprocessing queue would
+    # otherwise be shared via file descriptors that disappear when this process exits.
+    status.put(('latency', {conn.connection_id: conn._latency for conn in inputs}))
+    status.put(('dropped', {conn.connection_id: conn._dropped for conn in connected}))
+    trace = tracing.stop()
+    if trace is not None:
+        status.put(('trace', trace))
+    status.put(('final', {
+        'properties': process_obj._get_properties(),
+        'models': pickle.dumps(process_obj._models),
+    }))
+    # Don't wait for undelivered data to be flushed when exiting, except for outputs,
+    # whose values are written to the pipe by a feeder thread. Exiting while it writes one
+    # would leave half a value in the pipe, and the queue's lock held, for the parent
+    # reading it to block on forever. The parent drains outputs while waiting for us.
+    for conn in inputs:
+        conn._detach()
+    control.cancel_join_thread()
+
+
+
+async def run_async(container):
+    '''
+    Run loop of a ProcessContainer using the 'asyncio' backend.
+    Connections are polled without blocking so other tasks on the loop keep running.
+    run() may be a coroutine function.
+    '''
+    process_obj = container.process_obj
+    inputs, outputs = container.inputs, container.outputs
+    is_coroutine = inspect.iscoroutinefunction(process_obj.run)
+    process_obj._start()
+    try:
+        await _run_async_loop(container, process_obj, inputs, outputs, is_coroutine)
+    finally:
+        process_obj._stop()
+
+
+async def _run_async_loop(container, process_obj, inputs, outputs, is_coroutine):
+    stats = process_obj._stats
+    while container._keep_running:
+        t_start = time.perf_counter()
+        data = [None] * len(inputs)
+        origin = None
+        for i, conn in enumerate(inputs):
+            while True:
+                try:
+                    data[i] = conn.request(block=False)
+                    break
+                except queue.Empty:
+                    if not container._keep_running:
+                        return
+                    await asyncio.sleep(POLL_INTERVAL)
+            if data[i] is None:
+                data = None
+                break
+            if origin is None or conn.last_origin < origin:
+                origin = conn.last_origin
+        if data is None:
+            continue
+        t_inputs = time.perf_counter()
+        if is_coroutine:
+            results = await process_obj._run_async(data, origin)
+        else:
+            results = process_obj._run(data, origin)
+        t_run = time.perf_counter()
+        if tracing.active:
+            # Spans of a coroutine include time other tasks ran while it was suspended.
+            tracing.record(container.name, 'run', t_inputs, t_run)
+        origin = process_obj.input_origin()
+        for conn, d in zip(outputs, results):
+            while d is not None and conn is not None:
+                try:
+                    conn.send(d, block=False, origin=origin)
+                    break
+                except queue.Full:
+                    if not container._keep_running:
+                        return
+                    await asyncio.sleep(POLL_INTERVAL)
+        stats.record(t_inputs - t_start, t_run - t_inputs, time.perf_counter() - t_run)
+        # Give other tasks a turn even if this one never has to wait.
+        await asyncio.sleep(0)
@@ -0,0 +1,497 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import config
+from connection import Connection
+from controls import Controls
+from minecraft import Minecraft
+from minecraftai import MinecraftAI
+from process import Process
+import recording
+import tracing
+
+
+# Seconds to let the pipeline settle before measuring the end-to-end benchmark.
+WARMUP_SECONDS = 2.0
+# Per-stage iterations that are run but not measured.
+WARMUP_ITERATIONS = 10
+
+# CLI invocations measured by the startup benchmark, with the most they may take (in
+# milliseconds, including the interpreter's own startup) and modules they must not import.
+# Tooling calls the CLI many times, so these shouldn't creep up. {tmp} stands for a
+# temporary directory, e.g. to save a model to.
+STARTUP_COMMANDS = {
+    'version': (['--version'], 300, ['torch', 'cv2', 'numpy', 'mss', 'rich', 'win32api']),
+    'help': (['--help'], 300, ['torch', 'cv2', 'numpy', 'mss', 'rich', 'win32api']),
+    'run_help': (['run', '--help'], 600, ['torch', 'cv2', 'mss', 'rich', 'win32api']),
+    'record_help': (['record', '--help'], 600, ['torch', 'cv2', 'mss', 'rich', 'win32api']),
+    'create_help': (['create', '--help'], 600, ['torch', 'cv2', 'mss', 'rich', 'win32api']),
+    'create': (['create', '{tmp}/model'], 600, ['torch', 'cv2', 'mss', 'rich', 'win32api']),
+}
+# How many times each command is run for the startup benchmark.
+STARTUP_REPEATS = 10
+
+
+
+class SyntheticScreenGrab(Process):
+    '''
+    Produces frames the size of the Minecraft window without needing the game:
+    a fixed noisy background with a pink square drifting across it.
+    '''
+
+    def __init__(self, seed: int=0, agent: int=0):
+        # Each agent gets its own background.
+        self.seed = seed + agent
+        self.background = None
+        self.index = 0
+        super().__init__(num_inputs=0, num_outputs=1)
+
+    def build(self):
+        rng = np.random.default_rng(self.seed)
+        shape = (config.CONTROLS_WINDOW_HEIGHT, config.CONTROLS_WINDOW_WIDTH, 3)
+        self.background = rng.integers(0, 96, shape, dtype=np.uint8)
+
+    def run(self, inputs: list):
+        frame = self.background.copy()
+        h, w = frame.shape[:2]
+        size = min(h, w) // 8
+        t = self.index / 60
+        x = int((np.sin(t) * 0.4 + 0.5) * (w - size))
+        y = int((np.cos(t * 0.7) * 0.4 + 0.5) * (h - size))
+        frame[y:y + size, x:x + size] = (240, 150, 150)
+        self.index += 1
+        return [frame]
+
+    def serialize(self, path) -> dict:
+        return {'seed': self.seed}
+
+    def deserialize(self, config: dict, path):
+        self.seed = config.get('seed', 0)
+
+
+
+class LatencySink(Process):
+    '''
+    Stands in for Controls. Records when each input arrived and how long ago the data
+    behind it entered the graph.
+    '''
+
+    def __init__(self, capacity: int=1_000_000, agent: int=0):
+        self.agent = agent
+        self.arrivals = np.zeros(capacity, dtype=np.float64)
+        self.latencies = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+        super().__init__(num_inputs=1, num_outputs=0)
+
+    def run(self, inputs: list):
+        if self.count < len(self.arrivals):
+            now = time.perf_counter()
+            self.arrivals[self.count] = now
+            self.latencies[self.count] = now - self.input_origin()
+            self.count += 1
+        return []
+
+
+
+def percentiles(samples: np.ndarray, scale: float=1e3) -> dict:
+    '''Summary statistics of samples (in seconds), scaled to milliseconds by default.'''
+    if len(samples) == 0:
+        return {}
+    samples = np.asarray(samples) * scale
+    return {
+        'mean': float(np.mean(samples)),
+        'p50': float(np.percentile(samples, 50)),
+        'p90': float(np.percentile(samples, 90)),
+        'p99': float(np.percentile(samples, 99)),
+        'max': float(np.max(samples)),
+        'count': len(samples),
+    }
+
+
+def bench_stages(model: MinecraftAI, iterations: int) -> dict:
+    '''
+    Runs every Process once per iteration, in graph order, on the calling thread.
+    This measures the cost of each run() without any hand-off or contention.
+    The model must be built (see MinecraftAI.build()).
+    '''
+    order = model.order
+    timings = {p.name: np.zeros(iterations) for p in order}
+    for proc in order:
+        proc.process_obj._start()
+    values = {}
+    for i in range(-WARMUP_ITERATIONS, iterations):
+        for proc in order:
+            inputs = [values[c] for c in proc.input_connections]
+            start = time.perf_counter()
+            outputs = proc.process_obj._run(inputs)
+            elapsed = time.perf_counter() - start
+            if i >= 0:
+                timings[proc.name][i] = elapsed
+            for c, data in zip(proc.output_connections, outputs):
+                if data is not None:
+                    values[c] = data
+    for proc in order:
+        proc.process_obj._stop()
+    return {name: percentiles(t) for name, t in timings.items()}
+
+
+
+def bench_connections(frame_shape: tuple, iterations: int) -> dict:
+    '''
+    Measures the hand-off cost of each kind of Connection between two threads.
+    The producer sends as fast as it can; the consumer receives until it has seen the
+    last item, recording how long each received item spent in the Connection.
+    '''
+    frame = np.zeros(frame_shape, dtype=np.uint8)
+    variants = {
+        'discrete_queue_small': (Connection(0, 'discrete'), np.zeros(2)),
+        'discrete_queue_frame': (Connection(0, 'discrete'), frame),
+        'discrete_shared_memory_frame': (Connection(0, 'discrete', transport='shared_memory',
+            transport_args=dict(shape=frame_shape)), frame),
+        'continuous_frame': (Connection(0, 'continuous', wait_for_new=True), frame),
+        'discrete_queue_drop_oldest_frame': (Connection(0, 'discrete', overflow='drop_oldest'),
+            frame),
+    }
+    results = {}
+    for name, (conn, payload) in variants.items():
+        conn._build()
+        latencies = []
+        done = threading.Event()
+        def produce():
+            for _ in range(iterations):
+                conn.send(payload)
+            done.set()
+            # Continuous Connections may have overwritten the last item, so keep
+            # signalling until the consumer notices.
+            conn.post_stop()
+        producer = threading.Thread(target=produce)
+        start = time.perf_counter()
+        producer.start()
+        while True:
+            data = conn.request()
+            if data is None:
+                break
+            latencies.append(time.perf_counter() - conn.last_origin)
+            if done.is_set() and conn.size() == 0 and len(latencies) >= iterations:
+                break
+        elapsed = time.perf_counter() - start
+        producer.join()
+        results[name] = {
+            'items_per_second': iterations / elapsed,
+            'delivered': len(latencies),
+            'latency_us': percentiles(latencies, scale=1e6),
+        }
+        if 'dropped' in conn.get_stats():
+            results[name]['dropped'] = conn.get_stats()['dropped']
+    return results
+
+
+
+def bench_pipeline(
+    model: MinecraftAI,
+    sinks: list[LatencySink],
+    seconds: float,
+    allow_training: bool=True,
+    quantize: bool=False
+) -> dict:
+    '''
+    Runs the whole graph and measures the throughput and latency seen by the sinks.
+    With several agents, frames per second are summed over all of them.
+    '''
+    model.start(allow_training, quantize)
+    try:
+        time.sleep(WARMUP_SECONDS)
+        start_counts = [s.count for s in sinks]
+        start = time.perf_counter()
+        time.sleep(seconds)
+        end_counts = [s.count for s in sinks]
+        elapsed = time.perf_counter() - start
+    finally:
+        model.stop()
+    frames = sum(end - start for start, end in zip(start_counts, end_counts))
+    return {
+        'frames_per_second': frames / elapsed,
+        'frames_per_second_per_agent': frames / elapsed / len(sinks),
+        'latency_ms': percentiles(np.concatenate([s.latencies[start:end]
+            for s, start, end in zip(sinks, start_counts, end_counts)])),
+        'connections': {c.name: c.get_stats() for c in model.connections.values()},
+        'properties': {p.name: {k: str(v) for k, v in p.get_properties().items()}
+            for p in model.processes.values()},
+    }
+
+
+
+def bench_closed_loop(
+    model: MinecraftAI,
+    seconds: float,
+    allow_training: bool=True,
+    quantize: bool=False
+) -> dict:
+    '''
+    Runs the whole graph against the current platform (see Minecraft.use_platform()) and
+    measures the frames provided, the camera movements made, and the latency from frame to
+    movement seen by each Controls. Simulated environments also report how far each agent's
+    view is from a target.
+    '''
+    model.start(allow_training, quantize)
+    try:
+        time.sleep(WARMUP_SECONDS)
+        start_stats = Minecraft.get_platform().stats()
+        start = time.perf_counter()
+        time.sleep(seconds)
+        end_stats = Minecraft.get_platform().stats()
+        elapsed = time.perf_counter() - start
+    finally:
+        model.stop()
+    def total(key):
+        return sum(end_stats[a][key] - start_stats.get(a, {}).get(key, 0) for a in end_stats)
+    results = {
+        'frames_per_second': total('frames') / elapsed,
+        'frames_per_second_per_agent': total('frames') / elapsed / max(len(end_stats), 1),
+        'moves_per_second': total('moves') / elapsed,
+    }
+    if any('target_error' in stats for stats in end_stats.values()):
+        results['target_error'] = {a: stats.get('target_error')
+            for a, stats in end_stats.items()}
+    results.update({
+        'control_latency': {p.name: p.process_obj.latency.to_dict()
+            for p in model.processes.values() if isinstance(p.process_obj, Controls)},
+        'connections': {c.name: c.get_stats() for c in model.connections.values()},
+        'properties': {p.name: {k: str(v) for k, v in p.get_properties().items()}
+            for p in model.processes.values()},
+    })
+    return results
+
+
+
+def build_model(
+    define,
+    recording_path: str=None,
+    num_agents: int=1,
+    closed_loop: bool=False,
+    simple_logic_args: dict={}
+) -> MinecraftAI:
+    '''
+    Builds the design from define(), with benchmark frame sources and sinks, or with its
+    own frame sources and controls if closed_loop.
+    '''
+    model = MinecraftAI(name='bench')
+    if closed_loop:
+        define(model, simple_logic_args=simple_logic_args, num_agents=num_agents)
+    elif recording_path is None:
+        define(model, SyntheticScreenGrab, {}, LatencySink, {},
+            simple_logic_args=simple_logic_args, num_agents=num_agents)
+    else:
+        define(model, recording.RecordedScreenGrab,
+            dict(path=str(recording_path), mode='unthrottled'), LatencySink, {},
+            simple_logic_args=simple_logic_args, num_agents=num_agents)
+    return model
+
+
+def get_sinks(model: MinecraftAI) -> list[LatencySink]:
+    return [p.process_obj for p in model.processes.values()
+        if isinstance(p.process_obj, LatencySink)]
+
+
+
+def run_benchmark(
+    define,
+    recording_path: str=None,
+    seconds: float=10,
+    iterations: int=200,
+    output: str=None,
+    num_agents: int=1,
+    platform_name: str=None,
+    platform_args: dict={},
+    simple_logic_args: dict={},
+    allow_training: bool=True,
+    quantize: bool=False,
+    fuse: bool=False,
+    trace: str=None
+) -> dict:
+    '''
+    Benchmarks the design from define() (see __main__.py) and writes JSON results.
+    Frames are synthetic, or replayed from recording_path as fast as they are consumed.
+    Controls are replaced by a LatencySink, so nothing is sent to the game.
+    If platform_name is given (see platforms.PLATFORMS), the design runs closed-loop
+    against that platform instead, with its own frame sources and controls.
+    simple_logic_args are passed to SimpleLogic. allow_training and quantize are passed to
+    MinecraftAI.start(). If SimpleLogic is accelerated or quantized, each stage is also
+    measured without either first, and the speedups are reported.
+    With fuse, the pipeline is also run with its linear chains of Processes fused (see
+    MinecraftAI.fuse_chains()), and compared to running them separately.
+    With trace, the end-to-end pipeline (not fused) is traced, and the trace is written
+    there as Chrome trace events (see tracing.py).
+    '''
+    closed_loop = platform_name is not None
+    if closed_loop:
+        Minecraft.use_platform(platform_name, **platform_args)
+    results = {
+        'version': config.VERSION,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'source': f'platform {platform_name} {platform_args}' if closed_loop else \
+            'synthetic' if recording_path is None else str(recording_path),
+        'agents': num_agents,
+    }
+
+    results['training'] = allow_training
+    acceleration = simple_logic_args.get('acceleration')
+    accelerated = acceleration is not None or quantize
+    if accelerated:
+        # Before anything is accelerated, since that may change torch's thread count.
+        baseline_args = dict(simple_logic_args, acceleration=None)
+        model = build_model(define, recording_path, num_agents, closed_loop, baseline_args)
+        model.set_training(allow_training)
+        model.build()
+        baseline = bench_stages(model, iterations)
+
+    model = build_model(define, recording_path, num_agents, closed_loop, simple_logic_args)
+    model.set_training(allow_training, quantize)
+    model.build()
+    results['stages_ms'] = bench_stages(model, iterations)
+    if accelerated:
+        results['acceleration'] = {
+            'options': acceleration,
+            'quantize': quantize,
+            'baseline_stages_ms': baseline,
+            'speedup': {name: baseline[name]['p50'] / stats['p50']
+                for name, stats in results['stages_ms'].items()},
+        }
+
+    if recording_path is None or closed_loop:
+        frame_shape = (config.CONTROLS_WINDOW_HEIGHT, config.CONTROLS_WINDOW_WIDTH, 3)
+    else:
+        frame_shape = recording.FrameReader(recording_path).shape
+    results['connections'] = bench_connections(frame_shape, iterations * 10)
+
+    def pipeline(fuse):
+        model = build_model(define, recording_path, num_agents, closed_loop, simple_logic_args)
+        model.build(fuse=fuse)
+        chains = [[p.name for p in chain] for chain in model.chains]
+        if closed_loop:
+            # Start from a fresh platform, not the one the last benchmark moved.
+            Minecraft.use_platform(platform_name, **platform_args)
+            return bench_closed_loop(model, seconds, allow_training, quantize), chains
+        return bench_pipeline(model, get_sinks(model), seconds, allow_training,
+            quantize), chains
+
+    if trace is not None:
+        tracing.start(trace)
+    results['pipeline'], _ = pipeline(False)
+    if trace is not None:
+        tracing.stop()
+        results['trace'] = str(trace)
+    if fuse:
+        fused, chains = pipeline(True)
+        baseline = results['pipeline']
+        results['fusion'] = {
+            'chains': chains,
+            'pipeline': fused,
+            'frames_per_second_speedup': fused['frames_per_second'] / \
+                baseline['frames_per_second'] if baseline['frames_per_second'] else None,
+        }
+        if 'latency_ms' in fused and fused['latency_ms'] and baseline['latency_ms']:
+            results['fusion']['latency_p50_speedup'] = \
+                baseline['latency_ms']['p50'] / fused['latency_ms']['p50']
+
+    text = json.dumps(results, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as file:
+            file.write(text)
+    return results
+
+
+
+def parse_importtime(stderr: str) -> dict:
+    '''
+    The cumulative import time (in milliseconds) of each top-level import, from the output
+    of python -X importtime.
+    '''
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        # Nested imports are indented further, and are already part of their parent's time.
+        if not fields[2].startswith('  '):
+            imports[fields[2].strip()] = int(fields[1]) / 1e3
+    return imports
+
+
+def bench_startup(package_path: str, args: list, repeats: int=STARTUP_REPEATS) -> dict:
+    '''
+    Runs the CLI in package_path with args: repeats times for its wall time, and once with
+    -X importtime to see where that time goes.
+    '''
+    command = [sys.executable, str(package_path), *args]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=os.environ)
+        times.append(time.perf_counter() - start)
+    traced = subprocess.run([sys.executable, '-X', 'importtime', *command[1:]],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, env=os.environ)
+    imports = parse_importtime(traced.stderr)
+    slowest = sorted(imports.items(), key=lambda i: i[1], reverse=True)[:10]
+    all_modules = [line.split('|')[-1].strip() for line in traced.stderr.splitlines()
+        if line.startswith('import time:')]
+    return {
+        'wall_ms': percentiles(times),
+        'import_ms': sum(imports.values()),
+        'slowest_imports_ms': dict(slowest),
+        'modules': all_modules,
+    }
+
+
+def run_startup_benchmark(package_path: str, output: str=None) -> dict:
+    '''
+    Measures the CLI's startup (see STARTUP_COMMANDS) and writes JSON results.
+    Commands over their budget, or importing modules they shouldn't, are listed under
+    'regressions'.
+    '''
+    results = {
+        'version': config.VERSION,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commands': {},
+        'regressions': [],
+    }
+    for name, (args, budget_ms, forbidden) in STARTUP_COMMANDS.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            result = bench_startup(package_path, [a.format(tmp=tmp) for a in args])
+        modules = result.pop('modules')
+        # Submodules count as their package, e.g. torch.nn as torch.
+        result['forbidden_imports'] = [m for m in forbidden
+            if any(n == m or n.startswith(m + '.') for n in modules)]
+        result['budget_ms'] = budget_ms
+        results['commands'][name] = result
+        if result['wall_ms']['p50'] > budget_ms:
+            results['regressions'].append(f'{name}: {result["wall_ms"]["p50"]:.0f} ms ' + \
+                f'(budget {budget_ms} ms)')
+        if result['forbidden_imports']:
+            results['regressions'].append(f'{name}: imports ' + \
+                ', '.join(result['forbidden_imports']))
+
+    text = json.dumps(results, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as file:
+            file.write(text)
+    return results
@@ -0,0 +1,104 @@
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+
+
+
+# Checkpoints are complete model directories (loadable with MinecraftAI.load()), named by
+# number inside a checkpoints directory. They're written to a temporary directory first
+# and renamed once complete, so a crash never leaves a partial checkpoint behind.
+CHECKPOINT_PREFIX = 'checkpoint_'
+TEMP_PREFIX = '.tmp_'
+
+
+
+class CheckpointScheduler():
+    '''
+    Periodically saves a running MinecraftAI to path, keeping the last keep checkpoints.
+    Models are copied while they aren't being updated (see Process.models_lock()), which
+    only holds up the Processes for as long as the copy takes. Everything else, including
+    torch.save(), happens on the scheduler's own thread.
+    '''
+
+    def __init__(self, model: 'MinecraftAI', path: Path, interval: float=300, keep: int=3):
+        if interval <= 0:
+            raise ValueError('The checkpoint interval must be positive')
+        if keep < 1:
+            raise ValueError('At least one checkpoint must be kept')
+        self.model = model
+        self.path = Path(path)
+        self.interval = interval
+        self.keep = keep
+        self.count = 0
+        self.last_duration = 0.0
+        self.last_error = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def checkpoints(self) -> list[Path]:
+        '''Complete checkpoints in path, oldest first.'''
+        if not os.path.exists(self.path):
+            return []
+        names = [n for n in os.listdir(self.path) if n.startswith(CHECKPOINT_PREFIX)]
+        return [self.path / n for n in sorted(names)]
+
+
+    def start(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Remove checkpoints that were interrupted before being renamed.
+        for n in os.listdir(self.path):
+            if n.startswith(TEMP_PREFIX):
+                shutil.rmtree(self.path / n, ignore_errors=True)
+        existing = self.checkpoints()
+        if existing:
+            self.count = int(existing[-1].name[len(CHECKPOINT_PREFIX):])
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='checkpoints', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stops scheduling checkpoints, waiting for one in progress to be written.'''
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def checkpoint(self) -> Path or None:
+        '''
+        Saves a checkpoint now and removes the oldest ones beyond keep.
+        Returns the checkpoint's path, or None if a Process didn't provide its models.
+        '''
+        start = time.perf_counter()
+        models_data = {}
+        for proc in self.model.processes.values():
+            models_data[proc.process_id] = proc.snapshot_models()
+            if models_data[proc.process_id] is None:
+                self.last_error = f'Process "{proc.name}" did not provide its models'
+                return None
+
+        number = self.count + 1
+        temp_path = self.path / f'{TEMP_PREFIX}{number:06d}'
+        final_path = self.path / f'{CHECKPOINT_PREFIX}{number:06d}'
+        self.model.save(temp_path, verbose=False, models_data=models_data)
+        os.replace(temp_path, final_path)
+        self.count = number
+
+        for old in self.checkpoints()[:-self.keep]:
+            shutil.rmtree(old, ignore_errors=True)
+        self.last_duration = time.perf_counter() - start
+        self.last_error = None
+        return final_path
+
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception as e:
+                # Keep trying; a failed checkpoint shouldn't stop the session.
+                self.last_error = repr(e)
@@ -6,11 +6,18 @@ DEFAULT_MODEL_NAME = 'MinecraftAI'
 
 MINECRAFT_TITLE_TEXT_KEYWORD = 'Minecraft'
 
+# Where frames come from and camera movements go, by default. See platforms.PLATFORMS.
+PLATFORM = 'win32'
+
 CONTROLS_WINDOW_X = 25
 CONTROLS_WINDOW_Y = 25
 CONTROLS_WINDOW_WIDTH = 800
 CONTROLS_WINDOW_HEIGHT = 800
 
+# How SimpleLogic can learn, see SimpleLogic. Here so the CLI can offer them without
+# importing torch.
+LEARNING_MODES = ('inline', 'async')
+
 
 
 
@@ -5,15 +5,28 @@ import os
 from pathlib import Path
 import queue
 import threading
+import time
 
 import numpy as np
 
+from metrics import Histogram
+import tracing
+from transport import LatestValueSlot, SharedLatestValueSlot, SharedMemoryRing
+
+
+# Values a discrete Connection holds, unless given a capacity.
+DEFAULT_CAPACITY = 4
+
+# What sending to a full discrete Connection does. See Connection.
+OVERFLOW_POLICIES = ('block', 'drop_newest', 'drop_oldest', 'sample')
+
 
 class ConnectionPolicy():
 
     # Returns the next available value, blocking if necessary.
     DISCRETE = 0
     # Returns the most recent value, even if it hasn't changed, never blocking.
+    # Only blocks before the first value, or if the Connection is set to wait_for_new.
     CONTINUOUS = 1
 
     def eval_from_name(name: str) -> int:
@@ -41,36 +54,306 @@ class Connection():
     Rather, it acts as more of a server node where Processes deliver and request data.
     The Process objects track which Connection nodes to use as inputs and outputs.
     Use send() to deliver data (for outputs) and request() to request data (for inputs).
+
+    The transport decides how data travels between Processes:
+      - 'queue': objects are handed over by reference through a queue (the default).
+      - 'shared_memory': NumPy arrays of a fixed shape are written into slots of a
+        SharedMemoryRing and received as zero-copy views. transport_args must specify
+        'shape', and may specify 'dtype' and 'num_slots'. See transport.py.
+
+    Discrete Connections hold up to capacity values (for shared_memory, its number of
+    slots). overflow decides what sending does when they're full:
+      - 'block': wait for room (the default).
+      - 'drop_newest': discard the value being sent.
+      - 'drop_oldest': discard the oldest value not yet received, to make room.
+      - 'sample': only deliver every sample_every-th value sent, discarding the others,
+        and wait for room for those.
+    Discarded values are counted as dropped. See get_stats().
+
+    Continuous Connections hold a single LatestValueSlot instead of a queue: sending
+    overwrites the previous value and never blocks. If wait_for_new is set, requesting
+    waits for a value that is newer than the last one received.
+
+    Every value carries its origin: the time.perf_counter() time at which the data it was
+    derived from entered the graph. After request(), it's available as last_origin.
+    The time each value spends in the Connection, from send() to request(), is recorded
+    in a histogram. See get_stats().
     '''
 
 
     def __init__(self,
         connection_id: int,
         policy: str,
-        name: str='connection'
+        name: str='connection',
+        transport: str='queue',
+        transport_args: dict={},
+        wait_for_new: bool=False,
+        fuse: bool=True,
+        capacity: int=None,
+        overflow: str='block',
+        sample_every: int=2
     ):
         self.connection_id = connection_id
         self.policy = ConnectionPolicy.eval_from_name(policy)
         self.name = name
+        if transport not in ('queue', 'shared_memory'):
+            raise ValueError(f'"{transport}" is not a valid connection transport')
+        if transport == 'shared_memory' and 'shape' not in transport_args:
+            raise ValueError('The shared_memory transport requires a "shape" transport arg')
+        if transport == 'shared_memory' and self.policy == ConnectionPolicy.CONTINUOUS:
+            raise ValueError('Continuous connections do not support the shared_memory transport')
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'"{overflow}" is not a valid overflow policy ' + \
+                f'(expected one of {", ".join(OVERFLOW_POLICIES)})')
+        if self.policy == ConnectionPolicy.CONTINUOUS and overflow != 'block':
+            raise ValueError('Continuous connections always keep only the newest value')
+        if capacity is not None and capacity < 1:
+            raise ValueError('A connection\'s capacity must be at least 1')
+        if sample_every < 1:
+            raise ValueError('sample_every must be at least 1')
+        self.transport = transport
+        self.transport_args = dict(transport_args)
+        if self.policy == ConnectionPolicy.CONTINUOUS:
+            if capacity not in (None, 1):
+                raise ValueError('Continuous connections hold a single value')
+            self._capacity = 1
+        elif transport == 'shared_memory':
+            # The capacity is the number of slots.
+            if capacity is not None:
+                if self.transport_args.get('num_slots', capacity) != capacity:
+                    raise ValueError('capacity and the num_slots transport arg differ')
+                self.transport_args['num_slots'] = capacity
+            self._capacity = self.transport_args.get('num_slots', DEFAULT_CAPACITY)
+        else:
+            self._capacity = DEFAULT_CAPACITY if capacity is None else capacity
+        self.overflow = overflow
+        self.sample_every = sample_every
+        self.wait_for_new = wait_for_new
+        # Whether the Processes it connects may be fused. See MinecraftAI.fuse_chains().
+        self.fuse = fuse
+        self._last_origin = 0.0
+        self._latency = Histogram()
+        # Values discarded by the overflow policy, and values sent, for sampling.
+        self._dropped = 0
+        self._sent = 0
 
 
-    def _build(self):
-        #self.manager = multiprocessing.Manager()
-        self.queue = queue.Queue(maxsize=4)
+    def _build(self, context: 'multiprocessing.context.BaseContext'=None):
+        '''
+        Create the underlying queues.
+        If a multiprocessing context is given, they're created with it so that the
+        Connection can be passed to Processes running in other OS processes.
+        '''
+        make_queue = queue.Queue if context is None else context.Queue
+        self.slot = None
+        if self.policy == ConnectionPolicy.CONTINUOUS:
+            self.ring = None
+            self.queue = None
+            self.slot = LatestValueSlot() if context is None else SharedLatestValueSlot(context)
+        elif self.transport == 'shared_memory':
+            self.ring = SharedMemoryRing(**self.transport_args)
+            self.ring._build(make_queue)
+            # The filled-slot queue stands in for the data queue (e.g. for size reporting).
+            self.queue = self.ring.filled
+        else:
+            self.ring = None
+            self.queue = make_queue(self._capacity)
+
+
+    def _detach(self):
+        '''
+        Called in a child OS process before it exits.
+        Pending data that was never received is discarded instead of blocking the exit.
+        '''
+        for q in (self.queue, getattr(self.ring, 'free', None)):
+            if hasattr(q, 'cancel_join_thread'):
+                q.cancel_join_thread()
+        if hasattr(self.slot, '_detach'):
+            self.slot._detach()
 
 
-    def send(self, data: np.array):
-        # TODO: IMPLEMENT CONTINUOUS
-        self.queue.put(data)
+    def size(self) -> int:
+        if self.slot is not None:
+            return int(self.slot.has_unread())
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            # multiprocessing queues can't report their size on some platforms.
+            return -1
+
+
+    def capacity(self) -> int:
+        return self._capacity
+
+
+    def get_stats(self) -> dict:
+        '''
+        The send-to-request latency histogram. For discrete Connections, the values
+        dropped by the overflow policy. For continuous Connections: values written, values
+        overwritten before they were read, and requests that returned an already received
+        value.
+        '''
+        stats = {'latency': self._latency.to_dict()}
+        if self.slot is None:
+            stats['dropped'] = self._dropped
+        else:
+            stats.update({
+                'written': self.slot.written,
+                'overwritten': self.slot.overwritten,
+                'repeated': self.slot.repeated,
+            })
+        return stats
 
 
-    def request(self) -> np.array or None:
-        # TODO: IMPLEMENT CONTINUOUS
-        r = self.queue.get()
+    def _acquire_slot(self, block: bool=True, timeout: float=None) -> int or None:
+        '''
+        Reserves a free slot of the ring according to the overflow policy.
+        Returns None if the value is to be dropped instead.
+        '''
+        if self.overflow in ('block', 'sample'):
+            try:
+                return self.ring.acquire(block, timeout)[0]
+            except queue.Empty:
+                raise queue.Full()
+        while True:
+            try:
+                return self.ring.acquire(block=False)[0]
+            except queue.Empty:
+                pass
+            if self.overflow == 'drop_newest':
+                return None
+            slot = self.ring.reclaim()
+            if slot is not None:
+                self._dropped += 1
+                return slot
+            # Nothing to take back, e.g. while the consumer still holds its last slot.
+            try:
+                return self.ring.acquire(timeout=0.001)[0]
+            except queue.Empty:
+                pass
+
+
+    def _sampled_out(self) -> bool:
+        '''Whether the value being sent is skipped by the 'sample' overflow policy.'''
+        if self.overflow != 'sample':
+            return False
+        self._sent += 1
+        return (self._sent - 1) % self.sample_every != 0
+
+
+    def send(self,
+        data: np.array,
+        block: bool=True,
+        timeout: float=None,
+        origin: float=None
+    ):
+        '''
+        Deliver data to the connection.
+        origin defaults to now, i.e. data entering the graph here.
+        Raises queue.Full if block is False or timeout expires and there's no room, and
+        the overflow policy waits for room. Continuous Connections never block.
+        While tracing, each send is recorded as a span named after the Connection.
+        '''
+        sent = time.perf_counter()
+        if origin is None:
+            origin = sent
+        self._send(data, block, timeout, origin, sent)
+        if tracing.active:
+            tracing.record(self.name, 'send', sent, time.perf_counter())
+
+
+    def _send(self, data: np.array, block: bool, timeout: float, origin: float, sent: float):
+        if self.slot is not None:
+            self.slot.put((origin, sent, data))
+        elif self.ring is not None:
+            slot = None if self._sampled_out() else self._acquire_slot(block, timeout)
+            if slot is None:
+                self._dropped += 1
+                return
+            np.copyto(self.ring._views[slot], data, casting='unsafe')
+            self.ring.commit(slot, block, timeout, (origin, sent))
+        else:
+            self._put((origin, sent, data), block, timeout)
+
+
+    def _put(self, item: tuple, block: bool, timeout: float):
+        '''Puts item in the queue according to the overflow policy.'''
+        if self.overflow == 'block':
+            self.queue.put(item, block, timeout)
+        elif self.overflow == 'sample':
+            if self._sampled_out():
+                self._dropped += 1
+                return
+            self.queue.put(item, block, timeout)
+        elif self.overflow == 'drop_newest':
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self._dropped += 1
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+                try:
+                    oldest = self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                if oldest is None:
+                    # A stop was posted; keep it for the receiver, which won't need the
+                    # value being sent.
+                    try:
+                        self.queue.put_nowait(None)
+                    except queue.Full:
+                        pass
+                    self._dropped += 1
+                    return
+                self._dropped += 1
+
+
+    def request(self, block: bool=True, timeout: float=None) -> np.array or None:
+        '''
+        Request the next data from the connection. Returns None if a stop was posted.
+        Raises queue.Empty if block is False or timeout expires and nothing is available.
+        While tracing, each request that returns data is recorded as a span named after
+        the Connection, so time spent waiting for data shows up.
+        '''
+        t0 = time.perf_counter() if tracing.active else None
+        if self.ring is not None:
+            r = self.ring.read(block, timeout)
+            if r is None:
+                return None
+            self._last_origin, sent = self.ring.last_stamp
+        else:
+            if self.slot is not None:
+                item = self.slot.get(block, timeout, self.wait_for_new)
+            else:
+                item = self.queue.get(block, timeout)
+            if item is None:
+                return None
+            self._last_origin, sent, r = item
+        received = time.perf_counter()
+        self._latency.record(received - sent)
+        if t0 is not None:
+            tracing.record(self.name, 'request', t0, received)
         return r
 
 
+    @property
+    def last_origin(self) -> float:
+        '''The origin time of the data last returned by request().'''
+        return self._last_origin
+
+
     def drain(self) -> np.array or None:
+        if self.slot is not None:
+            self.slot.drain()
+            return
+        if self.ring is not None:
+            self.ring.drain()
+            return
         try:
             while True:
                 self.queue.get_nowait()
@@ -79,6 +362,12 @@ class Connection():
 
 
     def post_stop(self):
+        if self.slot is not None:
+            self.slot.post_stop()
+            return
+        if self.ring is not None:
+            self.ring.post_stop()
+            return
         try:
             self.queue.put(None, timeout=0.01)
         except queue.Full:
@@ -88,10 +377,10 @@ class Connection():
     def serialize(self, path: Path):
         if not os.path.exists(path):
             os.mkdir(path)
-        attributes = self.__dict__.copy()
-        if hasattr(self, 'queue'):
-            del attributes['queue']
+        attributes = {k: v for k, v in self.__dict__.items() \
+            if not k.startswith('_') and k not in ('queue', 'ring', 'slot')}
         attributes['policy'] = ConnectionPolicy.name_from_value(attributes['policy'])
+        attributes['capacity'] = self._capacity
         with open(path / 'attributes.json', 'w') as file:
             json.dump(attributes, file)
 
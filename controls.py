@@ -1,25 +1,156 @@
+import threading
+import time
 
+from metrics import Histogram
 from minecraft import Minecraft
 from process import Process
 
 
 class Controls(Process):
+    '''
+    Moves the camera of agent's game (see Minecraft) as the logic directs it.
+    Each input is a camera velocity (x, y), as a fraction of cam_speed pixels per second.
 
-    def __init__(self):
+    The camera isn't moved once per input, but by an actuator thread rate times per second,
+    so it moves smoothly even when the logic runs much slower. With interpolate, the
+    velocity ramps from where it was to each new input over the typical time between
+    inputs, rather than jumping. Movements are sent in whole pixels, and the remainder is
+    carried over to the next one, so small corrections add up instead of being lost.
+    Ticks that wouldn't move the camera by a whole pixel send nothing, and ticks the thread
+    fell behind on are coalesced into one movement rather than sent in a burst. If no input
+    arrives for hold seconds, the camera stops.
+    '''
+
+    def __init__(self,
+        agent: int=0,
+        rate: float=240.0,
+        cam_speed: float=2000.0,
+        interpolate: bool=True,
+        hold: float=0.25
+    ):
+        # Which agent's game to control. See Minecraft.
+        self.agent = agent
+        self.rate = rate
+        self.cam_speed = cam_speed
+        self.interpolate = interpolate
+        self.hold = hold
+        # Time from the frame entering the graph to its movement reaching the actuator.
+        self.latency = Histogram()
+        self._reset()
+        # Created in start(), since they can't be pickled for the 'process' backend.
+        self._lock = None
+        self._thread = None
         super().__init__(num_inputs=1, num_outputs=0)
-    
-    def run(self, inputs: list):
-        CAM_SPEED = 2000
 
-        cam_x, cam_y = inputs[0][0], inputs[0][1]
-        speed = CAM_SPEED * self.time_step()
+    def _reset(self):
+        # The velocity being ramped from, the latest input's, and when it arrived.
+        self._from = (0.0, 0.0)
+        self._target = (0.0, 0.0)
+        self._target_time = None
+        # Moving average of the time between inputs, which ramps last.
+        self._interval = 0.0
+        # Whether the actuator has used the latest input yet.
+        self._unread = False
+        self._actuating = False
+        self.commands = 0
+        self.dropped = 0
+        self.ticks = 0
+        self.coalesced = 0
+        self.movements = 0
+        self._actuation_start = None
 
-        #Minecraft.move_camera(0, 0)
-        #print(f'\r{cam_x} {cam_y}     ', end='')
-        Minecraft.move_camera(speed * cam_x, speed * cam_y)
+    def start(self):
+        self._reset()
+        self._lock = threading.Lock()
+        self._actuating = True
+        self._actuation_start = time.perf_counter()
+        self._thread = threading.Thread(target=self._actuate,
+            name=f'controls_{self.agent}', daemon=True)
+        self._thread.start()
+
+    def run(self, inputs: list):
+        now = time.perf_counter()
+        with self._lock:
+            # The ramp continues from wherever the velocity is now.
+            self._from = self._velocity(now)
+            if self._target_time is not None:
+                self._interval += 0.2 * (now - self._target_time - self._interval)
+            self._target = (float(inputs[0][0]), float(inputs[0][1]))
+            self._target_time = now
+            if self._unread:
+                # Superseded before the actuator got to it.
+                self.dropped += 1
+            self._unread = True
+            self.commands += 1
+        self.latency.record(now - self.input_origin())
 
+        elapsed = now - self._actuation_start
+        self.set_property('latency p50 ms', self.latency.percentile(50) * 1e3)
+        if elapsed > 0:
+            self.set_property('actuation Hz', round(self.movements / elapsed))
+            self.set_property('tick Hz', round(self.ticks / elapsed))
+        self.set_property('dropped', self.dropped)
+        self.set_property('coalesced', self.coalesced)
         return []
 
+    def stop(self):
+        self._actuating = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _velocity(self, now: float) -> tuple:
+        '''The camera velocity at time now, in fractions of cam_speed.'''
+        if self._target_time is None or now - self._target_time > self.hold:
+            return (0.0, 0.0)
+        if not self.interpolate or self._interval <= 0:
+            return self._target
+        f = min((now - self._target_time) / self._interval, 1.0)
+        return tuple(a + (b - a) * f for a, b in zip(self._from, self._target))
+
+    def _actuate(self):
+        period = 1 / self.rate
+        last = next_tick = time.perf_counter()
+        remainder_x = remainder_y = 0.0
+        while self._actuating:
+            now = time.perf_counter()
+            if now < next_tick:
+                # time.sleep() is high resolution, unlike waiting on an Event on Windows.
+                time.sleep(next_tick - now)
+                continue
+            # If ticks were missed, move once for all of them instead of catching up.
+            missed = int((now - next_tick) / period)
+            self.coalesced += missed
+            next_tick += (missed + 1) * period
+            with self._lock:
+                velocity = self._velocity(now)
+                self._unread = False
+            self.ticks += 1
+
+            step = self.cam_speed * (now - last)
+            last = now
+            remainder_x += velocity[0] * step
+            remainder_y += velocity[1] * step
+            move_x, move_y = round(remainder_x), round(remainder_y)
+            if move_x == 0 and move_y == 0:
+                continue
+            remainder_x -= move_x
+            remainder_y -= move_y
+            Minecraft.move_camera(move_x, move_y, self.agent)
+            self.movements += 1
 
-        
+    def serialize(self, path) -> dict:
+        return {
+            'agent': self.agent,
+            'rate': self.rate,
+            'cam_speed': self.cam_speed,
+            'interpolate': self.interpolate,
+            'hold': self.hold,
+        }
 
+    def deserialize(self, config: dict, path):
+        self.agent = config.get('agent', self.agent)
+        self.rate = config.get('rate', self.rate)
+        self.cam_speed = config.get('cam_speed', self.cam_speed)
+        self.interpolate = config.get('interpolate', self.interpolate)
+        self.hold = config.get('hold', self.hold)
@@ -0,0 +1,172 @@
+import numpy as np
+
+
+
+# The target's color as OpenCV 8-bit HSV ranges (H in [0, 180)). A pixel is part of the
+# target if it falls in any of them.
+TARGET_HSV_RANGES = (
+    ((245, 50, 0), (255, 255, 255)),
+    ((0, 50, 0), (15, 255, 255)),
+)
+
+# Lookup tables by HSV ranges, shared by all labelers. Each is 16 MiB.
+_tables = {}
+
+
+def color_table(hsv_ranges: tuple=TARGET_HSV_RANGES) -> np.ndarray:
+    '''
+    A flat lookup table of whether each 24-bit RGB color is in hsv_ranges,
+    indexed by r | g << 8 | b << 16. Built with OpenCV on first use, so it matches
+    cv2.cvtColor and cv2.inRange exactly.
+    '''
+    key = tuple(tuple(map(tuple, r)) for r in hsv_ranges)
+    table = _tables.get(key)
+    if table is None:
+        import cv2
+        table = np.zeros(1 << 24, dtype=bool)
+        # Every color, 16 blue values at a time, with red varying fastest.
+        levels = np.arange(256, dtype=np.uint8)
+        rgb = np.empty((16, 256, 256, 3), dtype=np.uint8)
+        rgb[..., 0] = levels[None, None, :]
+        rgb[..., 1] = levels[None, :, None]
+        for b in range(0, 256, 16):
+            rgb[..., 2] = levels[b:b + 16, None, None]
+            hsv = cv2.cvtColor(rgb.reshape(-1, 256, 3), cv2.COLOR_RGB2HSV)
+            mask = np.zeros(hsv.shape[:2], dtype=np.uint8)
+            for low, high in hsv_ranges:
+                mask |= cv2.inRange(hsv, np.array(low), np.array(high))
+            table[b << 16:(b + 16) << 16] = mask.ravel() != 0
+        _tables[key] = table
+    return table
+
+
+
+class ColorLabeler():
+    '''
+    Labels where the target is in RGB frames, by looking up each pixel's color in a
+    precomputed table (see color_table()) instead of converting the frame to HSV.
+    One vectorized pass over a frame, or a batch of frames, gives the target's:
+    - coverage: the fraction of the frame it covers
+    - centroid: its center (x, y) in pixels
+    - offset: its center's offset from the center of the frame, in [-1, 1]
+    - bbox: its bounding box (left, top, width, height) in pixels
+
+    Frames with a coverage below min_coverage have no target. The default is the
+    threshold SimpleLogic has always used, which any target pixel at all exceeds
+    for frames under 8500 pixels.
+    '''
+
+    def __init__(self, hsv_ranges: tuple=TARGET_HSV_RANGES, min_coverage: float=0.03 / 255):
+        self.table = color_table(hsv_ranges)
+        self.min_coverage = min_coverage
+        # Index and mask buffers, reused while the batch shape doesn't change.
+        self._shape = None
+        self._index = None
+        self._channel = None
+        self._mask = None
+
+
+    def mask(self, frames: np.ndarray) -> np.ndarray:
+        '''
+        Whether each pixel of frames, (..., height, width, >= 3) uint8 RGB, is part of the
+        target. Returns a view of a buffer that is reused by the next call.
+        '''
+        shape = frames.shape[:-1]
+        if shape != self._shape:
+            self._shape = shape
+            self._index = np.empty(shape, dtype=np.uint32)
+            self._channel = np.empty(shape, dtype=np.uint32)
+            self._mask = np.empty(shape, dtype=bool)
+        index = self._index
+        channels = frames.shape[-1]
+        if frames.flags.c_contiguous and index.size > 1:
+            # Each pixel's bytes, read in place as a little-endian integer from its first
+            # byte on, are the index plus whatever follows it. The last pixel is read on
+            # its own, so as not to read past the end of the frames.
+            pixels = np.ndarray((index.size - 1,), dtype='<u4', buffer=frames,
+                strides=(channels,))
+            flat = index.reshape(-1)
+            np.bitwise_and(pixels, 0xFFFFFF, out=flat[:-1])
+            r, g, b = (int(v) for v in frames.reshape(-1, channels)[-1, :3])
+            flat[-1] = r | g << 8 | b << 16
+        else:
+            channel = self._channel
+            np.left_shift(frames[..., 2], 16, out=index, dtype=np.uint32)
+            np.left_shift(frames[..., 1], 8, out=channel, dtype=np.uint32)
+            np.bitwise_or(index, channel, out=index)
+            np.bitwise_or(index, frames[..., 0], out=index)
+        return np.take(self.table, index, out=self._mask)
+
+    def label_batch(self, frames: np.ndarray) -> dict:
+        '''
+        Labels a batch of frames, (batch, height, width, >= 3) uint8 RGB.
+        Returns a dict of arrays, one row per frame: 'found' (bool), 'coverage',
+        'centroid', 'offset' and 'bbox'. Frames without a target have a centroid of
+        (0, 0) and an empty bounding box.
+        '''
+        frames = np.asarray(frames).astype(np.uint8, copy=False)
+        n, h, w = frames.shape[:3]
+        mask = self.mask(frames).view(np.uint8)
+        # Pixels per column and per row, from which everything else follows.
+        columns = mask.sum(axis=1, dtype=np.int32)
+        rows = mask.sum(axis=2, dtype=np.int32)
+        count = columns.sum(axis=1)
+        coverage = count / (h * w)
+        found = coverage >= self.min_coverage
+
+        # Moments over the pixel centers, as cv2.moments() computes them.
+        centroid = np.stack([columns @ np.arange(w), rows @ np.arange(h)], axis=1) / \
+            np.maximum(count, 1)[:, None]
+        offset = (centroid - [w / 2, h / 2]) / [w / 2, h / 2]
+
+        hit = count > 0
+        left, top = np.argmax(columns > 0, axis=1), np.argmax(rows > 0, axis=1)
+        right, bottom = w - np.argmax(columns[:, ::-1] > 0, axis=1), h - np.argmax(rows[:, ::-1] > 0, axis=1)
+        bbox = np.stack([left, top, right - left, bottom - top], axis=1) * hit[:, None]
+
+        return {
+            'found': found,
+            'coverage': coverage,
+            'centroid': centroid,
+            'offset': offset,
+            'bbox': bbox,
+        }
+
+    def label(self, rgb: np.ndarray) -> dict or None:
+        '''
+        Labels one frame, (height, width, >= 3) uint8 RGB, as a dict of 'coverage',
+        'centroid', 'offset' and 'bbox'. None if it has no target.
+        '''
+        # The same as label_batch(), without the batch bookkeeping, since it runs per frame.
+        rgb = np.asarray(rgb).astype(np.uint8, copy=False)
+        h, w = rgb.shape[:2]
+        mask = self.mask(rgb).view(np.uint8)
+        columns = mask.sum(axis=0, dtype=np.int32)
+        count = int(columns.sum())
+        coverage = count / (h * w)
+        if count == 0 or coverage < self.min_coverage:
+            return None
+        rows = mask.sum(axis=1, dtype=np.int32)
+        x = float(columns @ np.arange(w)) / count
+        y = float(rows @ np.arange(h)) / count
+        xs, ys = np.flatnonzero(columns), np.flatnonzero(rows)
+        return {
+            'coverage': coverage,
+            'centroid': (x, y),
+            'offset': ((x - w / 2) / (w / 2), (y - h / 2) / (h / 2)),
+            'bbox': (int(xs[0]), int(ys[0]), int(xs[-1] - xs[0] + 1), int(ys[-1] - ys[0] + 1)),
+        }
+
+    def label_recording(self, reader, start: int=0, stop: int=None, batch_size: int=64) -> dict:
+        '''
+        Labels frames [start, stop) of a recording (see recording.FrameReader), batch_size
+        frames at a time. Returns the same dict of arrays as label_batch().
+        '''
+        if len(reader.shape) != 3 or reader.shape[2] < 3:
+            raise ValueError(f'Recording frames {reader.shape} are not RGB')
+        stop = len(reader) if stop is None else min(stop, len(reader))
+        batches = [self.label_batch(reader.frames[i:min(i + batch_size, stop)])
+            for i in range(start, stop, batch_size)]
+        if not batches:
+            return self.label_batch(np.zeros((0, *reader.shape), dtype=np.uint8))
+        return {key: np.concatenate([b[key] for b in batches]) for key in batches[0]}
@@ -0,0 +1,141 @@
+import copy
+import queue
+import threading
+import time
+
+from model import Model
+
+
+
+def copy_model(model: Model) -> Model:
+    '''A copy of model without its optimizer, which references the original parameters.'''
+    # The private attributes, so a deferred optimizer isn't built just to be left out.
+    optimizer, pending = model._optimizer, model._pending_optimizer
+    model._optimizer = model._pending_optimizer = None
+    try:
+        return copy.deepcopy(model)
+    finally:
+        model._optimizer, model._pending_optimizer = optimizer, pending
+
+
+
+class AsyncLearner():
+    '''
+    Trains a Model on a background thread, so the Process using it doesn't wait for
+    backpropagation. The Process submits samples and runs inference on a read-only snapshot
+    of the weights, which the learner republishes every publish_interval seconds.
+
+    train_step(samples) is called on the learner thread with a list of up to max_batch
+    submitted samples, all those pending, and must do the whole optimizer step on model.
+    Training on them together costs the Process's thread (and core) much less than a step
+    per sample, e.g. when several agents submit a sample per run. It may return the loss.
+    If training falls behind, new samples are dropped rather than queued up.
+
+    The learner trains at most max_share of the time, and waits the rest. Where it shares
+    a core with the Process, e.g. on a single core machine, this keeps training from
+    taking the time inference needs.
+    '''
+
+    def __init__(self,
+        model: Model,
+        train_step,
+        publish_interval: float=0.1,
+        max_pending: int=4,
+        max_batch: int=1,
+        max_share: float=1.0
+    ):
+        if not 0 < max_share <= 1:
+            raise ValueError(f'The learner\'s share of time must be in (0, 1], not {max_share}')
+        self.model = model
+        self.train_step = train_step
+        self.publish_interval = publish_interval
+        self.max_batch = max_batch
+        self.max_share = max_share
+        self.snapshot = copy_model(model)
+        self.snapshot.eval()
+        self.snapshot.requires_grad_(False)
+        self.steps = 0
+        self.dropped = 0
+        self.loss = None
+        self.error = None
+        self._samples = queue.Queue(max_pending)
+        # (version, state dict), replaced as a whole so readers never see a partial update.
+        self._published = (0, None)
+        self._loaded_version = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='learner', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Finish the step in progress and stop. Pending samples are discarded.'''
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.error is not None:
+            raise self.error
+
+
+    def submit(self, *sample) -> bool:
+        '''Queue a sample for training. Returns False if it was dropped.'''
+        if self.error is not None:
+            raise self.error
+        try:
+            self._samples.put_nowait(sample)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def poll(self) -> Model:
+        '''
+        Loads the most recently published weights into the snapshot, if they changed.
+        Call from the inference thread; returns the snapshot to run inference on.
+        '''
+        version, state = self._published
+        if version != self._loaded_version:
+            self.snapshot.load_state_dict(state)
+            self._loaded_version = version
+        return self.snapshot
+
+    def pending(self) -> int:
+        return self._samples.qsize()
+
+    def staleness(self) -> int:
+        '''Training steps taken since the weights used for inference were published.'''
+        return self.steps - self._loaded_version
+
+
+    def _publish(self):
+        state = {k: v.detach().clone() for k, v in self.model.state_dict().items()}
+        self._published = (self.steps, state)
+
+    def _run(self):
+        try:
+            last_publish = time.perf_counter()
+            while not self._stop_event.is_set():
+                try:
+                    samples = [self._samples.get(timeout=0.05)]
+                except queue.Empty:
+                    continue
+                while len(samples) < self.max_batch:
+                    try:
+                        samples.append(self._samples.get_nowait())
+                    except queue.Empty:
+                        break
+                start = time.perf_counter()
+                self.loss = self.train_step(samples)
+                self.steps += 1
+                now = time.perf_counter()
+                if now - last_publish >= self.publish_interval:
+                    self._publish()
+                    last_publish = now
+                if self.max_share < 1:
+                    self._stop_event.wait((now - start) * (1 / self.max_share - 1))
+        except Exception as e:
+            self.error = e
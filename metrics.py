@@ -0,0 +1,88 @@
+# Histogram bucket i counts durations in [2^(i-1), 2^i) microseconds; bucket 0 is < 1us.
+# The last bucket also holds everything longer, from about 8 seconds up.
+NUM_BUCKETS = 24
+
+# Smoothing factor of the moving averages kept by StageStats.
+STAGE_STATS_ALPHA = 0.05
+
+
+
+class Histogram():
+    '''
+    A fixed-bucket histogram of durations, cheap enough to update on every hand-off.
+    Buckets are powers of two in microseconds, so percentiles are accurate to within 2x.
+    '''
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.total = 0
+        self.sum = 0.0
+
+    def record(self, seconds: float):
+        i = int(seconds * 1e6).bit_length()
+        self.counts[i if i < NUM_BUCKETS else NUM_BUCKETS - 1] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, q: float) -> float:
+        '''
+        Returns the upper bound, in seconds, of the bucket containing the q-th percentile.
+        '''
+        if self.total == 0:
+            return 0.0
+        rank = q / 100 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return (1 << i) / 1e6
+        return (1 << (NUM_BUCKETS - 1)) / 1e6
+
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0.0
+
+    def to_dict(self) -> dict:
+        '''Summary in milliseconds, plus the raw bucket counts.'''
+        return {
+            'count': self.total,
+            'mean_ms': self.mean() * 1e3,
+            'p50_ms': self.percentile(50) * 1e3,
+            'p90_ms': self.percentile(90) * 1e3,
+            'p99_ms': self.percentile(99) * 1e3,
+            'buckets_us': {f'<{1 << i}': c for i, c in enumerate(self.counts) if c},
+        }
+
+
+
+class StageStats():
+    '''
+    Splits each iteration of a Process's run loop into the time spent waiting for inputs,
+    computing (run()), and blocked delivering outputs. Kept as moving averages.
+    '''
+
+    def __init__(self):
+        self.iterations = 0
+        self.wait = 0.0
+        self.compute = 0.0
+        self.blocked = 0.0
+
+    def record(self, wait: float, compute: float, blocked: float):
+        if self.iterations == 0:
+            self.wait, self.compute, self.blocked = wait, compute, blocked
+        else:
+            a = STAGE_STATS_ALPHA
+            self.wait += a * (wait - self.wait)
+            self.compute += a * (compute - self.compute)
+            self.blocked += a * (blocked - self.blocked)
+        self.iterations += 1
+
+    def to_properties(self) -> dict:
+        if self.iterations == 0:
+            return {}
+        total = self.wait + self.compute + self.blocked
+        return {
+            'wait ms': round(self.wait * 1e3, 2),
+            'compute ms': round(self.compute * 1e3, 2),
+            'blocked ms': round(self.blocked * 1e3, 2),
+            'busy %': round(100 * self.compute / total) if total > 0 else 0,
+        }
@@ -1,37 +1,48 @@
-
 import config
-import windows
+import platforms
 
 
 class Minecraft():
     '''
     Handles information about the Minecraft instance, such as window handle, etc.
     Also handles sending operations to the game, such as movement controls.
-    If there are any platform-dependent operations, this is where code delegation occurs.
+    If there are any platform-dependent operations, this is where code delegation occurs:
+    everything is passed on to the platform chosen with use_platform() (see platforms.py),
+    or config.PLATFORM by default. Platforms are per OS process, so Processes using them
+    on the 'process' backend get the default platform.
     '''
 
-    window_handle = None
+    platform = None
+
+    def use_platform(name: str, **args) -> platforms.Platform:
+        '''Use the platform registered as name from now on, created with args.'''
+        Minecraft.platform = platforms.create_platform(name, **args)
+        return Minecraft.platform
+
+    def use_simulation(**simulation_args) -> platforms.Platform:
+        '''Shorthand for use_platform('simulated', **simulation_args).'''
+        return Minecraft.use_platform('simulated', **simulation_args)
+
+    def get_platform() -> platforms.Platform:
+        if Minecraft.platform is None:
+            Minecraft.use_platform(config.PLATFORM)
+        return Minecraft.platform
 
     def get_window_handle():
-        if Minecraft.window_handle is not None:
-            return Minecraft.window_handle
-        windows.windows_init()
-        Minecraft.window_handle = windows.find_window(config.MINECRAFT_TITLE_TEXT_KEYWORD)
-        if Minecraft.window_handle is None:
-            raise Exception(f'Could not find a window with ' + \
-                f'"{config.MINECRAFT_TITLE_TEXT_KEYWORD}" in title text')
-        else:
-            return Minecraft.window_handle
+        return Minecraft.get_platform().get_window_handle()
 
     def focus_window():
-        windows.windows_init()
-        windows.focus_window(Minecraft.get_window_handle())
+        Minecraft.get_platform().focus_window()
 
-    def resize_window():
-        windows.windows_init()
-        rect = windows.resize_window(Minecraft.get_window_handle())
-        return dict(zip(['left', 'top', 'width', 'height'], rect))
+    def resize_window(agent: int=0) -> dict:
+        return Minecraft.get_platform().view_rect(agent)
 
-    def move_camera(x: float, y: float):
-        windows.send_mousemove(x, y)
+    def grab_frame(agent: int=0):
+        '''
+        A BGRA frame of agent's view. Platforms with screen_capture set are grabbed from
+        the screen instead (see vision.ScreenGrab).
+        '''
+        return Minecraft.get_platform().grab_frame(agent)
 
+    def move_camera(x: float, y: float, agent: int=0):
+        Minecraft.get_platform().move_camera(x, y, agent)
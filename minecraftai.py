@@ -1,15 +1,22 @@
 
+from concurrent.futures import ThreadPoolExecutor
 import json
+import multiprocessing
 import os
 from pathlib import Path
+import time
 from tabnanny import process_tokens
 
+import backends
 import config
-from connection import Connection
-from process import Process, ProcessContainer
+from connection import Connection, ConnectionPolicy
+from process import Process, ProcessContainer, ProcessException
 import utils
 
 
+# Maximum number of Processes loaded concurrently by MinecraftAI.load().
+LOAD_WORKERS = 8
+
 
 class MinecraftAI():
     
@@ -25,6 +32,13 @@ class MinecraftAI():
         self.total_training_time = 0
         
         self._built = False
+        self._event_loop = None
+        # Chains of Processes running as one, if fused. See fuse_chains().
+        self.chains = []
+        # The Processes in topological order, computed by build(). See compile().
+        self.order = []
+        # Time spent in each phase of load(), in seconds.
+        self.load_times = {}
 
 
 
@@ -54,11 +68,14 @@ class MinecraftAI():
         process_type: type[Process],
         name: str='',
         type_args: dict={},
+        backend: str='thread'
     ) -> ProcessContainer:
         '''
         Adds a new Process to this model. process must be a subclass of Process.
         If using a subclass of Process, pass the type itself, not an instance.
         type_args are the arguments used for instantiation. Only used if process is a class.
+        backend selects how the process is executed: 'thread', 'process' or 'asyncio'.
+        It can also be changed later with connect().
         '''
         if type(process_type) is not type or not issubclass(process_type, Process):
             raise TypeError('process must be a subclass of Process, and not an instance')
@@ -71,7 +88,8 @@ class MinecraftAI():
             process_id=new_proc_id,
             process_type=process_type,
             name=name,
-            type_args=type_args
+            type_args=type_args,
+            backend=backend
         )
         return self.processes[new_proc_id]
 
@@ -81,49 +99,260 @@ class MinecraftAI():
         output: ProcessContainer.OutputReference,
         input: ProcessContainer.InputReference,
         policy: str='discrete',
-        name: str='connection'
+        name: str='connection',
+        connection_args: dict={}
     ):
         '''
         Adds a connection to this model from the given output to the given input.
         Input and output references can be acquired by calling inputs() and outputs() on
         the process returned by add_process().
+        connection_args are passed on to the Connection (e.g. transport, transport_args).
         '''
         name = utils.create_new_name(name, self.connections.values())
         new_conn_id = utils.create_new_id(self.connections.keys())
         self.connections[new_conn_id] = Connection(
             connection_id=new_conn_id,
             policy=policy,
-            name=name
+            name=name,
+            **connection_args
         )
-        self.processes[output.process_id].connect_output(new_conn_id, output)
-        self.processes[input.process_id].connect_input(new_conn_id, input)
+        producer, consumer = self.processes[output.process_id], self.processes[input.process_id]
+        previous = (list(producer.output_connections), list(consumer.input_connections))
+        try:
+            producer.connect_output(new_conn_id, output)
+            consumer.connect_input(new_conn_id, input)
+        except ProcessException:
+            # Leave the graph as it was.
+            producer.output_connections, consumer.input_connections = previous
+            del self.connections[new_conn_id]
+            raise
+
 
 
+    def build(self, fuse: bool=False):
+        '''
+        Checks the graph and binds Processes to their Connections (see compile()), then
+        builds the Processes and Connections. With fuse, linear chains of Processes are
+        also fused to run as one (see fuse_chains()).
+        '''
+        if not self._built:
+            self.compile()
+            self._build()
+        if fuse:
+            self.fuse_chains()
 
-    def build(self):
-        if self._built:
-            return
+    def _build(self):
         for proc in self.processes.values():
             proc._build()
+        # Connections touching a Process in another OS process need multiprocessing queues.
+        process_conns = set()
+        for proc in self.processes.values():
+            if proc.backend == 'process':
+                process_conns.update(proc.input_connections)
+                process_conns.update(proc.output_connections)
+        context = multiprocessing.get_context('spawn')
         for conn in self.connections.values():
-            conn._build()
+            conn._build(context if conn.connection_id in process_conns else None)
         self._built = True
 
 
 
+    def compile(self):
+        '''
+        Checks that the graph can run, and prepares it to:
+        - Every input of every Process must be connected, and every Connection must have
+          exactly one sending and one receiving Process.
+        - The graph must not contain a cycle. Every Connection blocks until it has
+          received its first value, so the Processes in a cycle would wait for each
+          other forever.
+        - Connections passing values by reference must not hold more values than their
+          sending Process has output buffers (see Process.num_output_buffers()).
+        Then computes the topological order of the Processes as order, and binds each
+        container's inputs and outputs to its Connection objects, so the run loops don't
+        look them up. Raises ProcessException if the graph can't run.
+        Called by build().
+        '''
+        producers, consumers = {}, {}
+        for proc in self.processes.values():
+            if -1 in proc.input_connections or \
+                    len(proc.input_connections) != proc.process_obj._num_inputs:
+                missing = [i for i in range(proc.process_obj._num_inputs)
+                    if i >= len(proc.input_connections) or proc.input_connections[i] == -1]
+                raise ProcessException(f'Inputs {missing} of "{proc.name}" are not connected')
+            for endpoints, kind, connections in ((producers, 'sent', proc.output_connections),
+                    (consumers, 'received', proc.input_connections)):
+                for c in connections:
+                    if c == -1:
+                        continue
+                    if c not in self.connections:
+                        raise ProcessException(f'"{proc.name}" uses connection {c}, ' + \
+                            'which does not exist')
+                    if c in endpoints:
+                        raise ProcessException(f'Connection "{self.connections[c].name}" is ' + \
+                            f'{kind} by both "{endpoints[c].name}" and "{proc.name}"')
+                    endpoints[c] = proc
+        for conn in self.connections.values():
+            c = conn.connection_id
+            if c not in producers or c not in consumers:
+                end = 'sending' if c not in producers else 'receiving'
+                raise ProcessException(f'Connection "{conn.name}" has no {end} Process')
+            # Values only cross OS processes, or go into shared memory, as copies.
+            if conn.transport == 'shared_memory' or \
+                    'process' in (producers[c].backend, consumers[c].backend):
+                continue
+            num_buffers = producers[c].process_obj.num_output_buffers()
+            # The receiver holds on to one more value while running, and the sender writes
+            # its next output into another buffer before sending it.
+            if num_buffers is not None and conn._capacity + 2 > num_buffers:
+                raise ProcessException(f'Connection "{conn.name}" can hold ' + \
+                    f'{conn._capacity} values, but "{producers[c].name}" overwrites its ' + \
+                    f'outputs after {num_buffers}, so the capacity must be at most ' + \
+                    f'{num_buffers - 2}')
+
+        # Kahn's algorithm, keeping the order Processes were added in among equals.
+        waiting = {p.process_id: len(set(p.input_connections)) for p in self.processes.values()}
+        ready = [p for p in self.processes.values() if waiting[p.process_id] == 0]
+        order = []
+        while ready:
+            proc = ready.pop(0)
+            order.append(proc)
+            for c in set(proc.output_connections) - {-1}:
+                consumer = consumers[c]
+                waiting[consumer.process_id] -= 1
+                if waiting[consumer.process_id] == 0:
+                    ready.append(consumer)
+        if len(order) != len(self.processes):
+            cycle = self._find_cycle(producers, [p for p in self.processes.values()
+                if p not in order])
+            raise ProcessException('The Processes ' + \
+                ' -> '.join(f'"{p.name}"' for p in cycle) + ' form a cycle, so they ' + \
+                'would wait for each other\'s outputs forever')
+        self.order = order
+
+        for proc in self.processes.values():
+            proc.inputs = [self.connections[c] for c in proc.input_connections]
+            proc.outputs = [None if c == -1 else self.connections[c]
+                for c in proc.output_connections]
+
+    def _find_cycle(self,
+        producers: dict,
+        remaining: list[ProcessContainer]
+    ) -> list[ProcessContainer]:
+        '''
+        A cycle among remaining, the Processes left over by a topological sort, which all
+        lie on or downstream of a cycle. Walking upstream from any of them must repeat.
+        '''
+        remaining_ids = {p.process_id for p in remaining}
+        path = [remaining[0]]
+        while True:
+            proc = next(producers[c] for c in path[-1].input_connections
+                if producers[c].process_id in remaining_ids)
+            if proc in path:
+                cycle = path[path.index(proc):][::-1]
+                return cycle + [cycle[0]]
+            path.append(proc)
+
+
+
+    def fusable_chains(self) -> list[list[ProcessContainer]]:
+        '''
+        The linear chains of Processes that can be fused, in order. Each Process in a chain
+        has a single output, connected only to the next one's single input by a discrete
+        Connection using the 'queue' transport that never drops values (overflow 'block'),
+        and all of them use the 'thread' backend.
+        Connections created with connection_args=dict(fuse=False) are never fused.
+        '''
+        producers, consumers = {}, {}
+        for proc in self.processes.values():
+            for c in proc.output_connections:
+                producers[c] = proc
+            for c in proc.input_connections:
+                consumers[c] = proc
+        following = {}
+        for conn in self.connections.values():
+            c = conn.connection_id
+            producer, consumer = producers.get(c), consumers.get(c)
+            if producer is None or consumer is None or producer is consumer:
+                continue
+            if conn.policy != ConnectionPolicy.DISCRETE or conn.transport != 'queue' or \
+                    conn.overflow != 'block' or not conn.fuse:
+                continue
+            if producer.backend != 'thread' or consumer.backend != 'thread':
+                continue
+            if producer.output_connections != [c] or consumer.input_connections != [c]:
+                continue
+            following[producer.process_id] = consumer
+        # Chains start at Processes that nothing is fused into. Cycles have no start, and
+        # aren't fused.
+        fused = {proc.process_id for proc in following.values()}
+        chains = []
+        for process_id in following:
+            if process_id in fused:
+                continue
+            chain = [self.processes[process_id]]
+            while chain[-1].process_id in following:
+                chain.append(following[chain[-1].process_id])
+            chains.append(chain)
+        return chains
+
+
+
+    def fuse_chains(self, fuse: bool=True):
+        '''
+        Runs each chain of fusable_chains() as one loop on a single thread, calling each
+        Process in turn with the previous one's output, instead of handing it over through
+        their Connection. That saves a queue hand-off and a thread switch per Process, but
+        the Processes in a chain no longer run in parallel with each other.
+        Each Process keeps its own properties and stats (see ProcessContainer.get_properties()).
+        The Connections within a chain are left in place but unused.
+        With fuse False, the chains are split up again. Takes effect when the model is
+        next started.
+        '''
+        if any(proc.subprocess is not None for proc in self.processes.values()):
+            raise ProcessException('Processes cannot be fused or split while running')
+        for proc in self.processes.values():
+            proc.fused = []
+            proc.fused_into = None
+        self.chains = self.fusable_chains() if fuse else []
+        for chain in self.chains:
+            chain[0].fused = chain[1:]
+            for proc in chain[1:]:
+                proc.fused_into = chain[0]
+
+
+
     def start(self,
-        allow_training: bool=True
+        allow_training: bool=True,
+        quantize: bool=False
     ):
         '''
         Launch all processes and start running the model.
+        Without allow_training, the model runs frozen: Processes skip training (see
+        Process.training_allowed()), and with quantize, run their models with int8 linear
+        layers (see Process.accelerated()).
         '''
+        self.set_training(allow_training, quantize)
         if not self._built:
             self.build()
-        for proc in self.processes.values():
+        if any(p.backend == 'asyncio' for p in self.processes.values()):
+            self._event_loop = backends.EventLoopThread(name=f'{self.name}_asyncio')
+            self._event_loop.start()
+        # Receivers first, so they're waiting by the time their inputs are sent.
+        for proc in reversed(self.order):
             proc.start()
 
 
 
+    def set_training(self, allow_training: bool=True, quantize: bool=False):
+        '''Sets whether the Processes may train. See start().'''
+        if quantize and allow_training:
+            raise ValueError('Only frozen models can be quantized')
+        for proc in self.processes.values():
+            proc.process_obj._allow_training = allow_training
+            proc.process_obj._quantize = quantize
+
+
+
     def stop(self):
         for proc in self.processes.values():
             proc.stop()
@@ -131,14 +360,19 @@ class MinecraftAI():
             conn.post_stop()
         for proc in self.processes.values():
             proc.join()
+        if self._event_loop is not None:
+            self._event_loop.stop()
+            self._event_loop = None
     
 
 
 
-    def save(self, path: Path, verbose: bool=True):
+    def save(self, path: Path, verbose: bool=True, models_data: dict=None):
         '''
         Saves the model to a given directory.
         If the path does not exist, it will be created.
+        models_data optionally maps process ids to snapshots of their models to save
+        instead of the live models. See ProcessContainer.snapshot_models().
         '''
         if type(path) is str:
             path = Path(path)
@@ -169,7 +403,8 @@ class MinecraftAI():
         if not os.path.exists(processes_dir):
             os.mkdir(processes_dir)
         for proc in self.processes.values():
-            proc.serialize(processes_dir / str(proc.process_id))
+            proc.serialize(processes_dir / str(proc.process_id),
+                None if models_data is None else models_data[proc.process_id])
 
         # Save Connections.
         connections_dir = path / 'connections'
@@ -184,6 +419,7 @@ class MinecraftAI():
         '''
         Loads a model from the given directory.
         '''
+        start = time.perf_counter()
         self = MinecraftAI()
         if type(path) is str:
             path = Path(path)
@@ -224,21 +460,44 @@ class MinecraftAI():
                 for k, v in overwritten_config.items():
                     print(f'\t{k}: {v}')
 
-        # Load Processes.
+        # Load Processes. They're independent, so load them concurrently; most of the
+        # time is spent in file I/O and torch.load(), which don't hold the GIL throughout.
+        processes_start = time.perf_counter()
         processes_dir = path / 'processes'
-        for proc_id_str in os.listdir(processes_dir):
-            self.processes[int(proc_id_str)] = ProcessContainer.deserialize(
+        proc_id_strs = os.listdir(processes_dir)
+        with ThreadPoolExecutor(max_workers=max(1, min(len(proc_id_strs), LOAD_WORKERS))) \
+                as executor:
+            containers = executor.map(lambda proc_id_str: ProcessContainer.deserialize(
                 path=processes_dir / proc_id_str,
                 parent_model=self
-            )
+            ), proc_id_strs)
+            for proc_id_str, container in zip(proc_id_strs, containers):
+                self.processes[int(proc_id_str)] = container
 
         # Load Connections.
+        connections_start = time.perf_counter()
         connections_dir = path / 'connections'
         for conn_id_str in os.listdir(connections_dir):
             self.connections[int(conn_id_str)] = Connection.deserialize(
                 path=connections_dir / conn_id_str,
             )
 
+        end = time.perf_counter()
+        self.load_times = {
+            'total': end - start,
+            'config': processes_start - start,
+            'processes': connections_start - processes_start,
+            'connections': end - connections_start,
+        }
+        if verbose:
+            print(f'Loaded "{self.name}" in {self.load_times["total"] * 1e3:.1f} ms ' + \
+                f'(config {self.load_times["config"] * 1e3:.1f} ms, ' + \
+                f'processes {self.load_times["processes"] * 1e3:.1f} ms, ' + \
+                f'connections {self.load_times["connections"] * 1e3:.1f} ms)')
+            for proc in self.processes.values():
+                print(f'\t{proc.name}: {proc.load_times["total"] * 1e3:.1f} ms ' + \
+                    f'(models {proc.load_times["models"] * 1e3:.1f} ms)')
+
         return self
 
 
@@ -1,4 +1,8 @@
 
+import copy
+from pathlib import Path
+
+import torch
 import torch.nn as nn
 
 
@@ -8,9 +12,56 @@ class Model(nn.Module):
         super().__init__()
         self.model_id = None
         self.name = None
-        self.optimizer = None
+        self._optimizer = None
+        # (optimizer type, saved model path or None, optimizer args) for models whose
+        # optimizer hasn't been needed yet. See defer_optimizer().
+        self._pending_optimizer = None
         self.init()
 
+    @property
+    def optimizer(self) -> torch.optim.Optimizer:
+        if self._pending_optimizer is not None:
+            optimizer_type, path, optimizer_args = self._pending_optimizer
+            optimizer = optimizer_type(self.parameters(), **optimizer_args)
+            if path is not None:
+                optimizer.load_state_dict(self._load_optimizer_state(path))
+            self._optimizer = optimizer
+            self._pending_optimizer = None
+        return self._optimizer
+
+    @optimizer.setter
+    def optimizer(self, optimizer: torch.optim.Optimizer):
+        self._optimizer = optimizer
+        self._pending_optimizer = None
+
+    def defer_optimizer(self,
+        optimizer_type: type[torch.optim.Optimizer],
+        path: Path=None,
+        optimizer_args: dict={}
+    ):
+        '''
+        Build the optimizer the first time it's used, so a model that never trains doesn't
+        pay for it. Its state is loaded from path (see ProcessContainer.serialize()) if
+        given, otherwise it's a new optimizer with optimizer_args.
+        '''
+        self._optimizer = None
+        self._pending_optimizer = (optimizer_type, path, optimizer_args)
+
+    def optimizer_type(self) -> type[torch.optim.Optimizer]:
+        if self._pending_optimizer is not None:
+            return self._pending_optimizer[0]
+        return type(self._optimizer)
+
+    def optimizer_state_dict(self) -> dict:
+        '''The optimizer's state, without building the optimizer if it's still deferred.'''
+        if self._pending_optimizer is not None and self._pending_optimizer[1] is not None:
+            return self._load_optimizer_state(self._pending_optimizer[1])
+        return self.optimizer.state_dict()
+
+    def _load_optimizer_state(self, path: Path) -> dict:
+        # Copied out of the memory map, so the file isn't held open and can be overwritten.
+        return copy.deepcopy(torch.load(path, mmap=True)['optimizer'])
+
     def init(self):
         pass
 
@@ -24,4 +75,4 @@ class Model(nn.Module):
         return {}
 
     def deserialize(self, config: dict):
-        pass
\ No newline at end of file
+        pass
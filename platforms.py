@@ -0,0 +1,206 @@
+import sys
+
+import numpy as np
+
+import config
+
+
+# Platforms are what Minecraft (see minecraft.py) delegates to: they find the game's view,
+# provide its frames and move its camera. Each one only imports its dependencies once it's
+# created, so e.g. pywin32 is never needed unless the 'win32' platform is used.
+
+
+
+class Platform():
+    '''
+    Base class of the platforms. Agents are numbered from 0; a platform may only support
+    some of them (e.g. there's a single Minecraft window).
+    '''
+
+    # Whether frames are grabbed from the screen at view_rect() (see vision.ScreenGrab),
+    # instead of being returned by grab_frame().
+    screen_capture = False
+
+    def focus_window(self):
+        pass
+
+    def view_rect(self, agent: int=0) -> dict:
+        '''The rect of agent's view, as {'left', 'top', 'width', 'height'}.'''
+        raise NotImplementedError()
+
+    def grab_frame(self, agent: int=0) -> np.ndarray:
+        '''
+        A (height, width, 4) BGRA frame of agent's view. It may be reused by the next call,
+        so copy anything that's kept.
+        '''
+        raise NotImplementedError()
+
+    def move_camera(self, x: float, y: float, agent: int=0):
+        raise NotImplementedError()
+
+    def stats(self) -> dict:
+        '''Per-agent statistics, e.g. for benchmarks.'''
+        return {}
+
+
+
+class Win32Platform(Platform):
+    '''The Minecraft window, on Windows. Only agent 0 exists.'''
+
+    screen_capture = True
+
+    def __init__(self):
+        if sys.platform != 'win32':
+            raise Exception('The Minecraft window can only be controlled on Windows; ' + \
+                f'use another platform (one of {", ".join(PLATFORMS)})')
+        import windows
+        self.windows = windows
+        self.windows.windows_init()
+        self.window_handle = None
+
+    def get_window_handle(self):
+        if self.window_handle is not None:
+            return self.window_handle
+        self.window_handle = self.windows.find_window(config.MINECRAFT_TITLE_TEXT_KEYWORD)
+        if self.window_handle is None:
+            raise Exception(f'Could not find a window with ' + \
+                f'"{config.MINECRAFT_TITLE_TEXT_KEYWORD}" in title text')
+        return self.window_handle
+
+    def _check_agent(self, agent: int):
+        if agent != 0:
+            raise Exception(f'Agent {agent} cannot use the Minecraft window; only agent 0 can')
+
+    def focus_window(self):
+        self.windows.focus_window(self.get_window_handle())
+
+    def view_rect(self, agent: int=0) -> dict:
+        self._check_agent(agent)
+        rect = self.windows.resize_window(self.get_window_handle())
+        return dict(zip(['left', 'top', 'width', 'height'], rect))
+
+    def move_camera(self, x: float, y: float, agent: int=0):
+        self._check_agent(agent)
+        self.windows.send_mousemove(x, y)
+
+
+
+class SimulatedPlatform(Platform):
+    '''
+    One simulated environment per agent (see simulation.SimulatedMinecraft), created on
+    first use. simulation_args are passed to SimulatedMinecraft, with the seed offset by
+    the agent index.
+    '''
+
+    def __init__(self, **simulation_args):
+        from simulation import SimulatedMinecraft
+        self.environment_type = SimulatedMinecraft
+        self.simulation_args = simulation_args
+        self.environments = {}
+
+    def environment(self, agent: int=0) -> 'simulation.SimulatedMinecraft':
+        if agent not in self.environments:
+            args = dict(self.simulation_args)
+            args['seed'] = args.get('seed', 0) + agent
+            self.environments[agent] = self.environment_type(**args)
+        return self.environments[agent]
+
+    def view_rect(self, agent: int=0) -> dict:
+        return self.environment(agent).rect()
+
+    def grab_frame(self, agent: int=0) -> np.ndarray:
+        return self.environment(agent).grab()
+
+    def move_camera(self, x: float, y: float, agent: int=0):
+        self.environment(agent).move_camera(x, y)
+
+    def stats(self) -> dict:
+        return {agent: env.stats() for agent, env in self.environments.items()}
+
+
+
+class NullPlatform(Platform):
+    '''
+    Black frames the size of the Minecraft window, and camera movements that go nowhere.
+    Movements are counted, so e.g. the real Controls can be benchmarked without the game.
+    '''
+
+    def __init__(self,
+        width: int=config.CONTROLS_WINDOW_WIDTH,
+        height: int=config.CONTROLS_WINDOW_HEIGHT
+    ):
+        self.width = width
+        self.height = height
+        self._frame = np.zeros((height, width, 4), dtype=np.uint8)
+        self._frame[:,:,3] = 255
+        self.frames = {}
+        self.moves = {}
+
+    def view_rect(self, agent: int=0) -> dict:
+        return {'left': 0, 'top': 0, 'width': self.width, 'height': self.height}
+
+    def grab_frame(self, agent: int=0) -> np.ndarray:
+        self.frames[agent] = self.frames.get(agent, 0) + 1
+        return self._frame
+
+    def move_camera(self, x: float, y: float, agent: int=0):
+        self.moves[agent] = self.moves.get(agent, 0) + 1
+
+    def stats(self) -> dict:
+        return {agent: {'frames': self.frames.get(agent, 0), 'moves': self.moves.get(agent, 0)}
+            for agent in set(self.frames) | set(self.moves)}
+
+
+
+class RecordedPlatform(NullPlatform):
+    '''
+    Frames replayed from a recording (see recording.py), one per grab, looping at the end.
+    Agent i starts recording.AGENT_FRAME_OFFSET * i frames in. Camera movements are counted
+    and discarded, like NullPlatform's. To replay with the recorded timing, use
+    recording.RecordedScreenGrab instead.
+    '''
+
+    def __init__(self, path: str):
+        import cv2
+        import recording
+        self.cv2 = cv2
+        self.reader = recording.FrameReader(path)
+        self.agent_offset = recording.AGENT_FRAME_OFFSET
+        height, width = self.reader.shape[:2]
+        super().__init__(width, height)
+        # Recordings hold converted frames (see vision.ScreenGrab), so convert them back.
+        if len(self.reader.shape) == 2:
+            self.conversion = cv2.COLOR_GRAY2BGRA
+        elif self.reader.shape[0] == 3 and self.reader.shape[2] != 3:
+            raise ValueError('Planar recordings cannot be replayed as frames')
+        else:
+            self.conversion = cv2.COLOR_RGB2BGRA
+        self._frames = {}
+
+    def grab_frame(self, agent: int=0) -> np.ndarray:
+        index = (self.frames.get(agent, 0) + agent * self.agent_offset) % len(self.reader)
+        super().grab_frame(agent)
+        if agent not in self._frames:
+            self._frames[agent] = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        self.cv2.cvtColor(self.reader[index], self.conversion, dst=self._frames[agent])
+        return self._frames[agent]
+
+
+
+# Platforms by name, for Minecraft.use_platform(). Others can be registered.
+PLATFORMS = {
+    'win32': Win32Platform,
+    'simulated': SimulatedPlatform,
+    'null': NullPlatform,
+    'recorded': RecordedPlatform,
+}
+
+
+def register_platform(name: str, platform_type: type[Platform]):
+    PLATFORMS[name] = platform_type
+
+
+def create_platform(name: str, **args) -> Platform:
+    if name not in PLATFORMS:
+        raise ValueError(f'"{name}" is not a valid platform (one of {", ".join(PLATFORMS)})')
+    return PLATFORMS[name](**args)
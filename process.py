@@ -1,18 +1,25 @@
 
+import copy
 import json
 import multiprocessing
 import threading
 import os
 from pathlib import Path
+import pickle
+import queue
 import time
 from typing import Any
+import warnings
 
-import torch
-
+import backends
 from connection import Connection
-from model import Model
+from metrics import StageStats
+import tracing
 import utils
 
+# torch (and model.py, which needs it) is imported where models are used, so Processes
+# without models, e.g. for recording, don't pay for importing it.
+
 
 
 class ProcessException(Exception):
@@ -22,7 +29,8 @@ class ProcessException(Exception):
 
 class Process():
     '''
-    A Process is a set of model components that run in their own multiprocessing thread.
+    A Process is a set of model components that run in parallel with the other Processes.
+    Depending on its container's backend, it runs in a thread, an OS process or an asyncio task.
     It typically contains a full abstraction layer (controls, logic, etc.)
     Time-sensitive operations, such as screen grabbing, may also run in their own Process.
     The constructor must have ALL default args. State must be able to come from deserialization.
@@ -33,13 +41,37 @@ class Process():
         self._num_outputs = num_outputs
         self._time_step_last = 0
         self._time_step_elapsed = 0
+        self._origin = 0.0
+        self._stats = StageStats()
         self._models_from_disk = False
         # Only used while loading from disk, helps match models to names. See add_model().
         self._model_names = []
         # self.models is a dict owned by its container, assigned in ProcessContainer.__init__().
         self._models = None
+        self._models_lock = threading.Lock()
+        # (batch size, deadline) if inputs are gathered rather than all awaited. See gather().
+        self._gather = None
+        # Options for running models, if set with accelerate(), and the models prepared
+        # for inference with them, by id. See accelerated().
+        self._acceleration = None
+        self._accelerated = {}
+        # Set by MinecraftAI.start(). See training_allowed().
+        self._allow_training = True
+        self._quantize = False
         self._properties = {}
 
+    def __getstate__(self):
+        # Locks can't be pickled, e.g. when sent to a 'process' backend.
+        state = self.__dict__.copy()
+        del state['_models_lock']
+        # Compiled models can't be pickled either, and are prepared again when needed.
+        state['_accelerated'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._models_lock = threading.Lock()
+
     def _build(self):
         self.build()
 
@@ -49,13 +81,27 @@ class Process():
         self._time_step_elapsed = 0
         self.start()
 
-    def _run(self, inputs: list):
+    def _stop(self):
+        '''Called after the last call to _run(), in the same thread.'''
+        self.stop()
+
+    def _run(self, inputs: list, origin: float=None):
+        self._origin = time.perf_counter() if origin is None else origin
         r = self.run(inputs)
         now = time.perf_counter()
         self._time_step_elapsed = now - self._time_step_last
         self._time_step_last = now
         return r
 
+    async def _run_async(self, inputs: list, origin: float=None):
+        '''Same as _run(), for Processes whose run() is a coroutine function.'''
+        self._origin = time.perf_counter() if origin is None else origin
+        r = await self.run(inputs)
+        now = time.perf_counter()
+        self._time_step_elapsed = now - self._time_step_last
+        self._time_step_last = now
+        return r
+
     def _serialize(self, path: Path):
         # Models are de/serialized in ProcessContainer.
         return {
@@ -73,9 +119,16 @@ class Process():
     def time_step(self):
         return self._time_step_elapsed
 
+    def input_origin(self) -> float:
+        '''
+        The time.perf_counter() time at which the oldest data behind the current inputs
+        entered the graph. For Processes without inputs, the time the current run started.
+        '''
+        return self._origin
+
     def add_model(self,
-        model_type: type[Model],
-        optimizer_type: type[torch.optim.Optimizer],
+        model_type: 'type[model.Model]',
+        optimizer_type: 'type[torch.optim.Optimizer]',
         name: str='model',
         type_args: dict={},
         optimizer_args: dict={}
@@ -102,18 +155,121 @@ class Process():
             return m
         else:
             # This is brand new, so construct a new model from scratch.
+            from model import Model
             if not issubclass(model_type, Model):
                 raise TypeError(f'{model_type.__name__} is not a subclass of Model')
             m = model_type(**type_args)
             m.model_id = utils.create_new_id(self._models.keys())
             m.name = utils.create_new_name(name, self._models.values())
-            m.optimizer = optimizer_type(m.parameters(), **optimizer_args)
+            if self._allow_training:
+                m.optimizer = optimizer_type(m.parameters(), **optimizer_args)
+            else:
+                # Frozen, so it's only built if something needs it, e.g. to save the model.
+                m.defer_optimizer(optimizer_type, optimizer_args=optimizer_args)
             self._models[m.model_id] = m
             return m
 
+    def gather(self, batch_size: int, deadline: float):
+        '''
+        For Processes serving several independent streams, one per input.
+        Instead of waiting for every input, run as soon as batch_size inputs have data,
+        or deadline seconds after the first one did. Inputs without data are passed to run()
+        as None. Call from start(); supported by the 'thread' and 'process' backends.
+        '''
+        self._gather = (batch_size, deadline)
+
+    def accelerate(self,
+        inference_mode: bool=True,
+        channels_last: bool=False,
+        compile: str=None,
+        num_threads: int=None
+    ):
+        '''
+        For Processes running models. Sets how inference() and accelerated() run them:
+          - inference_mode: use torch.inference_mode() instead of torch.no_grad().
+          - channels_last: keep models and their inputs channels last in memory, which
+            convolutions are faster with on CPU.
+          - compile: 'trace' (torch.jit.trace) or 'compile' (torch.compile) the models
+            for inference. Compiled models share their parameters with the originals.
+          - num_threads: how many threads torch uses within each operation. This is set
+            per OS process, so it's shared with the other Processes on the 'thread' and
+            'asyncio' backends. Fewer threads per stage avoids oversubscribing the cores.
+        Call it from build() or start().
+        '''
+        import torch
+        if compile not in COMPILE_MODES:
+            raise ValueError(f'"{compile}" is not a valid compile mode')
+        self._acceleration = {
+            'inference_mode': inference_mode,
+            'channels_last': channels_last,
+            'compile': compile,
+            'num_threads': num_threads,
+        }
+        self._accelerated = {}
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def inference(self):
+        '''A context for running models without autograd. See accelerate().'''
+        import torch
+        if self._acceleration is not None and self._acceleration['inference_mode']:
+            return torch.inference_mode()
+        return torch.no_grad()
+
+    def accelerated(self, model: 'model.Model') -> callable:
+        '''
+        model, prepared for inference as set by accelerate(). Call it on (N, C, H, W)
+        batches within inference(). Preparation happens on the first call (with 'trace',
+        the first batch is traced), and is reused as long as model is.
+        When frozen with quantize (see MinecraftAI.start()), a copy of model with int8
+        linear layers is used instead, so it doesn't follow later changes to model.
+        '''
+        if self._acceleration is None and not self._quantize:
+            return model
+        key = id(model)
+        if key not in self._accelerated or self._accelerated[key][0] is not model:
+            acceleration = self._acceleration or {}
+            self._accelerated[key] = (model,
+                _AcceleratedModel(model, **acceleration, quantize=self._quantize))
+        return self._accelerated[key][1]
+
+    def num_output_buffers(self) -> int or None:
+        '''
+        For Processes that write their outputs into a ring of preallocated arrays: how many
+        there are, so each output is overwritten that many outputs later. None (the default)
+        if every output is a new array. MinecraftAI.compile() checks that no Connection
+        passing outputs by reference can hold on to them for longer.
+        '''
+        return None
+
+    def training_allowed(self) -> bool:
+        '''
+        False if the model runs frozen (see MinecraftAI.start()). Processes should then
+        skip everything only needed for training, such as optimizers and labels.
+        '''
+        return self._allow_training
+
+    def models_lock(self) -> threading.Lock:
+        '''
+        Hold this lock while updating models (e.g. around an optimizer step), so that
+        checkpoints taken from another thread never see a partial update.
+        '''
+        return self._models_lock
+
+    def _snapshot_models(self) -> dict:
+        '''Copies of the models' saved data, by model id. See _model_data().'''
+        with self._models_lock:
+            return {m.model_id: _model_data(m, copy_tensors=True) for m in self._models.values()}
+
     def set_property(self, name: str, value: Any):
         self._properties[name] = value
 
+    def _get_properties(self) -> dict:
+        '''Properties set by the Process, followed by its run loop timings.'''
+        properties = dict(self._properties)
+        properties.update(self._stats.to_properties())
+        return properties
+
 
 
     def build(self):
@@ -123,8 +279,14 @@ class Process():
         pass
 
     def run(self, inputs: list):
+        '''
+        Returns a list with one entry per output. An entry of None sends nothing.
+        '''
         raise NotImplementedError()
 
+    def stop(self):
+        pass
+
     def serialize(self, path: Path) -> dict:
         return dict()
 
@@ -133,22 +295,237 @@ class Process():
         
 
 
-def _run(self):
-    self.process_obj._start()
-    while self._keep_running:
-        inputs = [None] * len(self.input_connections)
-        for i, c in enumerate(self.input_connections):
-            x = self.parent_model.connections[c].request()
-            if x is None:
-                # Signal stoppage by changing length of inputs.
-                inputs = []
-            else:
-                inputs[i] = x
-        if len(inputs) != len(self.input_connections):
+# How accelerate() can compile models for inference. torch.jit.script isn't offered, as it
+# can't handle Model's Python-only attributes (e.g. the optimizer property).
+COMPILE_MODES = (None, 'trace', 'compile')
+
+
+class _AcceleratedModel():
+    '''A model prepared for inference. See Process.accelerate() and Process.accelerated().'''
+
+    def __init__(self,
+        model: 'model.Model',
+        inference_mode: bool=True,
+        channels_last: bool=False,
+        compile: str=None,
+        num_threads: int=None,
+        quantize: bool=False
+    ):
+        import torch
+        if quantize:
+            from learner import copy_model
+            model = copy_model(model)
+            with warnings.catch_warnings():
+                # Eager quantization is deprecated in favour of torchao, but still works.
+                warnings.simplefilter('ignore')
+                torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear},
+                    dtype=torch.qint8, inplace=True)
+        self.model = model
+        self.memory_format = torch.channels_last if channels_last else None
+        self.compile = compile
+        if channels_last:
+            # Converts the parameters in place, so training uses the same layout.
+            model.to(memory_format=torch.channels_last)
+        self.forward = torch.compile(model) if compile == 'compile' else None
+
+    def __call__(self, x):
+        import torch
+        if self.memory_format is not None:
+            x = x.contiguous(memory_format=self.memory_format)
+        if self.forward is None and self.compile == 'trace':
+            # Traced on the first batch; other batch sizes reuse the same graph.
+            with warnings.catch_warnings():
+                # torch.jit is deprecated in favour of torch.compile, but still works.
+                warnings.simplefilter('ignore', FutureWarning)
+                self.forward = torch.jit.trace(self.model, x)
+        elif self.forward is None:
+            self.forward = self.model
+        return self.forward(x)
+
+
+
+def _model_data(model: 'model.Model', copy_tensors: bool=False) -> dict:
+    '''
+    Everything saved for a model: its state, its optimizer's state, and how to rebuild both.
+    With copy_tensors, the states are copied rather than referencing the live tensors.
+    '''
+    state = model.state_dict()
+    optimizer_state = model.optimizer_state_dict()
+    if copy_tensors:
+        state = {k: v.detach().clone() for k, v in state.items()}
+        optimizer_state = copy.deepcopy(optimizer_state)
+    return {
+        'id': model.model_id,
+        'name': model.name,
+        'model': state,
+        'optimizer': optimizer_state,
+        'type': utils.serialize_class(model.__class__),
+        'optimizer_type': utils.name_from_optimizer(model.optimizer_type()),
+        'config': model.serialize()
+    }
+
+
+
+def _run_loop(
+    process_obj: Process,
+    inputs: list[Connection],
+    outputs: list[Connection],
+    is_running,
+    on_iteration=None,
+    name: str=None
+):
+    '''
+    The run loop shared by the thread and process backends.
+    outputs holds None for outputs that aren't connected, whose values are discarded.
+    Each iteration is timed as input wait, compute and output blocked time.
+    is_running() is checked before each iteration, on_iteration() is called after it.
+    While tracing, each run() is recorded as a span named name (see tracing.py).
+    '''
+    name = name or type(process_obj).__name__
+    process_obj._start()
+    stats = process_obj._stats
+    while is_running():
+        t_start = time.perf_counter()
+        data, origin = _request_inputs(process_obj, inputs, is_running)
+        if data is None:
+            continue
+        t_inputs = time.perf_counter()
+        results = process_obj._run(data, origin)
+        t_run = time.perf_counter()
+        if tracing.active:
+            tracing.record(name, 'run', t_inputs, t_run)
+        origin = process_obj.input_origin()
+        for conn, d in zip(outputs, results):
+            if d is not None and conn is not None:
+                conn.send(d, origin=origin)
+        stats.record(t_inputs - t_start, t_run - t_inputs, time.perf_counter() - t_run)
+        if on_iteration is not None:
+            on_iteration()
+    process_obj._stop()
+
+
+def _run_chain_loop(
+    process_objs: list[Process],
+    inputs: list[Connection],
+    outputs: list[Connection],
+    is_running,
+    names: list[str]=None
+):
+    '''
+    The run loop of a fused chain of Processes (see MinecraftAI.fuse_chains()).
+    The first requests inputs from inputs, each passes its only output straight to the
+    next one's run(), and the last sends its outputs to outputs. If a Process outputs None,
+    the rest of the chain doesn't run that iteration.
+    Each Process's stats count the time outside its own run() as waiting for input, so
+    they still show how busy each one is.
+    While tracing, each run() is recorded as a span named by names.
+    '''
+    names = names or [type(p).__name__ for p in process_objs]
+    for process_obj in process_objs:
+        process_obj._start()
+    last = [time.perf_counter()] * len(process_objs)
+    while is_running():
+        data, origin = _request_inputs(process_objs[0], inputs, is_running)
+        if data is None:
             continue
-        outputs = self.process_obj._run(inputs)
-        for c, data in zip(self.output_connections, outputs):
-            self.parent_model.connections[c].send(data)
+        for i, process_obj in enumerate(process_objs):
+            t_inputs = time.perf_counter()
+            results = process_obj._run(data, origin)
+            t_run = time.perf_counter()
+            if tracing.active:
+                tracing.record(names[i], 'run', t_inputs, t_run)
+            origin = process_obj.input_origin()
+            blocked = 0.0
+            if i == len(process_objs) - 1:
+                for conn, d in zip(outputs, results):
+                    if d is not None and conn is not None:
+                        conn.send(d, origin=origin)
+                blocked = time.perf_counter() - t_run
+            process_obj._stats.record(t_inputs - last[i], t_run - t_inputs, blocked)
+            last[i] = t_run + blocked
+            if i < len(process_objs) - 1:
+                if results[0] is None:
+                    break
+                data = [results[0]]
+    for process_obj in process_objs:
+        process_obj._stop()
+
+
+def _request_inputs(
+    process_obj: Process,
+    inputs: list[Connection],
+    is_running
+) -> tuple[list or None, float]:
+    '''
+    Requests the inputs of one iteration, waiting for all of them, or gathering them if
+    the Process asked to (see Process.gather()).
+    Returns (data, origin), where data is None if a stop was posted.
+    '''
+    if process_obj._gather is not None:
+        return _gather_inputs(inputs, is_running, *process_obj._gather)
+    data = [None] * len(inputs)
+    origin = None
+    for i, conn in enumerate(inputs):
+        x = conn.request()
+        if x is None:
+            # Signal stoppage.
+            return None, None
+        data[i] = x
+        if origin is None or conn.last_origin < origin:
+            origin = conn.last_origin
+    return data, origin
+
+
+def _gather_inputs(
+    inputs: list[Connection],
+    is_running,
+    batch_size: int,
+    deadline: float
+) -> tuple[list or None, float]:
+    '''
+    Polls inputs until batch_size of them (or all of them) have data, or deadline seconds
+    have passed since the first one did. See Process.gather().
+    Returns (data, origin), where data is None if a stop was posted.
+    '''
+    data = [None] * len(inputs)
+    count = 0
+    origin = None
+    first = None
+    while is_running():
+        for i, conn in enumerate(inputs):
+            if data[i] is not None:
+                continue
+            try:
+                x = conn.request(block=False)
+            except queue.Empty:
+                continue
+            if x is None:
+                return None, None
+            data[i] = x
+            count += 1
+            if origin is None or conn.last_origin < origin:
+                origin = conn.last_origin
+            if first is None:
+                first = time.perf_counter()
+        if count >= batch_size or count == len(inputs) or \
+                (first is not None and time.perf_counter() - first >= deadline):
+            return data, origin
+        time.sleep(backends.POLL_INTERVAL)
+    return None, None
+
+
+def _run(self):
+    if self.fused:
+        _run_chain_loop(
+            [self.process_obj] + [p.process_obj for p in self.fused],
+            self.inputs,
+            self.fused[-1].outputs,
+            lambda: self._keep_running,
+            [self.name] + [p.name for p in self.fused]
+        )
+        return
+    _run_loop(self.process_obj, self.inputs, self.outputs, lambda: self._keep_running,
+        name=self.name)
 
 
 class ProcessContainer():
@@ -174,7 +551,8 @@ class ProcessContainer():
         process_id: int,
         process_type: type,
         name: str='process',
-        type_args: dict={}
+        type_args: dict={},
+        backend: str='thread'
     ):
         self.parent_model = parent_model
         self.process_id = process_id
@@ -183,10 +561,26 @@ class ProcessContainer():
                 f'"{process_type.__name__}" is not')
         self.process_obj = process_type(**type_args)
         self.name = name
+        self.backend = backends.check_backend(backend)
         self.subprocess = None
         self._keep_running = False
+        self._stop_event = None
+        self._status = None
+        self._control = None
+        self._child_properties = {}
+        self._snapshot_ticket = 0
+        self._child_snapshot = (0, None)
+        self.load_times = {}
         self.input_connections = []
         self.output_connections = []
+        # The Connection objects of input_connections and output_connections (None for
+        # unconnected outputs), bound by MinecraftAI.build().
+        self.inputs = []
+        self.outputs = []
+        # The containers this one runs after its own Process, if it heads a fused chain,
+        # or the head of the chain it's fused into. See MinecraftAI.fuse_chains().
+        self.fused = []
+        self.fused_into = None
         self.models = {}
         self.process_obj._models = self.models
 
@@ -195,7 +589,9 @@ class ProcessContainer():
     def connect(self,
         *args,
         policy: str or list[str]=None,
-        names: list[str]=None
+        names: list[str]=None,
+        connection_args: dict or list[dict]=None,
+        backend: str=None
     ) -> 'ProcessContainer.OutputReference' or list['ProcessContainer.OutputReference']:
         '''
         Specify the inputs and evaluation policy of this process.
@@ -203,6 +599,9 @@ class ProcessContainer():
         Returns a list of output references for this process.
         If unspecified, the evaluation policy defaults to 'discrete' for all inputs.
         To specify per-input evaluation policies, pass a list of policy names.
+        connection_args are extra Connection arguments (e.g. transport, or capacity and
+        overflow). Pass one dict to apply to all inputs, or a list with one dict per input.
+        If given, backend selects how this process is executed. See backends.BACKENDS.
         '''
         if any(not isinstance(a, ProcessContainer.OutputReference) for a in args):
             raise TypeError('All inputs must be references to outputs of ' + \
@@ -223,13 +622,25 @@ class ProcessContainer():
         elif len(names) != len(args):
             raise ValueError('Number of names must match number of inputs')
 
+        if backend is not None:
+            self.backend = backends.check_backend(backend)
+
+        if connection_args is None:
+            connection_args = [{}] * len(args)
+        elif type(connection_args) is list:
+            if len(connection_args) != len(args):
+                raise ValueError('Number of connection_args must match number of inputs')
+        else:
+            connection_args = [connection_args] * len(args)
+
         for i, output in enumerate(args):
             this_input = ProcessContainer.InputReference(self.process_id, i)
             self.parent_model.add_connection(
                 output=output,
                 input=this_input,
                 policy=policy[i],
-                name=names[i]
+                name=names[i],
+                connection_args=connection_args[i]
             )
         if self.process_obj._num_outputs == 1:
             return ProcessContainer.OutputReference(self.process_id, 0)
@@ -248,6 +659,9 @@ class ProcessContainer():
         elif len(self.input_connections) != self.process_obj._num_inputs:
             raise ProcessException('ProcessContainer connections length does not match ' + \
                 'process_obj._num_inputs')
+        if self.input_connections[input_reference.input_index] not in (-1, connection_id):
+            raise ProcessException(f'Input {input_reference.input_index} of "{self.name}" ' + \
+                'is already connected')
         self.input_connections[input_reference.input_index] = connection_id
 
 
@@ -260,41 +674,55 @@ class ProcessContainer():
             self.output_connections = [-1] * self.process_obj._num_outputs
         elif len(self.output_connections) != self.process_obj._num_outputs:
             raise ProcessException('ProcessContainer connections length does not match ' + \
-                'process_obj._num_inputs')
+                'process_obj._num_outputs')
+        if self.output_connections[output_reference.output_index] not in (-1, connection_id):
+            # Each value is delivered to one receiver, so an output can't feed two inputs.
+            raise ProcessException(f'Output {output_reference.output_index} of ' + \
+                f'"{self.name}" is already connected')
         self.output_connections[output_reference.output_index] = connection_id
             
 
     def _build(self):
-        if self.process_obj is not None:
+        # Processes running in their own OS process are built there instead.
+        if self.process_obj is not None and self.backend != 'process':
             self.process_obj._build()
 
 
-    def _run(self):
-        self.process_obj._start()
-        while self._keep_running:
-            inputs = [None] * len(self.input_connections)
-            for c, i in enumerate(self.input_connections):
-                x = self.parent_model.connections[c].request()
-                if x is None:
-                    inputs = None
-                    break
-                inputs[i] = x
-            if inputs is None:
-                continue
-            outputs = self.process_obj._run(inputs)
-            for c, data in zip(self.output_connections, outputs):
-                self.parent_model.connections[c].send(data)
-
-
     def start(self):
         '''
-        Start running the process.
+        Start running the process on its backend.
         '''
         if self.subprocess is not None:
             raise ProcessException('Process is already running')
         self._keep_running = True
-        self.subprocess = threading.Thread(target=_run, name=self.name, args=(self,))
-        self.subprocess.start()
+        if self.fused_into is not None:
+            # Run on the thread of the chain it's fused into.
+            return
+        if self.backend == 'process':
+            context = multiprocessing.get_context('spawn')
+            self._stop_event = context.Event()
+            self._status = context.Queue()
+            self._control = context.Queue()
+            self.subprocess = context.Process(
+                target=backends.process_main,
+                name=self.name,
+                args=(
+                    self.process_obj,
+                    self.inputs,
+                    self.outputs,
+                    self._stop_event,
+                    self._status,
+                    self._control,
+                    tracing._capacity if tracing.active else None
+                ),
+                daemon=True
+            )
+            self.subprocess.start()
+        elif self.backend == 'asyncio':
+            self.subprocess = self.parent_model._event_loop.submit(backends.run_async(self))
+        else:
+            self.subprocess = threading.Thread(target=_run, name=self.name, args=(self,))
+            self.subprocess.start()
 
 
     def stop(self):
@@ -303,6 +731,59 @@ class ProcessContainer():
         Does NOT wait for the process to actually stop. See self.join().
         '''
         self._keep_running = False
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+
+    def _is_alive(self) -> bool:
+        if self.backend == 'asyncio':
+            return not self.subprocess.done()
+        return self.subprocess.is_alive()
+
+
+    def _wait(self, timeout: float):
+        if self.backend == 'process':
+            # Keep reading status while waiting; the child can't exit until it's flushed.
+            self._poll_status(timeout)
+        elif self.backend == 'asyncio':
+            try:
+                self.subprocess.result(timeout)
+            except TimeoutError:
+                pass
+        else:
+            self.subprocess.join(timeout)
+
+
+    def _poll_status(self, timeout: float=None):
+        '''Handle messages sent back by a process running in its own OS process.'''
+        if self._status is None:
+            return
+        try:
+            while True:
+                kind, payload = self._status.get(timeout=timeout) if timeout \
+                    else self._status.get_nowait()
+                timeout = None
+                if kind == 'properties':
+                    self._child_properties = payload
+                elif kind == 'latency':
+                    # Latencies are recorded where data is received, i.e. in the child.
+                    for c, histogram in payload.items():
+                        self.parent_model.connections[c]._latency = histogram
+                elif kind == 'dropped':
+                    # Likewise, drops are counted where data is sent.
+                    for c, dropped in payload.items():
+                        self.parent_model.connections[c]._dropped = dropped
+                elif kind == 'trace':
+                    tracing.add_events(payload)
+                elif kind == 'snapshot':
+                    self._child_snapshot = payload
+                elif kind == 'final':
+                    self._child_properties = payload['properties']
+                    # Adopt the trained models so they can be saved.
+                    self.models.clear()
+                    self.models.update(pickle.loads(payload['models']))
+        except queue.Empty:
+            pass
 
 
     def join(self):
@@ -310,27 +791,75 @@ class ProcessContainer():
         Stops the process if it hasn't stopped already.
         Waits for it to finish stopping before returning.
         '''
-        self._keep_running = False
+        self.stop()
+        if self.subprocess is None:
+            # Not started, or run by the head of its fused chain, which is joined instead.
+            return
         for conn in self.parent_model.connections.values():
             conn.drain()
-        while self.subprocess.is_alive():
+        while self._is_alive():
             for conn in self.parent_model.connections.values():
                 conn.post_stop()
-            self.subprocess.join(0.1)
+            if self.backend == 'process':
+                # The child flushes what it sent before exiting, so make room for it.
+                for conn in self.outputs:
+                    if conn is not None:
+                        conn.drain()
+            self._wait(0.1)
+        if self.backend == 'process':
+            self._poll_status()
+            self._status = None
+            self._control = None
+            self._stop_event = None
+        elif self.backend == 'asyncio':
+            # Surface any exception raised in the task.
+            self.subprocess.result()
         self.subprocess = None
 
 
+    def snapshot_models(self, timeout: float=10.0) -> dict or None:
+        '''
+        Returns copies of the models' saved data, taken while they weren't being updated
+        (see Process.models_lock()). Can be called from any thread while running.
+        For the 'process' backend the copies are made in the child process. Returns None
+        if it doesn't respond within timeout seconds.
+        '''
+        if self.backend != 'process' or self._control is None:
+            return self.process_obj._snapshot_models()
+        self._snapshot_ticket += 1
+        ticket = self._snapshot_ticket
+        self._control.put(ticket)
+        deadline = time.perf_counter() + timeout
+        while self._child_snapshot[0] != ticket:
+            if time.perf_counter() > deadline or self._status is None:
+                return None
+            self._poll_status(0.05)
+        return pickle.loads(self._child_snapshot[1])
+
+
     def get_properties(self):
-        return self.process_obj._properties
+        '''
+        Properties set by the Process, plus its average input wait, compute and output
+        blocked times per iteration, and the share of time spent computing (busy %).
+        '''
+        if self.backend == 'process':
+            self._poll_status()
+            return self._child_properties
+        return self.process_obj._get_properties()
 
 
 
-    def serialize(self, path: Path):
+    def serialize(self, path: Path, models_data: dict=None):
+        '''
+        Saves the container, its Process and its models to path.
+        If given, models_data (see snapshot_models()) is saved instead of the live models.
+        '''
         if not os.path.exists(path):
             os.mkdir(path)
         attributes = {
             'process_id': self.process_id,
             'name': self.name,
+            'backend': self.backend,
             'input_connections': self.input_connections,
             'output_connections': self.output_connections,
             'process_obj_name': self.process_obj.__class__.__qualname__,
@@ -340,21 +869,15 @@ class ProcessContainer():
         with open(path / 'attributes.json', 'w') as file:
             json.dump(attributes, file)
 
-        if len(self.models) > 0:
+        if models_data is None:
+            models_data = {m.model_id: _model_data(m) for m in self.models.values()}
+        if len(models_data) > 0:
+            import torch
             models_path = path / 'models'
             if not os.path.exists(models_path):
                 os.mkdir(models_path)
-            for model in self.models.values():
-                model_data = {
-                    'id': model.model_id,
-                    'name': model.name,
-                    'model': model.state_dict(),
-                    'optimizer': model.optimizer.state_dict(),
-                    'type': utils.serialize_class(model.__class__),
-                    'optimizer_type': utils.name_from_optimizer(model.optimizer.__class__),
-                    'config': model.serialize()
-                }
-                torch.save(model_data, models_path / f'{model.model_id}.pt')
+            for model_id, model_data in models_data.items():
+                torch.save(model_data, models_path / f'{model_id}.pt')
 
 
 
@@ -363,6 +886,12 @@ class ProcessContainer():
         parent_model: 'MinecraftAI',
         custom_objects: dict={}
     ) -> 'ProcessContainer':
+        '''
+        Loads a container saved with serialize(). Model weights are memory-mapped and
+        copied straight into the models, and optimizers are only built once they're used
+        (see Model.defer_optimizer()). Timings are recorded in load_times, in seconds.
+        '''
+        start = time.perf_counter()
         with open(path / 'attributes.json', 'r') as file:
             attributes = json.load(file)
         if attributes['process_obj_name'] in custom_objects.keys():
@@ -382,20 +911,26 @@ class ProcessContainer():
         for name, value in attributes.items():
             setattr(self, name, value)
         self.process_obj._deserialize(process_obj_data, path)
+        models_start = time.perf_counter()
 
         models_path = path / 'models'
         if os.path.exists(models_path):
+            import torch
             for model_file in os.listdir(models_path):
-                model_data = torch.load(models_path / model_file)
+                model_data = torch.load(models_path / model_file, mmap=True)
                 model = utils.deserialize_class(model_data['type'])()
                 model.model_id = model_data['id']
                 model.name = model_data['name']
                 model.deserialize(model_data['config'])
                 model.load_state_dict(model_data['model'])
-                model.optimizer = utils.optimizer_from_name(model_data['optimizer_type'])\
-                    (model.parameters())
-                model.optimizer.load_state_dict(model_data['optimizer'])
+                model.defer_optimizer(
+                    utils.optimizer_from_name(model_data['optimizer_type']),
+                    models_path / model_file
+                )
                 self.models[model.model_id] = model
             if len(self.models) > 0:
-                self._models_from_disk = True
+                # Tell the Process to match add_model() calls with these models.
+                self.process_obj._models_from_disk = True
+        end = time.perf_counter()
+        self.load_times = {'total': end - start, 'models': end - models_start}
         return self
@@ -0,0 +1,219 @@
+import json
+import os
+from pathlib import Path
+import time
+
+import numpy as np
+
+from process import Process
+
+
+# A recording is a directory containing:
+#   - header.json: the frame shape and dtype
+#   - frames.bin: the raw frames, back to back
+#   - timestamps.bin: one float64 capture time (in seconds) per frame
+# The frame count is derived from the file sizes, so an interrupted recording stays readable.
+RECORDING_VERSION = 1
+
+# Agents replaying the same recording start this many frames apart, so they don't all
+# see the same frames at the same time.
+AGENT_FRAME_OFFSET = 100
+
+
+
+class FrameWriter():
+    '''
+    Appends frames to a recording. The frame shape and dtype are taken from the first frame.
+    '''
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.shape = None
+        self.dtype = None
+        self.count = 0
+        self._frames_file = None
+        self._timestamps_file = None
+
+
+    def write(self, frame: np.ndarray, timestamp: float=None):
+        if self._frames_file is None:
+            self.shape = frame.shape
+            self.dtype = frame.dtype
+            with open(self.path / 'header.json', 'w') as file:
+                json.dump({
+                    'version': RECORDING_VERSION,
+                    'shape': list(self.shape),
+                    'dtype': self.dtype.str,
+                }, file)
+            self._frames_file = open(self.path / 'frames.bin', 'wb')
+            self._timestamps_file = open(self.path / 'timestamps.bin', 'wb')
+        elif frame.shape != self.shape or frame.dtype != self.dtype:
+            raise ValueError(f'Frame {frame.shape} {frame.dtype} does not match the ' + \
+                f'recording format {self.shape} {self.dtype}')
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        self._frames_file.write(np.ascontiguousarray(frame).data)
+        self._timestamps_file.write(np.float64(timestamp).tobytes())
+        self.count += 1
+
+
+    def close(self):
+        if self._frames_file is not None:
+            self._frames_file.close()
+            self._timestamps_file.close()
+            self._frames_file = None
+            self._timestamps_file = None
+
+
+
+class FrameReader():
+    '''
+    Read-only access to a recording. Frames are memory-mapped, so indexing returns views
+    into the page cache instead of copies on the heap.
+    '''
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path / 'header.json', 'r') as file:
+            header = json.load(file)
+        if header['version'] != RECORDING_VERSION:
+            raise ValueError(f'Unsupported recording version {header["version"]}')
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.count = min(
+            os.path.getsize(self.path / 'frames.bin') // frame_size,
+            os.path.getsize(self.path / 'timestamps.bin') // 8
+        )
+        if self.count == 0:
+            raise ValueError(f'Recording "{self.path}" contains no frames')
+        self.frames = np.memmap(self.path / 'frames.bin', dtype=self.dtype, mode='r',
+            shape=(self.count, *self.shape))
+        self.timestamps = np.memmap(self.path / 'timestamps.bin', dtype=np.float64, mode='r',
+            shape=(self.count,))
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.frames[index]
+
+
+
+class FrameRecorder(Process):
+    '''
+    Passes its input through unchanged, recording every frame to path on the way.
+    Insert it after a capture Process (e.g. vision.ScreenGrab) to record a session.
+    '''
+
+    def __init__(self, path: str=''):
+        self.path = path
+        self.writer = None
+        super().__init__(num_inputs=1, num_outputs=1)
+
+    def start(self):
+        if not self.path:
+            raise ValueError('FrameRecorder requires a path')
+        self.writer = FrameWriter(self.path)
+
+    def run(self, inputs: list):
+        self.writer.write(inputs[0])
+        self.set_property('recorded', self.writer.count)
+        return [inputs[0]]
+
+    def stop(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def serialize(self, path: Path) -> dict:
+        return {'path': self.path}
+
+    def deserialize(self, config: dict, path: Path):
+        self.path = config.get('path', '')
+
+
+
+class RecordedScreenGrab(Process):
+    '''
+    A drop-in replacement for vision.ScreenGrab that replays a recording.
+    Frames are sent as views of the memory-mapped recording, without copying them.
+    Modes:
+      - 'native': replay with the recorded timing.
+      - 'fixed': replay at fps frames per second.
+      - 'unthrottled': replay as fast as downstream Processes consume the frames.
+    If loop is False, nothing more is sent after the last frame.
+    agent i starts i * AGENT_FRAME_OFFSET frames into the recording.
+    '''
+
+    MODES = ('native', 'fixed', 'unthrottled')
+
+    def __init__(self,
+        path: str='',
+        mode: str='native',
+        fps: float=30.0,
+        loop: bool=True,
+        agent: int=0
+    ):
+        if mode not in RecordedScreenGrab.MODES:
+            raise ValueError(f'"{mode}" is not a valid replay mode')
+        self.path = path
+        self.mode = mode
+        self.fps = fps
+        self.loop = loop
+        self.agent = agent
+        self.reader = None
+        self.index = 0
+        self._replay_start = 0
+        super().__init__(num_inputs=0, num_outputs=1)
+
+    def build(self):
+        self.reader = FrameReader(self.path)
+
+    def start(self):
+        self.index = self.agent * AGENT_FRAME_OFFSET % len(self.reader)
+        self._replay_start = time.perf_counter()
+        if self.mode == 'native':
+            # Keep to the recorded timing from the starting frame on.
+            self._replay_start -= self.reader.timestamps[self.index] - self.reader.timestamps[0]
+        elif self.mode == 'fixed':
+            self._replay_start -= self.index / self.fps
+
+    def run(self, inputs: list):
+        if self.index >= len(self.reader):
+            if not self.loop:
+                self.set_property('finished', True)
+                time.sleep(0.1)
+                return [None]
+            self.index = 0
+            self._replay_start = time.perf_counter()
+
+        if self.mode == 'native':
+            due = self.reader.timestamps[self.index] - self.reader.timestamps[0]
+        elif self.mode == 'fixed':
+            due = self.index / self.fps
+        else:
+            due = 0
+        delay = self._replay_start + due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        frame = self.reader[self.index]
+        self.index += 1
+        ts = self.time_step()
+        if ts > 0:
+            self.set_property('fps', round(1 / ts))
+        return [frame]
+
+    def serialize(self, path: Path) -> dict:
+        return {'path': self.path, 'mode': self.mode, 'fps': self.fps, 'loop': self.loop,
+            'agent': self.agent}
+
+    def deserialize(self, config: dict, path: Path):
+        self.path = config.get('path', self.path)
+        self.mode = config.get('mode', self.mode)
+        self.fps = config.get('fps', self.fps)
+        self.loop = config.get('loop', self.loop)
+        self.agent = config.get('agent', self.agent)
@@ -0,0 +1,149 @@
+import numpy as np
+
+
+
+class SumTree():
+    '''
+    A binary tree where each parent holds the sum of its children's priorities.
+    Updating a priority and finding the index for a given prefix sum are both O(log n).
+    '''
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def update(self, index: int, priority: float):
+        i = index + self.leaves
+        delta = priority - self.tree[i]
+        while i >= 1:
+            self.tree[i] += delta
+            i //= 2
+
+    def get(self, index: int) -> float:
+        return self.tree[index + self.leaves]
+
+    def total(self) -> float:
+        return self.tree[1]
+
+    def find(self, value: float) -> int:
+        '''Returns the index whose priority range contains the prefix sum value.'''
+        i = 1
+        while i < self.leaves:
+            left = 2 * i
+            if value < self.tree[left] or self.tree[left + 1] == 0:
+                i = left
+            else:
+                value -= self.tree[left]
+                i = left + 1
+        return min(i - self.leaves, self.capacity - 1)
+
+
+
+class ReplayBuffer():
+    '''
+    A fixed-capacity experience replay buffer for training Process models online.
+    Frames are kept in one preallocated contiguous array (uint8 by default) and labels in
+    another, so adding and sampling never allocate. New samples overwrite the oldest ones.
+
+    Modes:
+      - 'uniform': every stored sample is equally likely to be drawn.
+      - 'prioritized': samples are drawn proportionally to priority^alpha, where the
+        priority is set with update_priorities() (e.g. to the latest loss). Importance
+        sampling weights, annealed by beta, correct for the bias this introduces.
+    '''
+
+    MODES = ('uniform', 'prioritized')
+
+    def __init__(self,
+        capacity: int,
+        frame_shape: tuple,
+        label_shape: tuple=(2,),
+        frame_dtype: str='uint8',
+        mode: str='uniform',
+        max_batch_size: int=64,
+        alpha: float=0.6,
+        beta: float=0.4,
+        seed: int=None
+    ):
+        if mode not in ReplayBuffer.MODES:
+            raise ValueError(f'"{mode}" is not a valid replay buffer mode')
+        self.capacity = capacity
+        self.mode = mode
+        self.alpha = alpha
+        self.beta = beta
+        self.frames = np.zeros((capacity, *frame_shape), dtype=frame_dtype)
+        self.labels = np.zeros((capacity, *label_shape), dtype=np.float32)
+        self.position = 0
+        self.size = 0
+        self.max_priority = 1.0
+        self.tree = SumTree(capacity) if mode == 'prioritized' else None
+        self.rng = np.random.default_rng(seed)
+        # Sampled minibatches are gathered into these, so sampling doesn't allocate.
+        self._batch_frames = np.zeros((max_batch_size, *frame_shape), dtype=frame_dtype)
+        self._batch_labels = np.zeros((max_batch_size, *label_shape), dtype=np.float32)
+        self._batch_weights = np.ones(max_batch_size, dtype=np.float32)
+
+
+    def nbytes(self) -> int:
+        '''Memory used by the buffer, all of which is allocated on construction.'''
+        total = self.frames.nbytes + self.labels.nbytes + self._batch_frames.nbytes + \
+            self._batch_labels.nbytes + self._batch_weights.nbytes
+        if self.tree is not None:
+            total += self.tree.tree.nbytes
+        return total
+
+    def __len__(self):
+        return self.size
+
+
+    def add(self, frame: np.ndarray, label: np.ndarray):
+        '''Store a sample, overwriting the oldest one if the buffer is full.'''
+        i = self.position
+        np.copyto(self.frames[i], frame, casting='unsafe')
+        np.copyto(self.labels[i], label, casting='unsafe')
+        if self.tree is not None:
+            # New samples get the highest priority so they're replayed at least once soon.
+            self.tree.update(i, self.max_priority ** self.alpha)
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+
+    def sample(self, batch_size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Draw batch_size samples (with replacement).
+        Returns (indices, frames, labels, weights). frames, labels and weights are views
+        of internal buffers, valid until the next call to sample().
+        '''
+        if self.size == 0:
+            raise ValueError('Cannot sample from an empty ReplayBuffer')
+        if batch_size > len(self._batch_frames):
+            raise ValueError(f'batch_size must be at most {len(self._batch_frames)}')
+        weights = self._batch_weights[:batch_size]
+        if self.tree is None:
+            indices = self.rng.integers(0, self.size, batch_size)
+            weights[:] = 1
+        else:
+            # Stratified sampling: one draw from each equal slice of the total priority.
+            total = self.tree.total()
+            bounds = (np.arange(batch_size) + self.rng.random(batch_size)) * total / batch_size
+            indices = np.array([self.tree.find(b) for b in bounds], dtype=np.int64)
+            probabilities = np.array([self.tree.get(i) for i in indices]) / total
+            weights[:] = (self.size * probabilities) ** -self.beta
+            if batch_size > 0:
+                weights /= weights.max()
+        frames = self._batch_frames[:batch_size]
+        labels = self._batch_labels[:batch_size]
+        np.take(self.frames, indices, axis=0, out=frames)
+        np.take(self.labels, indices, axis=0, out=labels)
+        return indices, frames, labels, weights
+
+
+    def update_priorities(self, indices: np.ndarray, priorities: np.ndarray):
+        '''Set new priorities (e.g. per-sample losses) for previously sampled indices.'''
+        if self.tree is None:
+            return
+        for i, p in zip(indices, priorities):
+            p = float(p) + 1e-6
+            self.max_priority = max(self.max_priority, p)
+            self.tree.update(int(i), p ** self.alpha)
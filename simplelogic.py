@@ -1,109 +1,297 @@
 
 import os
+import time
 
-import cv2
 import numpy as np
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
 
 import config
+from labeling import ColorLabeler
 from process import Process
-from model import Model
+from replay import ReplayBuffer
+import tracing
 
 
-class SimpleLogicModel(Model):
+# Torch, and SimpleLogicModel with it, is only imported once the model is built, so
+# defining and saving a model (see "create") doesn't wait for it.
 
-    def init(self):
-        self.conv1 = nn.Conv2d(in_channels=3, out_channels=4, kernel_size=5)
-        self.conv2 = nn.Conv2d(in_channels=4, out_channels=4, kernel_size=5)
-        self.conv3 = nn.Conv2d(in_channels=4, out_channels=4, kernel_size=5)
-        self.lin1 = nn.Linear(in_features=1936, out_features=32)
-        self.lin2 = nn.Linear(in_features=32, out_features=2)
-        self.criterion = nn.MSELoss()
+def __getattr__(name: str):
+    # Models saved before SimpleLogicModel moved to simplelogicmodel.py refer to it here.
+    if name == 'SimpleLogicModel':
+        from simplelogicmodel import SimpleLogicModel
+        return SimpleLogicModel
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-    def forward(self, x):
-        x = F.max_pool2d(F.relu(self.conv1(x)), 2)
-        x = F.max_pool2d(F.relu(self.conv2(x)), 2)
-        x = torch.flatten(x)
-        x = self.lin1(x)
-        x = F.relu(x)
-        x = self.lin2(x)
-        return x
-
-    def loss(self, output, target):
-        return self.criterion(output, target)
 
+# The async learner's default share of time on a single core. See SimpleLogic.
+SINGLE_CORE_LEARNER_SHARE = 0.5
 
 
 class SimpleLogic(Process):
+    '''
+    Learning modes:
+      - 'inline': train on each frame before returning the movement for it.
+      - 'async': return the movement from a snapshot of the weights right away, and train
+        on a background AsyncLearner that republishes the weights every publish_interval
+        seconds. Movements then update at inference speed, independent of training.
+        The learner trains at most learner_share of the time (see AsyncLearner). By
+        default that's all of it with more than one core, and half of it on one core,
+        where it would otherwise take the time inference needs.
+
+    With num_agents > 1, there is one input and one output per agent, and frames from
+    all agents are run through the model as one batch. Each run waits for batch_size frames
+    (all agents by default), or for batch_deadline seconds after the first one arrived.
+
+    acceleration holds the arguments of Process.accelerate(), to speed up inference
+    (e.g. dict(channels_last=True, compile='trace', num_threads=2)). It's off by default.
+    '''
 
-    def __init__(self):
+    LEARNING_MODES = config.LEARNING_MODES
+
+    def __init__(self,
+        replay_size: int=4,
+        replay_capacity: int=2048,
+        replay_mode: str='uniform',
+        replay_probability: float=0.05,
+        learning: str='inline',
+        publish_interval: float=0.1,
+        learner_share: float=None,
+        num_agents: int=1,
+        batch_size: int=None,
+        batch_deadline: float=0.005,
+        acceleration: dict=None,
+        frame_size: tuple=None
+    ):
+        if learning not in SimpleLogic.LEARNING_MODES:
+            raise ValueError(f'"{learning}" is not a valid learning mode')
         self.model = None
+        # Whether to train on each frame. Set in start(), see Process.training_allowed().
         self.train = True
-        self.history = []
-        super().__init__(num_inputs=1, num_outputs=1)
+        self.learning = learning
+        self.publish_interval = publish_interval
+        self.learner_share = learner_share
+        self.learner = None
+        # Labels the frames trained on. Created in start(), when training.
+        self.labeler = None
+        # Number of past samples replayed alongside the current one in each training step.
+        self.replay_size = replay_size
+        # Number of samples the replay buffer holds, and how it samples them.
+        self.replay_capacity = replay_capacity
+        self.replay_mode = replay_mode
+        # Probability with which each trained frame is added to the replay buffer.
+        self.replay_probability = replay_probability
+        # The (width, height) of the frames trained on, if known in advance. The replay
+        # buffer and batch tensors are then allocated in start(), rather than on the first
+        # frame trained on.
+        self.frame_size = frame_size
+        self.replay = None
+        self._batch = None
+        self._targets = None
+        self._weights = None
+        self.num_agents = num_agents
+        self.batch_size = batch_size
+        self.batch_deadline = batch_deadline
+        self.acceleration = acceleration
+        super().__init__(num_inputs=num_agents, num_outputs=num_agents)
 
 
     def build(self):
+        import torch
+        from simplelogicmodel import SimpleLogicModel
         self.model = self.add_model(
             SimpleLogicModel,
             torch.optim.Adam,
             name='simple_logic',
             optimizer_args=dict(lr=1e-3)
         )
+        if self.acceleration is not None:
+            self.accelerate(**self.acceleration)
+
+    def start(self):
+        # Frozen, nothing is labeled, replayed or optimized, and the (deferred) optimizer
+        # of a loaded model is never built.
+        self.train = self.training_allowed()
+        if self.train:
+            self.labeler = ColorLabeler()
+            if self.replay is None and self.frame_size is not None:
+                width, height = self.frame_size
+                self._build_replay((3, height, width))
+        if self.train and self.learning == 'async':
+            from learner import AsyncLearner
+            share = self.learner_share
+            if share is None:
+                cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+                    else os.cpu_count() or 1
+                share = 1.0 if cores > 1 else SINGLE_CORE_LEARNER_SHARE
+            # Each run submits a sample per agent, which the learner trains on together.
+            self.learner = AsyncLearner(self.model,
+                lambda samples: self._train_step(*zip(*samples))[1], self.publish_interval,
+                max_pending=max(4, 2 * self.num_agents), max_batch=self.num_agents,
+                max_share=share)
+            self.learner.start()
+        if self.num_agents > 1:
+            self.gather(self.batch_size or self.num_agents, self.batch_deadline)
+
+    def stop(self):
+        if self.learner is not None:
+            self.learner.stop()
+            self.learner = None
 
 
     def run(self, inputs: list):
-    
-        rgb = inputs[0][:,:,0:3]
-        hsv = cv2.cvtColor(np.uint8(rgb), cv2.COLOR_RGB2HSV)
-        rgb = rgb / 255
+        # Each input is one agent's frame, or None if it has no new frame (see gather()).
+        # Frames from all agents are run as one batch.
+        import torch
+        outputs = [None] * len(inputs)
+        agents, frames, targets = [], [], []
+        for i, x in enumerate(inputs):
+            if x is None:
+                continue
+            rgb = x[:,:,0:3]
+            if self.train:
+                target = self._label(rgb)
+                if target is None:
+                    outputs[i] = np.array([0.0, 0.0])
+                    continue
+                targets.append(target)
+            agents.append(i)
+            frames.append(np.moveaxis(rgb, 2, 0))
+        if not agents:
+            return outputs
 
+        if self.train and self.learner is None:
+            batch_outputs, loss = self._train_step(frames, targets)
+            self.set_property('loss', loss)
+        else:
+            model = self.model
+            if self.train:
+                for chw, target in zip(frames, targets):
+                    # The learner trains later, so it gets its own copy of the frame.
+                    self.learner.submit(np.array(chw, dtype=np.uint8), target)
+                model = self.learner.poll()
+                self.set_property('loss', self.learner.loss)
+                self.set_property('learner steps', self.learner.steps)
+                self.set_property('learner dropped', self.learner.dropped)
+                self.set_property('staleness', self.learner.staleness())
+            with self.inference():
+                batch = torch.from_numpy(np.stack(frames).astype(np.float32)) / 255
+                with tracing.span('forward', 'model'):
+                    batch_outputs = self.accelerated(model)(batch)
+        for i, output in zip(agents, batch_outputs):
+            outputs[i] = output
+        if self.num_agents > 1:
+            self.set_property('batch', len(agents))
+        return outputs
 
-        if self.train:
-            target_mask = cv2.inRange(hsv, np.array([245, 50, 0]), np.array([255, 255, 255]))
-            target_mask = target_mask | cv2.inRange(hsv, np.array([0, 50, 0]), np.array([15, 255, 255]))
-
-            if np.mean(target_mask) < 0.03:
-                return [np.array([0.0, 0.0])]
-
-            #cv2.imshow('color', target_mask)
-            #cv2.waitKey(1)
-            target_moments = cv2.moments(target_mask)
-            # calculate x,y coordinate of center
-            if target_moments["m00"] == 0:
-                target_x, target_y = 0, 0
-            else:
-                target_x = target_moments["m10"] / target_moments["m00"]
-                target_y = target_moments["m01"] / target_moments["m00"]
-            target_x = (target_x - config.CONTROLS_WINDOW_WIDTH/16) * 16 / config.CONTROLS_WINDOW_WIDTH
-            target_y = (target_y - config.CONTROLS_WINDOW_HEIGHT/16) * 16 / config.CONTROLS_WINDOW_HEIGHT
-            target = torch.from_numpy(np.array([target_x, target_y], dtype=np.float32))
-
-            self.model.optimizer.zero_grad()
-            data = torch.from_numpy(np.moveaxis(rgb, 2, 0))
-            output = self.model(data)
-            loss = self.model.loss(output, target)
+
+    def _label(self, rgb: np.ndarray) -> 'torch.Tensor' or None:
+        '''
+        The offset of the pig from the center of the frame, in [-1, 1].
+        None if there isn't enough pig in the frame.
+        '''
+        import torch
+        labels = self.labeler.label(rgb)
+        if labels is None:
+            return None
+        return torch.tensor(labels['offset'], dtype=torch.float32)
+
+
+    def _train_step(self, frames: list[np.ndarray], targets: list['torch.Tensor']) -> tuple:
+        '''
+        One optimizer step on frames (uint8, channels first) and their targets,
+        together with samples replayed from the replay buffer.
+        Returns the outputs for frames and their mean loss.
+        '''
+        import torch
+        if self.replay is None or self._batch.shape[1:] != frames[0].shape:
+            # Not allocated in start(), or frames aren't frame_size after all.
+            self._build_replay(frames[0].shape)
+
+        # Train on the current samples and the replayed ones in a single batch.
+        # The batch tensors are preallocated and filled in place; replayed frames are
+        # stored as uint8.
+        k = n = len(frames)
+        for i, (chw, target) in enumerate(zip(frames, targets)):
+            # Frames may be strided views (see run()), which copy_() reads directly.
+            self._batch[i].copy_(torch.from_numpy(chw))
+            self._targets[i].copy_(target)
+        weights = self._weights
+        weights[:k] = 1
+        if self.replay_size > 0 and len(self.replay) > 0:
+            indices, replayed, labels, w = self.replay.sample(self.replay_size)
+            n += self.replay_size
+            self._batch[k:n].copy_(torch.from_numpy(replayed))
+            self._targets[k:n].copy_(torch.from_numpy(labels))
+            weights[k:n].copy_(torch.from_numpy(w))
+        batch = self._batch[:n].div_(255)
+        self.model.optimizer.zero_grad()
+        with tracing.span('forward', 'model'):
+            outputs = self.model(batch)
+            losses = self.model.sample_losses(outputs, self._targets[:n])
+            # The sum of per-sample losses, so gradients match separate backward passes
+            # over each sample. Prioritized replay weights correct for sampling bias.
+            loss = (losses * weights[:n]).sum()
+        with tracing.span('backward', 'model'):
             loss.backward()
-            for hd, ht in self.history:
-                hout = self.model(hd)
-                hloss = self.model.loss(hout, ht)
-                hloss.backward()
-            self.model.optimizer.step()
-            if np.random.random() < 0.005:
-                if len(self.history) >= 4:
-                    self.history.pop(0)
-                self.history.append((data, target))
-            self.set_property('loss', float(loss))
-
-            return [output]#[np.array([0.0, 0.0])]
+        t_lock = time.perf_counter()
+        with self.models_lock():
+            if tracing.active:
+                # Waiting for a checkpoint to finish copying the models.
+                tracing.record('models lock', 'lock', t_lock, time.perf_counter())
+            with tracing.span('optimizer step', 'model'):
+                self.model.optimizer.step()
+        if n > k:
+            self.replay.update_priorities(indices, losses[k:].detach().numpy())
+        for chw, target in zip(frames, targets):
+            if np.random.random() < self.replay_probability:
+                self.replay.add(chw, target.numpy())
+        self.set_property('replay', len(self.replay))
+        return outputs[:k].detach(), float(losses[:k].detach().mean())
 
-        else:
-            data = torch.from_numpy(np.float32(np.moveaxis(rgb, 2, 0)))
-            output = self.model(data)
 
-        return [output]
+    def _build_replay(self, frame_shape: tuple):
+        import torch
+        self.replay = ReplayBuffer(
+            capacity=self.replay_capacity,
+            frame_shape=frame_shape,
+            label_shape=(2,),
+            mode=self.replay_mode,
+            max_batch_size=max(self.replay_size, 1)
+        )
+        self._batch = torch.zeros((self.num_agents + self.replay_size, *frame_shape))
+        self._targets = torch.zeros((self.num_agents + self.replay_size, 2))
+        self._weights = torch.ones(self.num_agents + self.replay_size)
+        self.set_property('replay MB', round(self.replay.nbytes() / 2**20, 1))
+
+
+    def serialize(self, path) -> dict:
+        return {
+            'replay_size': self.replay_size,
+            'replay_capacity': self.replay_capacity,
+            'replay_mode': self.replay_mode,
+            'replay_probability': self.replay_probability,
+            'learning': self.learning,
+            'publish_interval': self.publish_interval,
+            'learner_share': self.learner_share,
+            'num_agents': self.num_agents,
+            'batch_size': self.batch_size,
+            'batch_deadline': self.batch_deadline,
+            'acceleration': self.acceleration,
+            'frame_size': self.frame_size,
+        }
+
+    def deserialize(self, config, path):
+        self.replay_size = config.get('replay_size', self.replay_size)
+        self.replay_capacity = config.get('replay_capacity', self.replay_capacity)
+        self.replay_mode = config.get('replay_mode', self.replay_mode)
+        self.replay_probability = config.get('replay_probability', self.replay_probability)
+        self.learning = config.get('learning', self.learning)
+        self.publish_interval = config.get('publish_interval', self.publish_interval)
+        self.learner_share = config.get('learner_share', self.learner_share)
+        self.num_agents = config.get('num_agents', self.num_agents)
+        self.batch_size = config.get('batch_size', self.batch_size)
+        self.batch_deadline = config.get('batch_deadline', self.batch_deadline)
+        self.acceleration = config.get('acceleration', self.acceleration)
+        self.frame_size = config.get('frame_size', self.frame_size)
 
 
     #def serialize(self, path):
@@ -0,0 +1,36 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import Model
+
+
+class SimpleLogicModel(Model):
+
+    def init(self):
+        self.conv1 = nn.Conv2d(in_channels=3, out_channels=4, kernel_size=5)
+        self.conv2 = nn.Conv2d(in_channels=4, out_channels=4, kernel_size=5)
+        self.conv3 = nn.Conv2d(in_channels=4, out_channels=4, kernel_size=5)
+        self.lin1 = nn.Linear(in_features=1936, out_features=32)
+        self.lin2 = nn.Linear(in_features=32, out_features=2)
+        self.criterion = nn.MSELoss()
+
+    def forward(self, x):
+        # Accepts a single (C, H, W) sample or an (N, C, H, W) batch.
+        batched = x.dim() == 4
+        if not batched:
+            x = x.unsqueeze(0)
+        x = F.max_pool2d(F.relu(self.conv1(x)), 2)
+        x = F.max_pool2d(F.relu(self.conv2(x)), 2)
+        x = torch.flatten(x, 1)
+        x = self.lin1(x)
+        x = F.relu(x)
+        x = self.lin2(x)
+        return x if batched else x.squeeze(0)
+
+    def loss(self, output, target):
+        return self.criterion(output, target)
+
+    def sample_losses(self, output, target):
+        '''Per-sample mean squared error of a batch.'''
+        return ((output - target) ** 2).mean(dim=-1)
@@ -0,0 +1,152 @@
+import threading
+import time
+
+import numpy as np
+
+import config
+
+
+# Colour of the targets, as RGB. It's what SimpleLogic looks for: a Minecraft pig's pink.
+TARGET_COLOR = (240, 150, 150)
+
+# Smoothing factor of the moving average of the target error.
+TARGET_ERROR_ALPHA = 0.05
+
+
+
+class SimulatedMinecraft():
+    '''
+    A stand-in for the Minecraft window, so the whole pipeline can run closed-loop without
+    the game (e.g. on a headless Linux machine). See platforms.SimulatedPlatform.
+
+    The world is a panorama, wrapping around horizontally, with pink square targets on a
+    noisy background. grab() renders the current view of it as a BGRA frame, like a screen
+    grab of the game window, and move_camera() pans the view by mouse deltas. The world
+    slowly turns by drift pixels per second, so there's always something to follow.
+    Modes:
+      - 'realtime': grab() waits so frames are produced at most fps times per second.
+      - 'unthrottled': grab() returns as soon as a frame is rendered.
+    '''
+
+    MODES = ('realtime', 'unthrottled')
+
+    def __init__(self,
+        width: int=config.CONTROLS_WINDOW_WIDTH,
+        height: int=config.CONTROLS_WINDOW_HEIGHT,
+        mode: str='realtime',
+        fps: float=60.0,
+        num_targets: int=8,
+        drift: float=40.0,
+        sensitivity: float=1.0,
+        seed: int=0
+    ):
+        if mode not in SimulatedMinecraft.MODES:
+            raise ValueError(f'"{mode}" is not a valid simulation mode')
+        self.width = width
+        self.height = height
+        self.mode = mode
+        self.fps = fps
+        self.drift = drift
+        self.sensitivity = sensitivity
+
+        rng = np.random.default_rng(seed)
+        self.world_width = width * 4
+        self.world_height = height * 2
+        self.world = np.empty((self.world_height, self.world_width, 4), dtype=np.uint8)
+        self.world[:,:,:3] = rng.integers(0, 96, (self.world_height, self.world_width, 3))
+        self.world[:,:,3] = 255
+        size = min(width, height) // 8
+        self.targets = []
+        for _ in range(num_targets):
+            x = int(rng.integers(0, self.world_width - size))
+            y = int(rng.integers(0, self.world_height - size))
+            self.world[y:y + size, x:x + size, :3] = TARGET_COLOR[::-1]
+            self.targets.append((x + size / 2, y + size / 2))
+
+        self.yaw = 0.0
+        self.pitch = (self.world_height - height) / 2
+        self.frames = 0
+        self.moves = 0
+        # Moving average of the distance from the center of the view to the nearest target,
+        # relative to half the view size. Falls as the agent learns to follow targets.
+        self.target_error = None
+        self._frame = np.empty((height, width, 4), dtype=np.uint8)
+        self._pending = [0.0, 0.0]
+        self._lock = threading.Lock()
+        self._last_grab = None
+        self._next_frame = None
+
+
+    def rect(self) -> dict:
+        '''The view's rect, as Platform.view_rect() returns it.'''
+        return {'left': 0, 'top': 0, 'width': self.width, 'height': self.height}
+
+
+    def move_camera(self, x: float, y: float):
+        '''Pan the view by a mouse movement. Applied from the next grab() on.'''
+        with self._lock:
+            self._pending[0] += float(x)
+            self._pending[1] += float(y)
+            self.moves += 1
+
+
+    def grab(self) -> np.ndarray:
+        '''
+        Renders the current view as a (height, width, 4) BGRA frame.
+        The same buffer is reused by the next grab(), so copy anything that's kept.
+        '''
+        now = time.perf_counter()
+        if self.mode == 'realtime':
+            if self._next_frame is None or now - self._next_frame > 1 / self.fps:
+                # Don't try to catch up after falling behind.
+                self._next_frame = now
+            elif self._next_frame > now:
+                time.sleep(self._next_frame - now)
+                now = time.perf_counter()
+            self._next_frame += 1 / self.fps
+        if self._last_grab is not None:
+            self.yaw += self.drift * (now - self._last_grab)
+        self._last_grab = now
+
+        with self._lock:
+            x, y = self._pending
+            self._pending[0] = self._pending[1] = 0.0
+        self.yaw += x * self.sensitivity
+        self.pitch = min(max(self.pitch + y * self.sensitivity, 0),
+            self.world_height - self.height)
+
+        # Copy the view out of the panorama, wrapping around horizontally.
+        left = int(self.yaw) % self.world_width
+        top = int(self.pitch)
+        rows = self.world[top:top + self.height]
+        first = min(self.width, self.world_width - left)
+        self._frame[:, :first] = rows[:, left:left + first]
+        self._frame[:, first:] = rows[:, :self.width - first]
+        self.frames += 1
+        self._record_error(left, top)
+        return self._frame
+
+
+    def _record_error(self, left: int, top: int):
+        cx, cy = left + self.width / 2, top + self.height / 2
+        error = None
+        for tx, ty in self.targets:
+            dx = (tx - cx + self.world_width / 2) % self.world_width - self.world_width / 2
+            dy = ty - cy
+            e = np.hypot(dx / (self.width / 2), dy / (self.height / 2))
+            if error is None or e < error:
+                error = e
+        if error is None:
+            return
+        if self.target_error is None:
+            self.target_error = error
+        else:
+            self.target_error += TARGET_ERROR_ALPHA * (error - self.target_error)
+
+
+    def stats(self) -> dict:
+        return {
+            'frames': self.frames,
+            'moves': self.moves,
+            'target_error': self.target_error,
+        }
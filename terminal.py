@@ -20,8 +20,19 @@ def build_tree(model: MinecraftAI):
     model_tree = Tree(model.name, style='bright_cyan', guide_style='blue')
     conn_head_tree = model_tree.add('Connections', style='cyan', guide_style='magenta')
     conns_table = Table(*[c.name for c in model.connections.values()], style='bright_black', header_style='bright_magenta')
-    conns_table.add_row(*[f'[white]{c.queue.qsize()}[/white] / {c.queue.maxsize}' \
+    conns_table.add_row(*[f'[white]{c.size()}[/white] / {c.capacity()}' \
         for c in model.connections.values()], style='bright_black')
+    stats = [c.get_stats() for c in model.connections.values()]
+    conns_table.add_row(*[f'p50 [white]{s["latency"]["p50_ms"]:g}[/white] ms, ' + \
+        f'p99 [white]{s["latency"]["p99_ms"]:g}[/white] ms' for s in stats], style='bright_black')
+    if any('overwritten' in s for s in stats):
+        conns_table.add_row(*[
+            f'[white]{s["overwritten"]}[/white] overwritten' if 'overwritten' in s else ''
+            for s in stats], style='bright_black')
+    if any(s.get('dropped') for s in stats):
+        conns_table.add_row(*[
+            f'[white]{s["dropped"]}[/white] dropped' if 'dropped' in s else ''
+            for s in stats], style='bright_black')
     conn_head_tree.add(conns_table)
     proc_head_tree = model_tree.add('Processes', style='cyan', guide_style='magenta')
     for proc in model.processes.values():
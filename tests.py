@@ -2,21 +2,25 @@
 
 from controls import Controls
 from PIL import Image, ImageGrab
-import win32api, win32gui, win32con
 import time
 from mss import mss
 import cv2 as cv
 import numpy as np
 import math
-import windows
 import config
 from pathlib import Path
+import threading
+from connection import Connection
 from minecraftai import MinecraftAI
+from process import Process
 
 
 
 
 def keypress_test():
+    # Windows-only, so pywin32 is imported here rather than with the module.
+    import win32gui
+    import windows
     windows.windows_init()
     wnd = windows.find_window('Notepad')
     if wnd is None:
@@ -158,6 +162,7 @@ def feature_map_test():
 
 
 def mouse_test():
+    import windows
     cont = Controls()
     cont.connect_to_window()
     elapsed = 0
@@ -168,7 +173,7 @@ def mouse_test():
     last = time.perf_counter()
     while elapsed < 30:
         step = time.perf_counter() - last
-        windows.send_mousemove(step *20* math.sin(elapsed), step *20* math.cos(elapsed))
+        windows.send_mousemove(round(step *20* math.sin(elapsed)), round(step *20* math.cos(elapsed)))
         time.sleep(0.01)
         last += step
         elapsed += step
@@ -181,6 +186,92 @@ def load_test():
 
 
 
+class _FrameSource(Process):
+    '''Sends a fresh copy of one random frame per iteration, as ScreenGrab would.'''
+
+    def __init__(self, shape: list=[800, 800, 3]):
+        self.shape = shape
+        self.frame = None
+        super().__init__(num_inputs=0, num_outputs=1)
+
+    def build(self):
+        self.frame = np.random.randint(0, 255, self.shape, dtype=np.uint8)
+
+    def run(self, inputs: list):
+        return [self.frame.copy()]
+
+
+class _FrameCounter(Process):
+    '''Counts the frames it receives, and when the first and last arrived.'''
+
+    def __init__(self):
+        self.count = 0
+        self.first = self.last = None
+        super().__init__(num_inputs=1, num_outputs=0)
+
+    def run(self, inputs: list):
+        self.last = time.perf_counter()
+        if self.first is None:
+            self.first = self.last
+        else:
+            self.count += 1
+        return []
+
+
+def transport_test(seconds: float=5):
+    '''
+    Compares Connection throughput for 800x800 RGB frames sent from a spawned OS process
+    (backend='process') to this one, between the default queue transport and the shared
+    memory ring. Across processes the queue pickles each frame through a pipe, while the
+    ring copies it into a shared slot and only passes the slot index.
+    '''
+    shape = [config.CONTROLS_WINDOW_HEIGHT, config.CONTROLS_WINDOW_WIDTH, 3]
+    frame_mb = np.prod(shape) / 2**20
+    for label, connection_args in [
+        ('queue', {}),
+        ('shared_memory', dict(transport='shared_memory', transport_args=dict(shape=shape))),
+    ]:
+        model = MinecraftAI(name='transport_test')
+        source = model.add_process(_FrameSource, name='source', type_args=dict(shape=shape),
+            backend='process')
+        counter = model.add_process(_FrameCounter, name='counter')
+        counter.connect(source.connect(), connection_args=connection_args)
+        model.start()
+        time.sleep(seconds)
+        model.stop()
+        # Counted from the first frame, so spawning the process isn't included.
+        counter = counter.process_obj
+        rate = counter.count / (counter.last - counter.first) if counter.count else 0.0
+        print(f'{label:>14} (across processes): {rate:8.1f} frames/s, ' + \
+            f'{rate * frame_mb:8.1f} MB/s')
+
+
+def frozen_build_test(define):
+    '''
+    Builds a freshly created model, without saved weights, the way "run" does, frozen
+    and then trainable. Only the trainable one should build its optimizers.
+    '''
+    import tempfile
+    import bench
+    from minecraft import Minecraft
+    Minecraft.use_platform('null')
+    with tempfile.TemporaryDirectory() as path:
+        bench.build_model(define).save(Path(path) / 'model', verbose=False)
+        for allow_training in (False, True):
+            model = MinecraftAI.load(Path(path) / 'model', verbose=False)
+            model.set_training(allow_training)
+            model.build()
+            built = {f'{proc.name}.{m.name}': m._optimizer is not None
+                for proc in model.processes.values() for m in proc.models.values()}
+            if not built:
+                raise Exception('The model has no models to check')
+            if any(b != allow_training for b in built.values()):
+                raise Exception(f'Optimizers built with allow_training={allow_training}: ' + \
+                    f'{built}')
+            print(f'allow_training={allow_training}: optimizers built {built}')
+
+
+
 
 def create_prototype1(
     path: Path,
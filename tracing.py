@@ -0,0 +1,199 @@
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import threading
+import time
+
+
+
+# An opt-in recorder of timed spans, e.g. each run() of a Process, each send() and
+# request() of a Connection, and SimpleLogic's forward and backward passes. Spans are
+# exported as Chrome trace events, which Perfetto (https://ui.perfetto.dev) and
+# chrome://tracing show as one track per thread.
+#
+#   tracing.start('trace.json')
+#   ... run the model ...
+#   tracing.stop()  # Writes trace.json
+#
+# While not started, hooks only check tracing.active.
+
+# Spans kept per thread. When a thread records more, its oldest spans are overwritten.
+DEFAULT_CAPACITY = 1 << 16
+
+# Whether spans are being recorded. Checked by hooks before timing anything.
+active = False
+
+_capacity = DEFAULT_CAPACITY
+_path = None
+# The SpanBuffer of each thread that recorded a span since start().
+_buffers = []
+_buffers_lock = threading.Lock()
+_local = threading.local()
+# Trace events of other OS processes, see add_events().
+_events = []
+
+
+
+class SpanBuffer():
+    '''
+    The spans recorded by one thread, as (name, category, start, end) tuples in a ring
+    preallocated to capacity spans. Only its own thread adds to it.
+    '''
+
+    def __init__(self, capacity: int):
+        self.spans = [None] * capacity
+        self.count = 0
+        thread = threading.current_thread()
+        self.thread_name = thread.name
+        self.pid = os.getpid()
+        self.tid = thread.native_id
+
+    def add(self, span: tuple):
+        self.spans[self.count % len(self.spans)] = span
+        self.count += 1
+
+    @property
+    def overwritten(self) -> int:
+        return max(0, self.count - len(self.spans))
+
+    def recorded(self) -> list[tuple]:
+        '''The spans still held, oldest first.'''
+        count, capacity = self.count, len(self.spans)
+        if count <= capacity:
+            return self.spans[:count]
+        i = count % capacity
+        return self.spans[i:] + self.spans[:i]
+
+
+
+class _Span():
+    '''Records the time spent in its with block as a span.'''
+
+    __slots__ = ('name', 'category', 't0')
+
+    def __init__(self, name: str, category: str):
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.category, self.t0, time.perf_counter())
+        return False
+
+
+
+class _NoSpan():
+    '''Stands in for a _Span while tracing isn't active.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+
+def start(path: str or Path=None, capacity: int=DEFAULT_CAPACITY):
+    '''
+    Starts recording spans, discarding any recorded before. Each thread keeps its last
+    capacity spans. If path is given, stop() writes the trace there.
+    '''
+    global active, _capacity, _path, _buffers, _local, _events
+    if capacity < 1:
+        raise ValueError(f'Trace capacity must be positive, not {capacity}')
+    with _buffers_lock:
+        _capacity = capacity
+        _path = path
+        _buffers = []
+        _events = []
+        # Threads get new buffers, even if they recorded spans before.
+        _local = threading.local()
+    active = True
+
+
+def stop() -> list[dict] or None:
+    '''
+    Stops recording spans. Writes the trace to the path given to start(), if any.
+    Returns the trace events, or None if tracing wasn't active.
+    '''
+    global active
+    if not active:
+        return None
+    active = False
+    trace = events()
+    if _path is not None:
+        _write(_path, trace)
+    return trace
+
+
+def record(name: str, category: str, t0: float, t1: float):
+    '''
+    Records a span from t0 to t1 (time.perf_counter() seconds) on the calling thread.
+    Callers that time things anyway check active first instead of using span().
+    '''
+    try:
+        buffer = _local.buffer
+    except AttributeError:
+        buffer = _local.buffer = SpanBuffer(_capacity)
+        with _buffers_lock:
+            _buffers.append(buffer)
+    buffer.add((name, category, t0, t1))
+
+
+def span(name: str, category: str='') -> _Span or _NoSpan:
+    '''A context manager recording the time spent in its with block, if tracing is active.'''
+    if not active:
+        return _NO_SPAN
+    return _Span(name, category)
+
+
+def events() -> list[dict]:
+    '''
+    The spans recorded so far, as Chrome trace events, together with those added from
+    other OS processes. Times are in microseconds of time.perf_counter(), which is
+    system-wide, so spans of different processes line up.
+    '''
+    with _buffers_lock:
+        buffers = list(_buffers)
+        trace = list(_events)
+    pid = os.getpid()
+    if buffers:
+        trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+            'args': {'name': multiprocessing.current_process().name}})
+    for buffer in buffers:
+        trace.append({'name': 'thread_name', 'ph': 'M', 'pid': buffer.pid, 'tid': buffer.tid,
+            'args': {'name': buffer.thread_name, 'overwritten spans': buffer.overwritten}})
+        for name, category, t0, t1 in buffer.recorded():
+            trace.append({'name': name, 'cat': category, 'ph': 'X', 'pid': buffer.pid,
+                'tid': buffer.tid, 'ts': t0 * 1e6, 'dur': (t1 - t0) * 1e6})
+    return trace
+
+
+def add_events(trace: list[dict]):
+    '''Adds trace events recorded in another OS process, see events().'''
+    with _buffers_lock:
+        _events.extend(trace)
+
+
+def dump(path: str or Path=None) -> Path:
+    '''
+    Writes the spans recorded so far as a Chrome trace, without stopping. path defaults
+    to the one given to start(). Returns where it was written.
+    '''
+    path = path if path is not None else _path
+    if path is None:
+        raise ValueError('No path to write the trace to')
+    _write(path, events())
+    return Path(path)
+
+
+def _write(path: str or Path, trace: list[dict]):
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file)
@@ -0,0 +1,353 @@
+from multiprocessing import shared_memory
+import queue
+import threading
+import time
+import weakref
+
+import numpy as np
+
+
+
+class SharedMemoryRing():
+    '''
+    A fixed number of equally sized array slots preallocated in shared memory.
+    Only slot indices and sequence numbers are passed through the index queues, so
+    frames are written once by the producer and read in place by the consumer.
+
+    The producer owns a slot from acquire() until commit(). The consumer owns a slot
+    from read() until its next read(), at which point the slot is returned to the pool.
+    Views returned by read() are therefore only valid until the next call to read().
+    '''
+
+    def __init__(self,
+        shape: tuple,
+        dtype: str='uint8',
+        num_slots: int=4
+    ):
+        if num_slots < 2:
+            raise ValueError('A SharedMemoryRing needs at least 2 slots')
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.num_slots = num_slots
+        self.slot_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = None
+        self.free = None
+        self.filled = None
+        self.sequence = 0
+        self.last_sequence = -1
+        self.last_stamp = None
+        self.skipped = 0
+        self._views = None
+        self._held = None
+
+
+    def _build(self, make_queue=queue.Queue):
+        '''
+        Allocate the shared memory block and the index queues.
+        make_queue(maxsize) is used to create the queues, so the same ring can be backed
+        by threading or multiprocessing queues.
+        '''
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slot_size * self.num_slots)
+        # Unlink the block once the ring that created it is gone, even on abnormal exit.
+        self._finalizer = weakref.finalize(self, SharedMemoryRing._unlink, self.shm)
+        self.free = make_queue(self.num_slots)
+        self.filled = make_queue(self.num_slots)
+        for slot in range(self.num_slots):
+            self.free.put(slot)
+        self._make_views()
+
+
+    def _make_views(self):
+        self._views = [
+            np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf,
+                offset=slot * self.slot_size)
+            for slot in range(self.num_slots)
+        ]
+
+
+    def __getstate__(self):
+        # Views and the finalizer belong to the creating OS process. The shared memory
+        # block itself pickles by name, so other processes attach to the same memory.
+        state = self.__dict__.copy()
+        state['_views'] = None
+        state.pop('_finalizer', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shm is not None:
+            self._make_views()
+
+
+    def _unlink(shm: shared_memory.SharedMemory):
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            shm.close()
+        except BufferError:
+            # A consumer still holds a view; the mapping is freed with the process.
+            pass
+
+
+    def acquire(self, block: bool=True, timeout: float=None) -> tuple[int, np.ndarray]:
+        '''
+        Reserve a free slot for writing. Returns (slot, writable view).
+        Raises queue.Empty if no slot is free and block is False or timeout expires.
+        '''
+        slot = self.free.get(block, timeout)
+        return slot, self._views[slot]
+
+
+    def commit(self, slot: int, block: bool=True, timeout: float=None, stamp=None):
+        '''
+        Publish a slot previously reserved with acquire().
+        stamp is passed along with the slot index, e.g. for timing information.
+        '''
+        self.filled.put((slot, self.sequence, stamp), block, timeout)
+        self.sequence += 1
+
+
+    def write(self,
+        data: np.ndarray,
+        block: bool=True,
+        timeout: float=None,
+        stamp=None
+    ):
+        '''
+        Copy data into a free slot and publish it.
+        Raises queue.Full if no slot is free and block is False or timeout expires.
+        '''
+        try:
+            slot, view = self.acquire(block, timeout)
+        except queue.Empty:
+            raise queue.Full()
+        np.copyto(view, data, casting='unsafe')
+        self.commit(slot, block, timeout, stamp)
+
+
+    def read(self, block: bool=True, timeout: float=None) -> np.ndarray or None:
+        '''
+        Returns a read-only view of the next published slot, or None if a stop was posted.
+        The slot returned by the previous call is released back to the producer.
+        '''
+        self.release()
+        item = self.filled.get(block, timeout)
+        if item is None:
+            return None
+        slot, sequence, self.last_stamp = item
+        if sequence != self.last_sequence + 1:
+            self.skipped += sequence - self.last_sequence - 1
+        self.last_sequence = sequence
+        self._held = slot
+        view = self._views[slot].view()
+        view.flags.writeable = False
+        return view
+
+
+    def reclaim(self) -> int or None:
+        '''
+        Takes back the oldest published slot that hasn't been read yet, for the producer
+        to write over instead. Returns its index, or None if there is none.
+        The consumer counts the value it never got as skipped.
+        '''
+        try:
+            item = self.filled.get_nowait()
+        except queue.Empty:
+            return None
+        if item is None:
+            # A stop was posted; keep it for the consumer.
+            self.post_stop()
+            return None
+        return item[0]
+
+
+    def release(self):
+        '''Return the slot held by the consumer, if any, to the free pool.'''
+        if self._held is not None:
+            self.free.put(self._held)
+            self._held = None
+
+
+    def drain(self):
+        '''Discard all published slots, returning them to the free pool.'''
+        try:
+            while True:
+                item = self.filled.get_nowait()
+                if item is not None:
+                    self.free.put(item[0])
+        except queue.Empty:
+            pass
+
+
+    def post_stop(self):
+        try:
+            self.filled.put(None, timeout=0.01)
+        except queue.Full:
+            pass
+
+
+    def nbytes(self) -> int:
+        return self.slot_size * self.num_slots
+
+
+
+class LatestValueSlot():
+    '''
+    A single slot holding the most recent value, used by 'continuous' Connections.
+    The producer overwrites the slot in place and never blocks. The consumer always gets
+    the newest value, tagged with a generation counter that increases with every put().
+    Publishing is a single reference assignment, so neither side takes a lock to access
+    the value; the event is only used to wake up a consumer waiting for a new value.
+    Assumes a single producer and a single consumer.
+    '''
+
+    def __init__(self):
+        # (generation, data). Generation 0 means nothing has been put yet.
+        self._value = (0, None)
+        self._event = threading.Event()
+        self._stop = False
+        # Values up to this generation were drained and must not be returned.
+        self._floor = 0
+        self.last_generation = 0
+        self.written = 0
+        self.overwritten = 0
+        self.repeated = 0
+
+
+    def put(self, data):
+        generation = self._value[0]
+        if generation > self.last_generation:
+            # The previous value was never read.
+            self.overwritten += 1
+        self._value = (generation + 1, data)
+        self.written += 1
+        self._event.set()
+
+
+    def get(self, block: bool=True, timeout: float=None, wait_for_new: bool=False):
+        '''
+        Returns the newest value, or None if a stop was posted.
+        If wait_for_new, waits for a value newer than the last one returned. Otherwise only
+        waits if nothing has been put yet.
+        Raises queue.Empty if block is False or timeout expires while waiting.
+        '''
+        newer_than = max(self.last_generation, self._floor) if wait_for_new else self._floor
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            generation, data = self._value
+            if generation > newer_than:
+                break
+            if self._stop:
+                self._stop = False
+                return None
+            # Clear, then check again, so a put() between the two can't be missed.
+            self._event.clear()
+            generation, data = self._value
+            if generation > newer_than or self._stop:
+                continue
+            if not block:
+                raise queue.Empty()
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                raise queue.Empty()
+            self._event.wait(remaining)
+        if generation == self.last_generation:
+            self.repeated += 1
+        self.last_generation = generation
+        return data
+
+
+    def has_unread(self) -> bool:
+        return self._value[0] > self.last_generation
+
+
+    def drain(self):
+        '''Forget the current value, so the consumer waits for the next put().'''
+        self._floor = self._value[0]
+
+
+    def post_stop(self):
+        self._stop = True
+        self._event.set()
+
+
+
+class SharedLatestValueSlot():
+    '''
+    The multiprocessing counterpart of LatestValueSlot, for 'continuous' Connections
+    between OS processes. The value travels through a queue of size 1 which the producer
+    empties before putting, so it never blocks; the consumer keeps the last value it
+    received to hand out again when nothing newer arrived.
+    Counters live in shared memory so every process sees the same numbers.
+    '''
+
+    def __init__(self, context: 'multiprocessing.context.BaseContext'):
+        self._mailbox = context.Queue(1)
+        self._counters = context.RawArray('q', 3)
+        self._latest = (0, None)
+        self._generation = 0
+        self.last_generation = 0
+
+    written = property(lambda self: self._counters[0])
+    overwritten = property(lambda self: self._counters[1])
+    repeated = property(lambda self: self._counters[2])
+
+
+    def put(self, data):
+        self._generation += 1
+        item = (self._generation, data)
+        while True:
+            try:
+                self._mailbox.put_nowait(item)
+                break
+            except queue.Full:
+                try:
+                    self._mailbox.get_nowait()
+                    self._counters[1] += 1
+                except queue.Empty:
+                    pass
+        self._counters[0] += 1
+
+
+    def get(self, block: bool=True, timeout: float=None, wait_for_new: bool=False):
+        '''See LatestValueSlot.get().'''
+        try:
+            item = self._mailbox.get_nowait()
+        except queue.Empty:
+            if self._latest[0] > 0 and not wait_for_new:
+                self._counters[2] += 1
+                return self._latest[1]
+            if not block:
+                raise
+            item = self._mailbox.get(True, timeout)
+        if item is None:
+            return None
+        self._latest = item
+        self.last_generation = item[0]
+        return item[1]
+
+
+    def has_unread(self) -> bool:
+        return not self._mailbox.empty()
+
+
+    def drain(self):
+        try:
+            while True:
+                self._mailbox.get_nowait()
+        except queue.Empty:
+            pass
+        self._latest = (0, None)
+
+
+    def post_stop(self):
+        try:
+            self._mailbox.put(None, timeout=0.01)
+        except queue.Full:
+            pass
+
+
+    def _detach(self):
+        self._mailbox.cancel_join_thread()
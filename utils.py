@@ -3,8 +3,6 @@ import itertools
 import pydoc
 from typing import Iterable
 
-import torch
-
 
 def get_full_qualified_name(obj: object) -> str:
     return obj.__module__ + '.' + obj.__qualname__
@@ -40,7 +38,9 @@ def create_new_id(existing_keys: Iterable):
     return next(itertools.filterfalse(existing_keys.__contains__, itertools.count(1)))
 
 
+# torch is only imported by the functions using it, so importing utils stays cheap.
 def optimizer_from_name(name: str):
+    import torch
     o = torch.optim
     return {
         'adadelta':     o.Adadelta,
@@ -59,6 +59,7 @@ def optimizer_from_name(name: str):
     }[name.lower()]
 
 def name_from_optimizer(opt: type):
+    import torch
     o = torch.optim
     return {
         o.Adadelta:     'adadelta',
@@ -1,63 +1,245 @@
 
-import cv2
-from mss import mss
 import numpy as np
-from PIL import Image
 
 from minecraft import Minecraft
 from process import Process
 
 
 class ScreenGrab(Process):
+    '''
+    Grabs agent's view of the game (see Minecraft and platforms.py), or the
+    region roi = (left, top, width, height) of it.
+    If size = (width, height) is given, the grab is decimated to that size (nearest neighbour)
+    in the same pass as its conversion from BGRA, so full-resolution frames never leave
+    this Process. Formats:
+      - 'rgb': (height, width, 3)
+      - 'gray': (height, width)
+      - 'planar': (3, height, width), RGB channels first
+    Outputs are written into a ring of num_buffers preallocated arrays (see VisionProcessing).
+    '''
 
-    def __init__(self):
+    FORMATS = ('rgb', 'gray', 'planar')
+
+    def __init__(self,
+        size: tuple=None,
+        roi: tuple=None,
+        format: str='rgb',
+        num_buffers: int=8,
+        agent: int=0
+    ):
+        if format not in ScreenGrab.FORMATS:
+            raise ValueError(f'"{format}" is not a valid ScreenGrab format')
+        self.size = size
+        self.roi = roi
+        self.format = format
+        self.num_buffers = num_buffers
+        self.agent = agent
+        self._outputs = None
+        self._index = 0
         super().__init__(num_inputs=0, num_outputs=1)
 
     def build(self):
-        self.client_rect_dict = Minecraft.resize_window()
-        self.sct = mss()
+        self.client_rect_dict = Minecraft.resize_window(self.agent)
+        if self.roi is not None:
+            left, top, width, height = self.roi
+            self.client_rect_dict = {
+                'left': self.client_rect_dict['left'] + left,
+                'top': self.client_rect_dict['top'] + top,
+                'width': width,
+                'height': height,
+            }
+        # Only the game's window is grabbed from the screen. Other platforms provide frames.
+        if Minecraft.get_platform().screen_capture:
+            from mss import mss
+            self.sct = mss()
+        else:
+            self.sct = None
+
+    def _allocate(self, grab_shape: tuple):
+        h, w = grab_shape[:2]
+        out_w, out_h = self.size if self.size is not None else (w, h)
+        if self.format == 'rgb':
+            shape = (out_h, out_w, 3)
+        elif self.format == 'gray':
+            shape = (out_h, out_w)
+        else:
+            shape = (3, out_h, out_w)
+        self._outputs = [np.zeros(shape, dtype=np.uint8) for _ in range(self.num_buffers)]
+        self._grab_shape = grab_shape
+        # Integer factors are decimated with strides, anything else is resized first.
+        self._step = (h // out_h, w // out_w) if h % out_h == 0 and w % out_w == 0 else None
+        self._resized = np.zeros((out_h, out_w, 4), dtype=np.uint8)
+        self._bgr = np.zeros((out_h, out_w, 3), dtype=np.uint8)
+
+    def convert(self, bgra: np.ndarray) -> np.ndarray:
+        '''Decimates and converts a (height, width, 4) BGRA grab into the next output buffer.'''
+        import cv2
+        if self._outputs is None or bgra.shape != self._grab_shape:
+            self._allocate(bgra.shape)
+        output = self._outputs[self._index]
+        self._index = (self._index + 1) % self.num_buffers
+
+        if self._step is None:
+            src = cv2.resize(bgra, self._resized.shape[1::-1], dst=self._resized,
+                interpolation=cv2.INTER_NEAREST)
+        else:
+            src = bgra[::self._step[0], ::self._step[1]]
+        # Reversing the first 3 channels converts BGRA to RGB and drops the alpha channel.
+        # It's faster to do this here rather than with vision processing
+        # because we don't pass the alpha channel between processes.
+        if self._step == (1, 1) and self.format != 'planar':
+            # Nothing to decimate, and cv2 converts faster than strided copies.
+            code = cv2.COLOR_BGRA2RGB if self.format == 'rgb' else cv2.COLOR_BGRA2GRAY
+            cv2.cvtColor(bgra, code, dst=output)
+        elif self.format == 'rgb':
+            np.copyto(output, src[:,:,2::-1])
+        elif self.format == 'planar':
+            np.copyto(output, src[:,:,2::-1].transpose(2, 0, 1))
+        else:
+            np.copyto(self._bgr, src[:,:,:3])
+            cv2.cvtColor(self._bgr, cv2.COLOR_BGR2GRAY, dst=output)
+        return output
 
     def run(self, inputs: list):
-        img = self.sct.grab(self.client_rect_dict)
-        # Convert BGRA to RGB. It's faster to do this here rather than with vision processing
-        # because we can drop the alpha channel and not pass it between processes.
-        img = cv2.cvtColor(np.array(img), cv2.COLOR_BGRA2RGB)
+        if self.sct is None:
+            r = self.client_rect_dict
+            bgra = Minecraft.grab_frame(self.agent)[
+                r['top']:r['top'] + r['height'], r['left']:r['left'] + r['width']]
+        else:
+            img = self.sct.grab(self.client_rect_dict)
+            bgra = np.frombuffer(img.raw, dtype=np.uint8).reshape(img.height, img.width, 4)
+        output = self.convert(bgra)
         #if self.time_step() != 0:
         #    print(f'\r{int(1/self.time_step()):.3f}     ', end='')
         ts = self.time_step()
         if ts > 0:
             self.set_property('fps', round(1 / ts))
-        return [img]
+        return [output]
+
+    def num_output_buffers(self) -> int:
+        return self.num_buffers
+
+    def serialize(self, path) -> dict:
+        return {
+            'size': self.size,
+            'roi': self.roi,
+            'format': self.format,
+            'num_buffers': self.num_buffers,
+            'agent': self.agent,
+        }
+
+    def deserialize(self, config: dict, path):
+        self.size = config.get('size', self.size)
+        self.roi = config.get('roi', self.roi)
+        self.format = config.get('format', self.format)
+        self.num_buffers = config.get('num_buffers', self.num_buffers)
+        self.agent = config.get('agent', self.agent)
 
 
 
 class VisionProcessing(Process):
+    '''
+    Shrinks each frame by shrink_factor, or to size = (width, height) if given, and outputs the requested features, stacked along
+    the channel axis in the order of FEATURES:
+      - 'rgb': the shrunk frame (3 channels)
+      - 'flow': Farneback optical flow from the previous frame (2 channels)
+      - 'diff': the change from the previous frame, in [-1, 1] (3 channels)
+      - 'edges': Canny edges (1 channel)
+    The output is uint8 if only 'rgb' and 'edges' are requested, and float32 otherwise.
+    Outputs are written into a ring of num_buffers preallocated arrays, so an output is
+    overwritten num_buffers frames later. The capacity of its output Connection must be
+    at most num_buffers - 2, which MinecraftAI.compile() checks (see num_output_buffers()).
+    '''
 
-    def __init__(self):
-        self.prev = None
-        self.prev_gray = None
+    FEATURES = {'rgb': 3, 'flow': 2, 'diff': 3, 'edges': 1}
+
+    def __init__(self,
+        features: list=list(FEATURES),
+        shrink_factor: int=8,
+        size: tuple=None,
+        num_buffers: int=8
+    ):
+        for f in features:
+            if f not in VisionProcessing.FEATURES:
+                raise ValueError(f'"{f}" is not a valid vision feature')
+        self.features = [f for f in VisionProcessing.FEATURES if f in features]
+        self.shrink_factor = shrink_factor
+        self.size = size
+        self.num_buffers = num_buffers
+        self._outputs = None
+        self._index = 0
         super().__init__(num_inputs=1, num_outputs=1)
 
-    def run(self, inputs: list):
+    def _allocate(self, frame_shape: tuple):
+        if self.size is not None:
+            w, h = self.size
+        else:
+            h, w = frame_shape[0] // self.shrink_factor, frame_shape[1] // self.shrink_factor
+        self._slices = {}
+        channels = 0
+        for f in self.features:
+            n = VisionProcessing.FEATURES[f]
+            self._slices[f] = slice(channels, channels + n)
+            channels += n
+        dtype = np.uint8 if set(self.features) <= {'rgb', 'edges'} else np.float32
+        self._outputs = [np.zeros((h, w, channels), dtype=dtype) for _ in range(self.num_buffers)]
+        self._frame_shape = frame_shape
+        # Scratch buffers. The current and previous frame are swapped rather than copied.
+        self._small = np.zeros((h, w, 3), dtype=np.uint8)
+        self._prev = np.zeros((h, w, 3), dtype=np.uint8)
+        self._gray = np.zeros((h, w), dtype=np.uint8)
+        self._prev_gray = np.zeros((h, w), dtype=np.uint8)
+        self._flow = np.zeros((h, w, 2), dtype=np.float32)
+        self._edges = np.zeros((h, w), dtype=np.uint8)
 
-        SHRINK_FACTOR = 8
+    def run(self, inputs: list):
+        import cv2
         img = inputs[0]
-        img_smol = np.array(Image.fromarray(img).resize((img.shape[0] // SHRINK_FACTOR, img.shape[1] // SHRINK_FACTOR)))
-        
-        #img_smol = cv2.resize(img, (img.shape[0] // SHRINK_FACTOR, img.shape[1] // SHRINK_FACTOR))
-        img_gray = cv2.cvtColor(np.array(img_smol), cv2.COLOR_RGB2GRAY)
-        if self.prev is None:
-            self.prev = np.zeros_like(img_smol)
-            self.prev_gray = np.zeros_like(img_gray)
-        flow = cv2.calcOpticalFlowFarneback(self.prev_gray, img_gray,
-            None, 0.5, 3, 4, 3, 5, 1.2, 0
-        )
-        diff = (np.float32(img_smol) - np.float32(self.prev)) / 255.0
-        edges = cv2.Canny(np.array(img_smol), 100, 200)
-        edges = np.expand_dims(edges, axis=2)
-        output = np.concatenate([img_smol, flow, diff, edges], axis=2)
-        self.prev = img_smol
-        self.prev_gray = img_gray
+        if self._outputs is None or img.shape != self._frame_shape:
+            self._allocate(img.shape)
+        output = self._outputs[self._index]
+        self._index = (self._index + 1) % self.num_buffers
+
+        h, w = self._small.shape[:2]
+        # cv2 sizes are (width, height).
+        if self.features == ['rgb']:
+            cv2.resize(img, (w, h), dst=output, interpolation=cv2.INTER_AREA)
+            return [output]
+        small = cv2.resize(img, (w, h), dst=self._small, interpolation=cv2.INTER_AREA)
+
+        if 'rgb' in self.features:
+            np.copyto(output[:,:,self._slices['rgb']], small)
+        if 'flow' in self.features:
+            gray = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY, dst=self._gray)
+            cv2.calcOpticalFlowFarneback(self._prev_gray, gray,
+                self._flow, 0.5, 3, 4, 3, 5, 1.2, 0
+            )
+            np.copyto(output[:,:,self._slices['flow']], self._flow)
+            self._gray, self._prev_gray = self._prev_gray, self._gray
+        if 'diff' in self.features:
+            diff = output[:,:,self._slices['diff']]
+            np.subtract(small, self._prev, out=diff, dtype=np.float32)
+            diff *= 1 / 255.0
+            self._small, self._prev = self._prev, self._small
+        if 'edges' in self.features:
+            cv2.Canny(small, 100, 200, edges=self._edges)
+            np.copyto(output[:,:,self._slices['edges']], self._edges[:,:,None])
 
         return [output]
 
+    def num_output_buffers(self) -> int:
+        return self.num_buffers
+
+    def serialize(self, path) -> dict:
+        return {
+            'features': self.features,
+            'shrink_factor': self.shrink_factor,
+            'size': self.size,
+            'num_buffers': self.num_buffers,
+        }
+
+    def deserialize(self, config: dict, path):
+        self.features = config.get('features', self.features)
+        self.shrink_factor = config.get('shrink_factor', self.shrink_factor)
+        self.size = config.get('size', self.size)
+        self.num_buffers = config.get('num_buffers', self.num_buffers)
@@ -28,11 +28,13 @@ class Win32:
     # The ctypes mouse_event operates on "mickeys" on a 65536x65536 virtual screen
     # These helpers will transform coordinates from pixels to mickeys
     # @source: https://stackoverflow.com/questions/4263608/ctypes-mouse-events
-    VIRTUAL_SCREEN_RATIO_X = 65536 / ctypes.windll.user32.GetSystemMetrics(0)
-    VIRTUAL_SCREEN_RATIO_Y = 65536 / ctypes.windll.user32.GetSystemMetrics(1)
+    # The screen size is only read when needed, so importing this module has no side effects.
+    def virtual_screen_ratio() -> tuple:
+        return 65536 / ctypes.windll.user32.GetSystemMetrics(0), \
+            65536 / ctypes.windll.user32.GetSystemMetrics(1)
     def mouse_event_coord(x, y):
-        return int(x * Win32.VIRTUAL_SCREEN_RATIO_X + 1), \
-            int(y * Win32.VIRTUAL_SCREEN_RATIO_Y + 1)
+        ratio_x, ratio_y = Win32.virtual_screen_ratio()
+        return int(x * ratio_x + 1), int(y * ratio_y + 1)
 
 
 def windows_init():
@@ -99,12 +101,13 @@ def send_keydown(window_handle: HWND, keycode: int):
 def send_keyup(window_handle: HWND, keycode: int):
     win32gui.PostMessage(window_handle, win32con.WM_KEYUP, keycode, 0xC0000001)
 
-def send_mousemove(delta_x: float, delta_y: float):
-    p = win32api.GetCursorPos()
-    #delta_x += p[0]
-    #delta_y += p[1]
+def send_mousemove(delta_x: int, delta_y: int):
+    '''
+    Moves the mouse by whole pixels, relative to where it is.
+    Callers keep track of fractions of a pixel themselves (see Controls).
+    '''
     #ctypes.windll.user32.mouse_event(0x8001, *Win32.mouse_event_coord(delta_x, delta_y), 0)
-    ctypes.windll.user32.mouse_event(0x0001, int(delta_x), int(delta_y), 0)
+    ctypes.windll.user32.mouse_event(0x0001, delta_x, delta_y, 0)
 
 
 def set_cursor_pos(x: int, y: int):